@@ -11,6 +11,13 @@ load_dotenv()
 from .mathpix_config import mathpix_config
 from .vertex_ai_config import vertex_ai_config
 
+def _env_bool(name, default=False):
+    """Đọc biến môi trường dạng bool (1/true/yes/on)"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
 class AppConfig:
     """Cấu hình tổng cho ứng dụng"""
     
@@ -24,6 +31,84 @@ class AppConfig:
         self.input_folder = os.path.join(self.data_folder, "input")
         self.output_folder = os.path.join(self.data_folder, "output")
         
+        # Cấu hình cache kết quả OCR (SQLite + blob files)
+        self.ocr_cache_enabled = _env_bool("OCR_CACHE_ENABLED", True)
+        self.ocr_cache_folder = os.getenv("OCR_CACHE_DIR") or os.path.join(self.data_folder, "cache", "ocr")
+        self.ocr_cache_max_mb = int(os.getenv("OCR_CACHE_MAX_MB", "1024"))
+        self.ocr_cache_max_age_days = float(os.getenv("OCR_CACHE_MAX_AGE_DAYS", "30"))
+        
+        # Tải ảnh trong md2json: số ảnh tải đồng thời, timeout, cache HTTP (ETag) trên đĩa
+        self.image_fetch_workers = int(os.getenv("IMAGE_FETCH_WORKERS", "8"))
+        self.image_fetch_timeout = float(os.getenv("IMAGE_FETCH_TIMEOUT", "20"))
+        self.image_http_cache_enabled = _env_bool("IMAGE_HTTP_CACHE_ENABLED", True)
+        self.image_http_cache_folder = os.getenv("IMAGE_HTTP_CACHE_DIR") or os.path.join(self.data_folder, "cache", "http")
+        
+        # Asset store theo sha256 (ảnh md2json, diagram, media pandoc); JSON nhúng ảnh "inline" (base64) hoặc "asset" (hash + URL)
+        self.asset_store_enabled = _env_bool("ASSET_STORE_ENABLED", True)
+        self.asset_store_folder = os.getenv("ASSET_STORE_DIR") or os.path.join(self.data_folder, "assets")
+        self.asset_base_url = os.getenv("ASSET_BASE_URL", "").strip() or None
+        self.json_image_mode = os.getenv("JSON_IMAGE_MODE", "inline").strip().lower()
+        
+        # md2json: chia đề theo phần (và tối đa N ký tự mỗi đoạn), gọi AI song song rồi gộp quizParts
+        self.md2json_section_parallel = _env_bool("MD2JSON_SECTION_PARALLEL", True)
+        self.md2json_max_chunk_chars = int(os.getenv("MD2JSON_MAX_CHUNK_CHARS", "20000"))
+        self.md2json_max_workers = int(os.getenv("MD2JSON_MAX_WORKERS", "4"))
+        # DOCX: mapping + dựng JSON trong một lần gọi AI (lời giải vào explainQuestion), .md mapping suy ra từ JSON
+        self.md2json_fused_mapping = _env_bool("MD2JSON_FUSED_MAPPING", False)
+        # Mapping câu hỏi - lời giải: "rewrite" (AI viết lại toàn văn) hoặc "offsets" (AI trả bảng ghép số dòng, ghép lại ở local)
+        self.mapper_mode = os.getenv("MAPPER_MODE", "rewrite").strip().lower()
+        # Mapping câu hỏi - lời giải: số token ước lượng tối đa mỗi đoạn (0 = không chia) và số đoạn song song
+        self.mapper_chunk_tokens = int(os.getenv("MAPPER_CHUNK_TOKENS", "6000"))
+        self.mapper_max_workers = int(os.getenv("MAPPER_MAX_WORKERS", "4"))
+        # Số tài liệu được mapping đồng thời qua mapper dùng chung
+        self.mapper_service_workers = int(os.getenv("MAPPER_SERVICE_WORKERS", "4"))
+        # Nhận kết quả Vertex AI theo từng đoạn token (OCR 1 file, mapping, md2json) và ghi dần ra thư mục stream
+        self.generation_streaming = _env_bool("GENERATION_STREAMING", False)
+        self.stream_output_folder = os.getenv("STREAM_OUTPUT_DIR") or os.path.join(self.output_folder, "stream")
+        
+        # Cấu hình thực thi OCR: "process" (ProcessPoolExecutor) hoặc "async" (asyncio)
+        self.execution_mode = os.getenv("OCR_EXECUTION_MODE", "process").strip().lower()
+        # Số request OCR đồng thời ở chế độ async (độc lập với số CPU)
+        self.max_concurrency = int(os.getenv("OCR_MAX_CONCURRENCY", "50"))
+        # Poll trạng thái PDF Mathpix: interval thích ứng trong [min, max] giây, số worker download
+        self.mathpix_poll_min_interval = float(os.getenv("MATHPIX_POLL_MIN_INTERVAL", "1"))
+        self.mathpix_poll_max_interval = float(os.getenv("MATHPIX_POLL_MAX_INTERVAL", "15"))
+        self.mathpix_download_workers = int(os.getenv("MATHPIX_DOWNLOAD_WORKERS", "8"))
+        # Chia PDF lớn thành cụm N trang xử lý song song trên Mathpix (0 = gửi nguyên file)
+        self.mathpix_pdf_chunk_pages = int(os.getenv("MATHPIX_PDF_CHUNK_PAGES", "10"))
+        self.mathpix_chunk_retries = int(os.getenv("MATHPIX_CHUNK_RETRIES", "2"))
+        # Nhận kết quả PDF Mathpix theo từng trang ngay khi trang xong (SSE stream / lines.json)
+        self.mathpix_pdf_streaming = _env_bool("MATHPIX_PDF_STREAMING", False)
+        # Gộp nhiều ảnh nhỏ thành một job PDF Mathpix (giảm số request /v3/text)
+        self.mathpix_pack_images = _env_bool("MATHPIX_PACK_IMAGES", False)
+        self.mathpix_pack_size = int(os.getenv("MATHPIX_PACK_SIZE", "20"))
+        self.mathpix_pack_min_images = int(os.getenv("MATHPIX_PACK_MIN_IMAGES", "8"))
+        self.mathpix_pack_max_image_kb = int(os.getenv("MATHPIX_PACK_MAX_IMAGE_KB", "1024"))
+        
+        # Render PDF streaming: số trang mỗi lần render và số trang tối đa chờ OCR
+        self.raster_window_pages = int(os.getenv("RASTER_WINDOW_PAGES", "4"))
+        self.raster_buffer_pages = int(os.getenv("RASTER_BUFFER_PAGES", "8"))
+        # Trang render được encode JPEG một lần trong RAM; trang lớn hơn ngưỡng spill mới ghi ra đĩa
+        self.raster_jpeg_quality = int(os.getenv("RASTER_JPEG_QUALITY", "90"))
+        self.page_shm_spill_mb = float(os.getenv("PAGE_SHM_SPILL_MB", "16"))
+        
+        # Ảnh diagram crop từ line_data: format (png/jpeg/webp), tham số encoder, số thread encode
+        self.diagram_format = os.getenv("DIAGRAM_FORMAT", "png").strip().lower()
+        self.diagram_optimize = _env_bool("DIAGRAM_OPTIMIZE", True)
+        self.diagram_png_compress_level = int(os.getenv("DIAGRAM_PNG_COMPRESS_LEVEL", "6"))
+        self.diagram_jpeg_quality = int(os.getenv("DIAGRAM_JPEG_QUALITY", "90"))
+        self.diagram_encode_workers = int(os.getenv("DIAGRAM_ENCODE_WORKERS", "4"))
+        
+        # Tối ưu payload upload: định dạng/quality/kích thước để ảnh nằm trong ngân sách
+        self.upload_optimize_enabled = _env_bool("UPLOAD_OPTIMIZE_ENABLED", True)
+        self.upload_max_kb = int(os.getenv("UPLOAD_MAX_KB", "1024"))
+        self.upload_max_dimension = int(os.getenv("UPLOAD_MAX_DIMENSION", "2048"))
+        self.upload_max_pixels = int(os.getenv("UPLOAD_MAX_PIXELS", "0")) or None
+        self.upload_format = os.getenv("UPLOAD_FORMAT", "jpeg").strip().lower()
+        self.upload_grayscale = _env_bool("UPLOAD_GRAYSCALE", False)
+        self.upload_min_quality = int(os.getenv("UPLOAD_MIN_QUALITY", "40"))
+        self.upload_max_quality = int(os.getenv("UPLOAD_MAX_QUALITY", "90"))
+        
         # Tạo thư mục nếu chưa có
         self._create_directories()
     
@@ -56,6 +141,7 @@ class AppConfig:
         print(f"📋 Mathpix API: {'✅ OK' if status['mathpix'] else '❌ Chưa cấu hình'}")
         print(f"🤖 Vertex AI: {'✅ OK' if status['vertex_ai'] else '❌ Chưa cấu hình'}")
         print(f"📁 Thư mục: {'✅ OK' if status['directories'] else '❌ Lỗi'}")
+        print(f"⚙️ Chế độ OCR: {self.execution_mode} (async concurrency: {self.max_concurrency})")
         
         return status
 
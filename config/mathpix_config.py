@@ -3,9 +3,14 @@ Cấu hình API cho Mathpix
 """
 import os
 import json
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from sqlalchemy import true
+from .rate_limiter import mathpix_limiter, call_with_retry, response_status
 
 # Load environment variables
 load_dotenv()
@@ -16,9 +21,74 @@ class MathpixConfig:
     def __init__(self):
         self.app_key = os.getenv('MATHPIX_APP_KEY')
         self.app_id = os.getenv('MATHPIX_APP_ID')
-        self.pdf_base_url = "https://api.mathpix.com/v3/pdf"
-        self.text_base_url = "https://api.mathpix.com/v3/text"
+        # Base URL cấu hình được (vd. server giả lập local khi test)
+        self.api_base_url = (os.getenv("MATHPIX_API_URL") or "https://api.mathpix.com").rstrip("/")
+        self.pdf_base_url = f"{self.api_base_url}/v3/pdf"
+        self.text_base_url = f"{self.api_base_url}/v3/text"
         
+        # Connection pool keep-alive (mỗi process một session) + timeout tường minh
+        self.pool_size = int(os.getenv("MATHPIX_POOL_SIZE") or os.getenv("OCR_MAX_CONCURRENCY", "50"))
+        self.connect_timeout = float(os.getenv("MATHPIX_CONNECT_TIMEOUT", "10"))
+        self.read_timeout = float(os.getenv("MATHPIX_READ_TIMEOUT", "120"))
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+    
+    def get_session(self):
+        """
+        Trả về requests.Session dùng chung trong process hiện tại (tạo lại sau fork)
+        - Pool keep-alive kích thước pool_size: các request liên tiếp không phải bắt tay TCP/TLS lại
+        - Không retry ở tầng transport: lỗi kết nối/đọc/status đều do call_with_retry xử lý
+          (tránh nhân số lần thử với backoff của rate limiter)
+        """
+        if self._session is not None and self._session_pid == os.getpid():
+            return self._session
+        
+        with self._session_lock:
+            if self._session is None or self._session_pid != os.getpid():
+                transport_retry = Retry(
+                    total=0,
+                    connect=0,
+                    read=0,
+                    status=0,  # Mọi retry do call_with_retry xử lý (backoff + Retry-After)
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=self.pool_size,
+                    max_retries=transport_retry
+                )
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update(self.get_headers())
+                self._session = session
+                self._session_pid = os.getpid()
+        return self._session
+    
+    def close(self):
+        """Đóng session của process hiện tại"""
+        if self._session is not None and self._session_pid == os.getpid():
+            self._session.close()
+        self._session = None
+        self._session_pid = None
+    
+    def _request(self, method, url, **kwargs):
+        """
+        Gửi request tới Mathpix qua session keep-alive và rate limiter dùng chung (RPM giữa các process),
+        retry 429/5xx/lỗi mạng với backoff jitter và tôn trọng Retry-After
+        Returns:
+            requests.Response của lần thử cuối
+        """
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        session = self.get_session()
+        return call_with_retry(
+            lambda: session.request(method, url, **kwargs),
+            mathpix_limiter,
+            label="Mathpix",
+            is_retryable_result=response_status
+        )
+    
     def get_headers(self):
         """Trả về headers cho Mathpix API"""
         return {
@@ -46,11 +116,49 @@ class MathpixConfig:
         """Trả về URL để download file đã convert"""
         return f"{self.pdf_base_url}/{pdf_id}.{format_type}"
     
+    def get_stream_url(self, pdf_id):
+        """Trả về URL stream kết quả từng trang (Server-Sent Events)"""
+        return f"{self.pdf_base_url}/{pdf_id}/stream"
+    
+    def get_lines_url(self, pdf_id):
+        """Trả về URL lấy kết quả line-level JSON theo trang"""
+        return f"{self.pdf_base_url}/{pdf_id}.lines.json"
+    
+    def build_image_options(self, options=None):
+        """Trả về options cho /v3/text (default + options truyền vào)"""
+        # Default options
+        default_options = {
+            "math_inline_delimiters": ["$", "$"],
+            "rm_spaces": True,
+        }
+        
+        if options:
+            default_options.update(options)
+        return default_options
+    
+    def build_pdf_options(self, options=None):
+        """Trả về options cho /v3/pdf (default + options truyền vào)"""
+        # Default options for PDF processing - chỉ sử dụng format được hỗ trợ
+        default_options = {
+            "conversion_formats": {
+                "md": True,      # Markdown format (text)
+                "docx": True     # Word format (backup)
+            },
+            "math_inline_delimiters": ["$", "$"],
+            "math_display_delimiters": ["$$", "$$"],
+            "rm_spaces": True,
+            "enable_tables_fallback": True
+        }
+        
+        if options:
+            default_options.update(options)
+        return default_options
+    
     def ocr_image(self, image_path, options=None):
         """
         OCR một ảnh bằng Mathpix API
         Args:
-            image_path: đường dẫn đến file ảnh
+            image_path: đường dẫn đến file ảnh hoặc PageImage (bytes đã encode trong RAM)
             options: dict các tùy chọn OCR
         Returns:
             dict response từ API hoặc None nếu lỗi
@@ -58,40 +166,45 @@ class MathpixConfig:
         if not self.is_configured():
             print("❌ Mathpix chưa được cấu hình!")
             return None
-            
-        if not os.path.exists(image_path):
-            print(f"❌ Không tìm thấy file ảnh: {image_path}")
-            return None
         
-        if not self.is_supported_image(image_path):
-            print(f"❌ Format ảnh không được hỗ trợ: {image_path}")
-            print(f"💡 Các format được hỗ trợ: {', '.join(self.get_supported_formats())}")
-            return None
+        # PageImage: bytes trong RAM, không cần file
+        in_memory = hasattr(image_path, "data") and hasattr(image_path, "mime_type")
         
-        # Default options
-        default_options = {
-            "math_inline_delimiters": ["$", "$"],
-            "rm_spaces": True,
-        }
+        if not in_memory:
+            if not os.path.exists(image_path):
+                print(f"❌ Không tìm thấy file ảnh: {image_path}")
+                return None
+            
+            if not self.is_supported_image(image_path):
+                print(f"❌ Format ảnh không được hỗ trợ: {image_path}")
+                print(f"💡 Các format được hỗ trợ: {', '.join(self.get_supported_formats())}")
+                return None
         
-        if options:
-            default_options.update(options)
+        default_options = self.build_image_options(options)
         
         try:
-            print(f"🔄 Đang OCR ảnh: {os.path.basename(image_path)}")
+            # Import lazy: processors phụ thuộc config
+            from processors.page_image import load_page
+            from processors.payload_optimizer import payload_optimizer, rescale_line_data
             
-            with open(image_path, "rb") as f:
-                response = requests.post(
-                    self.text_base_url,
-                    files={"file": f},
-                    data={
-                        "options_json": json.dumps(default_options)
-                    },
-                    headers=self.get_headers()
-                )
+            page = load_page(image_path)
+            print(f"🔄 Đang OCR ảnh: {page.name}")
+            
+            # Encode lại ảnh theo ngân sách upload (định dạng/quality/kích thước)
+            upload_page, scale = payload_optimizer.optimize(page)
+            
+            response = self._request(
+                "POST",
+                self.text_base_url,
+                files={"file": (upload_page.name, upload_page.data, upload_page.mime_type)},
+                data={
+                    "options_json": json.dumps(default_options)
+                }
+            )
             
             if response.status_code == 200:
-                result = response.json()
+                # Tọa độ line_data quy đổi về ảnh gốc (để crop diagram đúng vị trí)
+                result = rescale_line_data(response.json(), scale)
                 print(f"✅ OCR thành công! Confidence: {result.get('confidence', 'N/A')}")
                 return result
             else:
@@ -116,27 +229,51 @@ class MathpixConfig:
         """
         return self.ocr_image(image_path, kwargs)
     
-    def batch_ocr_images(self, image_paths, options=None):
+    def batch_ocr_images(self, image_paths, options=None, max_workers=None, callback=None):
         """
-        OCR nhiều ảnh cùng lúc
+        OCR nhiều ảnh cùng lúc (thread pool giới hạn, dùng chung session và rate limiter)
         Args:
             image_paths: list đường dẫn ảnh
             options: dict tùy chọn OCR
+            max_workers: số request đồng thời (mặc định = pool_size của session)
+            callback: hàm(index, item) gọi ngay khi từng ảnh xong (theo thứ tự hoàn thành)
         Returns:
-            list kết quả OCR cho từng ảnh
+            list kết quả OCR cho từng ảnh (theo thứ tự input)
         """
-        results = []
+        from concurrent.futures import ThreadPoolExecutor, as_completed
         
-        print(f"🔄 Bắt đầu batch OCR {len(image_paths)} ảnh...")
+        results = [None] * len(image_paths)
+        if not image_paths:
+            return results
         
-        for i, image_path in enumerate(image_paths, 1):
-            print(f"\n📄 [{i}/{len(image_paths)}] {os.path.basename(image_path)}")
-            result = self.ocr_image(image_path, options)
-            results.append({
-                'image_path': image_path,
-                'result': result,
-                'success': result is not None
-            })
+        max_workers = max(1, min(max_workers or self.pool_size, len(image_paths)))
+        print(f"🔄 Bắt đầu batch OCR {len(image_paths)} ảnh ({max_workers} luồng)...")
+        
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mathpix-ocr") as executor:
+            future_to_index = {
+                executor.submit(self.ocr_image, image_path, options): i
+                for i, image_path in enumerate(image_paths)
+            }
+            
+            completed_count = 0
+            for future in as_completed(future_to_index):
+                i = future_to_index[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"❌ Lỗi OCR ảnh {image_paths[i]}: {str(e)}")
+                    result = None
+                
+                results[i] = {
+                    'image_path': image_paths[i],
+                    'result': result,
+                    'success': result is not None
+                }
+                completed_count += 1
+                print(f"📄 [{completed_count}/{len(image_paths)}] {os.path.basename(str(image_paths[i]))}")
+                
+                if callback:
+                    callback(i, results[i])
         
         success_count = sum(1 for r in results if r['success'])
         print(f"\n✅ Batch OCR hoàn thành: {success_count}/{len(image_paths)} thành công")
@@ -193,33 +330,23 @@ class MathpixConfig:
             print(f"💡 Các format được hỗ trợ: {', '.join(self.get_supported_pdf_formats())}")
             return None
         
-        # Default options for PDF processing - chỉ sử dụng format được hỗ trợ
-        default_options = {
-            "conversion_formats": {
-                "md": True,      # Markdown format (text)
-                "docx": True     # Word format (backup)
-            },
-            "math_inline_delimiters": ["$", "$"],
-            "math_display_delimiters": ["$$", "$$"],
-            "rm_spaces": True,
-            "enable_tables_fallback": True
-        }
-        
-        if options:
-            default_options.update(options)
+        default_options = self.build_pdf_options(options)
         
         try:
             print(f"🔄 Đang upload document: {os.path.basename(document_path)}")
             
+            # Đọc bytes trước để có thể gửi lại khi retry
             with open(document_path, "rb") as f:
-                response = requests.post(
-                    self.pdf_base_url,
-                    files={"file": f},
-                    data={
-                        "options_json": json.dumps(default_options)
-                    },
-                    headers=self.get_headers()
-                )
+                file_data = f.read()
+            
+            response = self._request(
+                "POST",
+                self.pdf_base_url,
+                files={"file": (os.path.basename(document_path), file_data)},
+                data={
+                    "options_json": json.dumps(default_options)
+                }
+            )
             
             if response.status_code == 200:
                 result = response.json()
@@ -265,10 +392,7 @@ class MathpixConfig:
             return None
         
         try:
-            response = requests.get(
-                self.get_status_url(pdf_id),
-                headers=self.get_headers()
-            )
+            response = self._request("GET", self.get_status_url(pdf_id))
             
             if response.status_code == 200:
                 return response.json()
@@ -293,10 +417,7 @@ class MathpixConfig:
             return None
         
         try:
-            response = requests.get(
-                self.get_download_url(pdf_id, format_type),
-                headers=self.get_headers()
-            )
+            response = self._request("GET", self.get_download_url(pdf_id, format_type))
             
             if response.status_code == 200:
                 # Xử lý theo format type
@@ -382,5 +503,155 @@ class MathpixConfig:
         print("❌ Không thể download kết quả text từ bất kỳ format nào!")
         return None
 
+    def iter_pdf_pages(self, document_path, options=None, timeout=300):
+        """
+        Xử lý PDF qua Mathpix và trả kết quả từng trang ngay khi trang đó xong
+        (upload với streaming=True rồi đọc SSE /v3/pdf/{pdf_id}/stream).
+        Nếu endpoint stream không dùng được thì chờ xử lý xong và lấy .lines.json
+        Args:
+            document_path: đường dẫn file PDF
+            options: dict các tùy chọn xử lý
+            timeout: thời gian chờ tối đa (giây)
+        Yields:
+            tuple (page_no, text, line_data, page_size) theo thứ tự trang xong, page_no bắt đầu từ 1;
+            line_data là list dòng của trang (None nếu stream không trả về),
+            page_size = (page_width, page_height) - hệ tọa độ của line_data (None nếu không rõ)
+        """
+        upload_result = self.upload_pdf(document_path, dict(options or {}, streaming=True))
+        if not upload_result or not upload_result.get('pdf_id'):
+            return
+        pdf_id = upload_result['pdf_id']
+        
+        seen_pages = set()
+        try:
+            for page_no, text, line_data, page_size in self._iter_stream_pages(pdf_id, timeout):
+                seen_pages.add(page_no)
+                yield page_no, text, line_data, page_size
+        except Exception as e:
+            print(f"⚠️ Không stream được kết quả Mathpix ({str(e)}), chuyển sang lines.json")
+        
+        if seen_pages:
+            # Stream có thể dừng sớm (timeout, [DONE] khi chưa đủ trang) -> so với số trang của job
+            total_pages = (self.check_pdf_status(pdf_id) or {}).get('num_pages')
+            if total_pages and len(seen_pages) >= total_pages:
+                return
+            print(f"⚠️ Stream mới trả {len(seen_pages)}/{total_pages or '?'} trang, lấy phần còn lại từ lines.json")
+        
+        # Fallback: chờ hoàn thành rồi lấy các trang chưa nhận từ lines.json
+        if not self.wait_for_pdf(pdf_id, timeout=timeout):
+            return
+        for page_no, text, line_data, page_size in self.download_pdf_lines(pdf_id, with_page_size=True):
+            if page_no not in seen_pages:
+                yield page_no, text, line_data, page_size
+    
+    def _iter_stream_pages(self, pdf_id, timeout):
+        """Đọc SSE stream của Mathpix, yield (page_no, text, line_data, page_size) cho từng event trang"""
+        deadline = time.time() + timeout
+        mathpix_limiter.acquire()
+        response = self.get_session().get(
+            self.get_stream_url(pdf_id),
+            stream=True,
+            timeout=(self.connect_timeout, self.read_timeout)
+        )
+        try:
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            
+            data_lines = []
+            for raw_line in response.iter_lines(decode_unicode=True):
+                if time.time() > deadline:
+                    print(f"⏰ Timeout stream sau {timeout}s!")
+                    return
+                if raw_line is None:
+                    continue
+                if raw_line.startswith("data:"):
+                    data_lines.append(raw_line[5:].strip())
+                    continue
+                if raw_line.strip() or not data_lines:
+                    continue
+                
+                # Dòng trống -> kết thúc một event
+                event = self._parse_stream_event(data_lines)
+                data_lines = []
+                if event is None:
+                    return
+                if event:
+                    yield event
+            
+            # Event cuối không có dòng trống kết thúc
+            event = self._parse_stream_event(data_lines) if data_lines else None
+            if event:
+                yield event
+        finally:
+            response.close()
+    
+    @staticmethod
+    def _parse_stream_event(data_lines):
+        """
+        Parse một event SSE
+        Returns:
+            tuple (page_no, text, line_data, page_size); () nếu event không phải trang; None nếu [DONE]
+        """
+        payload = "\n".join(data_lines)
+        if payload == "[DONE]":
+            return None
+        event = json.loads(payload)
+        if event.get("page_idx") is not None:
+            page_no = int(event["page_idx"]) + 1  # page_idx đánh số từ 0
+        elif event.get("page") is not None:
+            page_no = int(event["page"])
+        else:
+            return ()
+        text = event.get("text") or event.get("mmd") or ""
+        page_size = None
+        if event.get("page_width") and event.get("page_height"):
+            page_size = (event["page_width"], event["page_height"])
+        return page_no, text, event.get("line_data") or event.get("lines"), page_size
+    
+    def wait_for_pdf(self, pdf_id, timeout=120, check_interval=2):
+        """Chờ PDF xử lý xong, trả về True nếu completed"""
+        elapsed_time = 0
+        while elapsed_time < timeout:
+            status_result = self.check_pdf_status(pdf_id)
+            status = (status_result or {}).get('status', 'unknown')
+            if status == 'completed':
+                return True
+            if status == 'error':
+                print("❌ Xử lý thất bại!")
+                return False
+            time.sleep(check_interval)
+            elapsed_time += check_interval
+        print(f"⏰ Timeout sau {timeout}s!")
+        return False
+    
+    def download_pdf_lines(self, pdf_id, with_page_size=False):
+        """
+        Download kết quả line-level (.lines.json) của PDF đã xử lý xong
+        Args:
+            with_page_size: trả thêm (page_width, page_height) của từng trang (tọa độ của line_data)
+        Returns:
+            list tuple (page_no, text, line_data[, page_size]) theo thứ tự trang
+        """
+        try:
+            response = self._request("GET", self.get_lines_url(pdf_id))
+            if response.status_code != 200:
+                print(f"❌ Lỗi download lines.json: {response.status_code} - {response.text}")
+                return []
+            result = response.json()
+        except Exception as e:
+            print(f"❌ Lỗi khi download lines.json: {str(e)}")
+            return []
+        
+        pages = []
+        for page in result.get("pages", []):
+            lines = page.get("lines") or []
+            text = "\n".join(line.get("text", "") for line in lines if line.get("text"))
+            entry = (int(page.get("page", len(pages) + 1)), text, lines)
+            if with_page_size:
+                entry += ((page.get("page_width"), page.get("page_height")),)
+            pages.append(entry)
+        pages.sort(key=lambda x: x[0])
+        return pages
+
 # Tạo instance global để sử dụng trong toàn bộ ứng dụng
 mathpix_config = MathpixConfig()
@@ -0,0 +1,318 @@
+"""
+Rate limiter dùng chung giữa thread, process và asyncio cho Vertex AI / Mathpix
+
+- Token bucket theo engine: requests/phút (RPM) và tokens/phút (TPM), trạng thái nằm trong
+  shared memory (multiprocessing.Array) nên N worker process cùng nhìn thấy một quota
+- Retry với decorrelated-jitter backoff, tôn trọng Retry-After và ngữ nghĩa 429/503:
+  khi một request bị 429, cả engine tạm dừng để tránh retry storm đồng loạt
+"""
+import os
+import time
+import random
+import asyncio
+import multiprocessing as mp
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Status HTTP nên retry (quota / lỗi tạm thời phía server)
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# Status chắc chắn không thành công khi gửi lại
+FATAL_STATUS = {400, 401, 403, 404, 413}
+
+# Ước lượng token cho một ảnh gửi lên Gemini (ảnh lớn được chia tile 258 token)
+IMAGE_TOKEN_ESTIMATE = 1032
+
+# Vị trí trong shared array
+_REQ_TOKENS, _TPM_TOKENS, _LAST_REFILL, _BLOCKED_UNTIL = range(4)
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def estimate_tokens(text="", images=0):
+    """Ước lượng số token input (~4 ký tự/token + token ảnh)"""
+    return len(text or "") // 4 + images * IMAGE_TOKEN_ESTIMATE
+
+
+def parse_retry_after(headers):
+    """
+    Đọc header Retry-After (số giây hoặc HTTP-date)
+    Returns:
+        số giây cần chờ hoặc None
+    """
+    if not headers:
+        return None
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def classify_error(error):
+    """
+    Phân loại exception từ API client
+    Returns:
+        tuple (retryable, status, retry_after)
+    """
+    status = getattr(error, "code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if not isinstance(status, int):
+        status = None
+
+    retry_after = None
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = parse_retry_after(getattr(response, "headers", None))
+        if status is None:
+            status = getattr(response, "status_code", None)
+
+    if status is None:
+        # google.api_core không phải lúc nào cũng có code -> nhận diện qua message
+        message = str(error)
+        if "429" in message or "Resource exhausted" in message or "RESOURCE_EXHAUSTED" in message:
+            status = 429
+        elif "503" in message or "UNAVAILABLE" in message:
+            status = 503
+
+    if status in FATAL_STATUS:
+        return False, status, retry_after
+    # Lỗi mạng / không rõ status -> retry như trước đây
+    return True, status, retry_after
+
+
+class Backoff:
+    """Decorrelated-jitter backoff: delay = min(cap, random(base, prev * 3))"""
+
+    def __init__(self, base=None, cap=None):
+        self.base = base if base is not None else _env_float("RETRY_BASE_DELAY", 1.0)
+        self.cap = cap if cap is not None else _env_float("RETRY_MAX_DELAY", 60.0)
+        self._prev = self.base
+
+    def next_delay(self, retry_after=None):
+        """Delay cho lần thử tiếp theo; Retry-After của server được ưu tiên (cộng jitter nhỏ)"""
+        self._prev = min(self.cap, random.uniform(self.base, self._prev * 3))
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base)
+        return self._prev
+
+
+class RateLimiter:
+    """Token bucket RPM/TPM cho một engine, dùng chung giữa các process"""
+
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, burst_seconds=10, enabled=True):
+        """
+        Args:
+            name: tên engine ("vertex_ai", "mathpix")
+            requests_per_minute: giới hạn request/phút (0 = không giới hạn)
+            tokens_per_minute: giới hạn token/phút (0 = không giới hạn)
+            burst_seconds: dung lượng bucket tính theo số giây quota (cho phép burst ngắn)
+            enabled: tắt hoàn toàn limiter nếu False
+        """
+        self.name = name
+        self.enabled = enabled
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.request_capacity = max(1.0, self.rpm * burst_seconds / 60.0)
+        self.token_capacity = max(1.0, self.tpm * burst_seconds / 60.0)
+
+        # [request tokens, tpm tokens, last refill, blocked until]
+        # Tạo lazy: tạo lúc import sẽ cố định start method của multiprocessing quá sớm
+        self._state = None
+
+    def _get_state(self):
+        if self._state is None:
+            self._state = mp.Array("d", [self.request_capacity, self.token_capacity, time.time(), 0.0])
+        return self._state
+
+    # ------------------------------------------------------------------
+    # Shared state (truyền cho worker process qua initializer)
+    # ------------------------------------------------------------------
+    def shared_state(self):
+        return self._get_state()
+
+    def attach(self, state):
+        """Dùng shared state của process cha (worker tạo bằng spawn)"""
+        if state is not None:
+            self._state = state
+
+    # ------------------------------------------------------------------
+    # Token bucket
+    # ------------------------------------------------------------------
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state[_LAST_REFILL])
+        state[_LAST_REFILL] = now
+        if self.rpm:
+            state[_REQ_TOKENS] = min(self.request_capacity, state[_REQ_TOKENS] + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            state[_TPM_TOKENS] = min(self.token_capacity, state[_TPM_TOKENS] + elapsed * self.tpm / 60.0)
+
+    def _reserve(self, tokens):
+        """Trừ quota nếu đủ, trả về 0; nếu chưa đủ trả về số giây cần chờ"""
+        state = self._get_state()
+        with state.get_lock():
+            now = time.time()
+            if state[_BLOCKED_UNTIL] > now:
+                return state[_BLOCKED_UNTIL] - now
+
+            self._refill(state, now)
+            waits = []
+            if self.rpm and state[_REQ_TOKENS] < 1:
+                waits.append((1 - state[_REQ_TOKENS]) * 60.0 / self.rpm)
+            if self.tpm and tokens:
+                # Request lớn hơn dung lượng bucket: chờ bucket đầy rồi cho phép âm
+                need = min(tokens, self.token_capacity)
+                if state[_TPM_TOKENS] < need:
+                    waits.append((need - state[_TPM_TOKENS]) * 60.0 / self.tpm)
+            if waits:
+                return max(waits)
+
+            if self.rpm:
+                state[_REQ_TOKENS] -= 1
+            if self.tpm and tokens:
+                state[_TPM_TOKENS] -= tokens
+            return 0.0
+
+    def acquire(self, tokens=0):
+        """Chờ (blocking) tới khi có quota cho một request ước lượng `tokens` token"""
+        if not self.enabled:
+            return
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            # Jitter nhỏ để các process không thức dậy cùng lúc
+            time.sleep(wait * random.uniform(1.0, 1.1))
+
+    async def acquire_async(self, tokens=0):
+        """Như acquire() nhưng không block event loop"""
+        if not self.enabled:
+            return
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait * random.uniform(1.0, 1.1))
+
+    def charge(self, tokens):
+        """Trừ thêm token thực tế (vd. output tokens) sau khi request xong, không chờ"""
+        if not self.enabled or not self.tpm or not tokens:
+            return
+        state = self._get_state()
+        with state.get_lock():
+            self._refill(state, time.time())
+            state[_TPM_TOKENS] -= tokens
+
+    def pause(self, seconds):
+        """Tạm dừng engine trên tất cả process (khi server trả 429 / Retry-After)"""
+        if not self.enabled or not seconds:
+            return
+        state = self._get_state()
+        with state.get_lock():
+            state[_BLOCKED_UNTIL] = max(state[_BLOCKED_UNTIL], time.time() + seconds)
+
+    def retry_delay(self, backoff, status=None, retry_after=None):
+        """
+        Tính delay retry; 429 hoặc có Retry-After thì pause cả engine cho mọi process
+        Returns:
+            số giây cần chờ trước lần thử tiếp theo
+        """
+        delay = backoff.next_delay(retry_after)
+        if status == 429 or retry_after is not None:
+            self.pause(delay)
+        return delay
+
+
+def call_with_retry(func, limiter, tokens=0, max_attempts=None, label=None, is_retryable_result=None):
+    """
+    Gọi func() với rate limit + retry backoff (sync)
+    Args:
+        func: hàm không tham số gọi API
+        limiter: RateLimiter của engine
+        tokens: số token ước lượng của request
+        max_attempts: số lần thử tối đa (mặc định RETRY_MAX_ATTEMPTS)
+        label: tên hiển thị trong log
+        is_retryable_result: hàm(result) -> (retryable, status, retry_after) cho response lỗi
+                             không raise exception (vd. requests.Response 429)
+    Returns:
+        kết quả của lần gọi cuối cùng (exception của lần cuối được raise lại)
+    """
+    max_attempts = max_attempts or max_retry_attempts()
+    backoff = Backoff()
+    label = label or limiter.name
+
+    for attempt in range(max_attempts):
+        limiter.acquire(tokens)
+        try:
+            result = func()
+        except Exception as e:
+            retryable, status, retry_after = classify_error(e)
+            if not retryable or attempt == max_attempts - 1:
+                raise
+            delay = limiter.retry_delay(backoff, status, retry_after)
+            print(f"⚠️ [{label}] Lần thử {attempt + 1}: {str(e)} - thử lại sau {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        if is_retryable_result is not None and attempt < max_attempts - 1:
+            retryable, status, retry_after = is_retryable_result(result)
+            if retryable:
+                delay = limiter.retry_delay(backoff, status, retry_after)
+                print(f"⚠️ [{label}] Lần thử {attempt + 1}: HTTP {status} - thử lại sau {delay:.1f}s")
+                time.sleep(delay)
+                continue
+        return result
+
+
+def response_status(response):
+    """is_retryable_result cho requests.Response / aiohttp response"""
+    status = getattr(response, "status_code", None) or getattr(response, "status", None)
+    if status in RETRYABLE_STATUS:
+        return True, status, parse_retry_after(getattr(response, "headers", None))
+    return False, status, None
+
+
+def max_retry_attempts():
+    return int(_env_float("RETRY_MAX_ATTEMPTS", 5))
+
+
+_rate_limit_enabled = os.getenv("RATE_LIMIT_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+# Limiter global cho từng engine
+vertex_limiter = RateLimiter(
+    "vertex_ai",
+    requests_per_minute=_env_float("VERTEX_RPM", 300),
+    tokens_per_minute=_env_float("VERTEX_TPM", 0),
+    enabled=_rate_limit_enabled
+)
+mathpix_limiter = RateLimiter(
+    "mathpix",
+    requests_per_minute=_env_float("MATHPIX_RPM", 200),
+    enabled=_rate_limit_enabled
+)
+
+_LIMITERS = {limiter.name: limiter for limiter in (vertex_limiter, mathpix_limiter)}
+
+
+def get_shared_state():
+    """Shared state của tất cả limiter (truyền vào initargs của ProcessPoolExecutor)"""
+    return {name: limiter.shared_state() for name, limiter in _LIMITERS.items()}
+
+
+def attach_shared_state(state):
+    """Gắn worker process vào shared state của process cha"""
+    for name, shared in (state or {}).items():
+        if name in _LIMITERS:
+            _LIMITERS[name].attach(shared)
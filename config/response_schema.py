@@ -180,4 +180,46 @@ AI_ANSWER_GEN = {
         "totalOption",
         "options"
     ]
-}
\ No newline at end of file
+}
+
+# Bảng ghép câu hỏi - lời giải theo số dòng (mapping chế độ offsets)
+QA_PAIRING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "items": {
+            "type": "array",
+            "description": "Các phần và câu hỏi theo thứ tự xuất hiện trong đề.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "kind": {
+                        "type": "string",
+                        "enum": ["section", "question"]
+                    },
+                    "number": {
+                        "type": "string",
+                        "description": "Số câu hỏi (chỉ với kind = question)."
+                    },
+                    "start": {
+                        "type": "integer",
+                        "description": "Số dòng đầu tiên."
+                    },
+                    "end": {
+                        "type": "integer",
+                        "description": "Số dòng cuối cùng."
+                    },
+                    "solutions": {
+                        "type": "array",
+                        "description": "Các khoảng [dòng đầu, dòng cuối] của lời giải.",
+                        "items": {
+                            "type": "array",
+                            "items": {"type": "integer"}
+                        }
+                    }
+                },
+                "required": ["kind", "start", "end"]
+            }
+        }
+    },
+    "required": ["items"]
+}
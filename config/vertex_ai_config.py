@@ -2,8 +2,11 @@
 Cấu hình API cho Google Vertex AI
 """
 import os
+import json
+import threading
 from google.oauth2 import service_account
 import vertexai
+from vertexai.generative_models import GenerativeModel
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -18,6 +21,11 @@ class VertexAIConfig:
         self.model_name = "gemini-2.5-pro"  # Model mặc định
         self.credentials = None
         
+        # vertexai.init() và model chỉ khởi tạo một lần cho mỗi process
+        self._initialized_pid = None
+        self._models = {}
+        self._models_lock = threading.Lock()
+        
         # Thiết lập credentials
         self._setup_credentials()
     
@@ -47,8 +55,11 @@ class VertexAIConfig:
             print(f"Lỗi khi tạo credentials từ service account: {e}")
             self.credentials = None
     
-    def initialize_vertex_ai(self):
-        """Khởi tạo Vertex AI với credentials"""
+    def initialize_vertex_ai(self, force=False):
+        """Khởi tạo Vertex AI với credentials (bỏ qua nếu process đã khởi tạo)"""
+        if not force and self._initialized_pid == os.getpid():
+            return True
+        
         try:
             if not self.is_configured():
                 raise ValueError("Vertex AI chưa được cấu hình đúng")
@@ -58,12 +69,59 @@ class VertexAIConfig:
                 location=self.region, 
                 credentials=self.credentials
             )
+            
+            # Model tạo trước khi init lại (hoặc kế thừa khi fork) không dùng tiếp
+            with self._models_lock:
+                self._models = {}
+            self._initialized_pid = os.getpid()
             return True
             
         except Exception as e:
             print(f"Lỗi khi khởi tạo Vertex AI: {e}")
             return False
     
+    @staticmethod
+    def _config_key(generation_config):
+        """Chuẩn hóa generation config thành chuỗi để làm khóa cache model"""
+        if generation_config is None:
+            return None
+        if hasattr(generation_config, "to_dict"):
+            generation_config = generation_config.to_dict()
+        return json.dumps(generation_config, sort_keys=True, ensure_ascii=False, default=str)
+    
+    def get_model(self, model_name=None, generation_config=None, cache_key=None, model_cls=None, **model_kwargs):
+        """
+        Trả về GenerativeModel đã được cache trong process hiện tại
+        Args:
+            model_name: tên model (mặc định self.model_name)
+            generation_config: GenerationConfig/dict gắn vào model (nếu có)
+            cache_key: khóa bổ sung khi model có tham số khác (tools, system_instruction...)
+            model_cls: class model (mặc định vertexai.generative_models.GenerativeModel)
+            **model_kwargs: tham số khác truyền cho constructor của model
+        Returns:
+            GenerativeModel hoặc None nếu không khởi tạo được Vertex AI
+        """
+        if not self.initialize_vertex_ai():
+            return None
+        
+        model_name = model_name or self.model_name
+        model_cls = model_cls or GenerativeModel
+        key = (
+            f"{model_cls.__module__}.{model_cls.__name__}",
+            model_name,
+            self._config_key(generation_config),
+            cache_key
+        )
+        
+        with self._models_lock:
+            model = self._models.get(key)
+            if model is None:
+                if generation_config is not None:
+                    model_kwargs["generation_config"] = generation_config
+                model = model_cls(model_name, **model_kwargs)
+                self._models[key] = model
+            return model
+    
     def is_configured(self):
         """Kiểm tra xem API đã được cấu hình chưa"""
         return bool(self.project_id and self.credentials)
@@ -91,3 +149,16 @@ class VertexAIConfig:
 
 # Tạo instance global để sử dụng trong toàn bộ ứng dụng
 vertex_ai_config = VertexAIConfig()
+
+def init_worker(limiter_state=None):
+    """
+    Initializer cho worker của ProcessPoolExecutor:
+    gắn rate limiter dùng chung và khởi tạo Vertex AI + model OCR mặc định một lần cho mỗi process
+    Args:
+        limiter_state: rate_limiter.get_shared_state() của process cha
+    """
+    from .rate_limiter import attach_shared_state
+    attach_shared_state(limiter_state)
+    
+    if vertex_ai_config.is_configured():
+        vertex_ai_config.get_model()
@@ -41,6 +41,24 @@ Lời giải
 Nội dung cần xử lý:  
 {content}"""
 
+# Prompt cho Question-Answer Mapping dạng bảng ghép (chỉ trả về số dòng, tài liệu được ghép lại ở local)
+QUESTION_ANSWER_PAIRING = """Bạn là trợ lý biên tập tài liệu.
+Nội dung bên dưới đã được đánh số từng dòng dạng [số dòng] nội dung.
+Nhiệm vụ: xác định các phần của đề, từng câu hỏi và lời giải chi tiết tương ứng của mỗi câu hỏi, CHỈ trả về số dòng.
+
+Với mỗi mục theo đúng thứ tự xuất hiện trong đề, trả về một phần tử trong "items":
+- Tiêu đề phần (Phần I, Part II...): kind = "section", start/end = dòng đầu/cuối của tiêu đề phần.
+- Câu hỏi: kind = "question", number = số câu, start/end = dòng đầu/cuối của câu hỏi (gồm cả các đáp án A, B, C, D...),
+  solutions = danh sách [dòng đầu, dòng cuối] của lời giải tương ứng (có thể nằm ngay dưới câu hỏi hoặc ở phần lời giải/đáp án cuối đề).
+
+Quy tắc bắt buộc:
+1. Không chép lại nội dung, chỉ trả về số dòng.
+2. Lời giải phải là của đúng câu hỏi đó; câu hỏi không có lời giải thì solutions = [].
+3. Xử lý tất cả câu hỏi có trong tài liệu, theo đúng thứ tự xuất hiện.
+
+Nội dung cần xử lý:
+{numbered_content}"""
+
 MD2JSON = """
 Bạn là một công cụ chuyển đổi Markdown sang JSON. Tôi sẽ cung cấp cho bạn một đoạn văn bản chứa nhiều dạng câu hỏi (gồm Trắc nghiệm, Đúng/Sai, Trắc nghiệm ngắn - Điền, Tự luận), có thể kèm theo hình ảnh.
 Các hình ảnh đã được tôi gửi kèm theo yêu cầu này. Trong văn bản, chúng được đại diện bởi các placeholder như [IMAGE_0], [IMAGE_1], v.v.
@@ -58,4 +76,27 @@ Bây giờ, hãy chuyển đổi đoạn văn bản sau:
 ```
 {modified_markdown_content}
 ```
-"""
\ No newline at end of file
+"""
+
+# Prompt gộp mapping + md2json: markdown thô (câu hỏi và lời giải có thể tách rời) -> JSON trong một lần gọi
+MD2JSON_FUSED = """
+Bạn là một công cụ chuyển đổi Markdown sang JSON. Tôi sẽ cung cấp cho bạn một đoạn văn bản chứa nhiều dạng câu hỏi (gồm Trắc nghiệm, Đúng/Sai, Trắc nghiệm ngắn - Điền, Tự luận), có thể kèm theo hình ảnh.
+Các hình ảnh đã được tôi gửi kèm theo yêu cầu này. Trong văn bản, chúng được đại diện bởi các placeholder như [IMAGE_0], [IMAGE_1], v.v.
+Lời giải/đáp án có thể nằm ngay dưới mỗi câu hỏi hoặc tách riêng ở phần "Lời giải"/"Đáp án"/"Hướng dẫn giải" cuối đề.
+
+Nhiệm vụ của bạn là phân tích và chuyển đổi mỗi câu hỏi thành một đối tượng JSON, đồng thời ghép mỗi câu hỏi với lời giải tương ứng.
+
+Hãy đảm bảo các chú ý sau:
+- Trích xuất chính xác "Câu X:" và nội dung của câu hỏi.
+- Tìm lời giải chi tiết của từng câu hỏi (kể cả khi nằm ở phần lời giải cuối đề) và đưa NGUYÊN VĂN vào trường "explainQuestion"; đáp án đúng đưa vào "optionAnswer". Tuyệt đối không tự bịa lời giải; câu hỏi không có lời giải thì để trống.
+- Phần lời giải/đáp án cuối đề không phải là câu hỏi: không tạo câu hỏi hay phần mới từ nội dung đó.
+- Nội dung sẽ có cả những câu hỏi được xây dựng dựa trên nội dung của một học liệu (là một đoạn nội dung và một số câu hỏi bên dưới có liên quan tới nội dung đó) nên cần phải kiểm soát kĩ và trả về đúng định dạng Json theo yêu cầu.
+- Khi bạn thấy một placeholder như [IMAGE_0], HÃY GIỮ NGUYÊN placeholder đó trong trường "question_content" của JSON. Đừng cố gắng mô tả hình ảnh.
+- Bao gồm cả các câu hỏi không có lời giải, đáp án, hoặc lựa chọn.
+
+
+Bây giờ, hãy chuyển đổi đoạn văn bản sau:
+```
+{modified_markdown_content}
+```
+"""
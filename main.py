@@ -1,53 +1,112 @@
 ﻿import os
+import re
 import time
+import shutil
+import tempfile
 import traceback
+import asyncio
 import multiprocessing as mp
 import subprocess
 from config import app_config
+from config.vertex_ai_config import init_worker
+from config.rate_limiter import (vertex_limiter, Backoff, classify_error, estimate_tokens,
+                                 max_retry_attempts, get_shared_state)
 from datetime import datetime
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from processors import QuestionAnswerMapper
+from vertexai.generative_models import Part, GenerationConfig
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from processors.mapper_service import get_mapper_service
 from processors.image_processor import save_diagrams_from_line_data, insert_diagrams_into_text
 from processors.md2json import process_markdown_with_vertex_ai
+from processors.ocr_cache import ocr_cache, digest_bytes, digest_file
+from processors.async_ocr import AsyncOCREngine, ASYNC_HTTP_SUPPORT, run_async
+from processors.page_scheduler import PageScheduler
+from processors.pdf_rasterizer import PDF_SUPPORT, get_pdf_page_count, iter_pdf_page_images, render_pdf_page
+from processors.page_image import load_page, page_name
+from processors.payload_optimizer import payload_optimizer
+from processors.asset_store import asset_store
+from processors.image_packer import should_pack, ocr_images_packed
 from processors.docx_to_markdown import run_pandoc, which_pandoc, target_paths
+from processors.stream_output import StreamSink, stream_path, generate_streaming
 from data.prompt.prompts import VERTEX_AI_OCR
 
-try:
-    from pdf2image import convert_from_path
-    import tempfile
-    PDF_SUPPORT = True
-except ImportError:
-    PDF_SUPPORT = False
+if not PDF_SUPPORT:
     print("⚠️ PDF support cho Mode 1 không khả dụng. Cài đặt: pip install pdf2image")
     print("⚠️ Và cài đặt poppler-utils (Windows: choco install poppler)")
 
-try:
-    # Kiểm tra pandoc có sẵn không
-    pandoc_exe = which_pandoc(None)
-    if pandoc_exe:
-        DOCX_SUPPORT = True
-        print(f"✅ DOCX support: Pandoc found at {pandoc_exe}")
-    else:
-        DOCX_SUPPORT = False
+_DOCX_SUPPORT = None
+
+def check_docx_support():
+    """
+    Kiểm tra pandoc (chỉ probe một lần, lazy - worker process không phải chạy lại khi import main.py)
+    Returns:
+        bool: True nếu có thể xử lý DOCX
+    """
+    global _DOCX_SUPPORT
+    if _DOCX_SUPPORT is not None:
+        return _DOCX_SUPPORT
+    
+    try:
+        # Kiểm tra pandoc có sẵn không
+        pandoc_exe = which_pandoc(None)
+        if pandoc_exe:
+            _DOCX_SUPPORT = True
+            print(f"✅ DOCX support: Pandoc found at {pandoc_exe}")
+        else:
+            _DOCX_SUPPORT = False
+            print("⚠️ DOCX support không khả dụng. Cài đặt pandoc: https://pandoc.org/installing.html")
+    except (ImportError, FileNotFoundError):
+        _DOCX_SUPPORT = False
         print("⚠️ DOCX support không khả dụng. Cài đặt pandoc: https://pandoc.org/installing.html")
-except (ImportError, FileNotFoundError):
-    DOCX_SUPPORT = False
-    print("⚠️ DOCX support không khả dụng. Cài đặt pandoc: https://pandoc.org/installing.html")
+    
+    return _DOCX_SUPPORT
+
+# Generation config cho Vertex AI OCR (dùng chung cho chế độ process/async và khóa cache)
+VERTEX_OCR_GENERATION_PARAMS = {
+    "temperature": 0.1,
+    "top_p": 0.8,
+    "max_output_tokens": 15000
+}
+
+# Tùy chọn OCR ảnh cho Mathpix /v3/text
+MATHPIX_IMAGE_OPTIONS = {
+    "formats": ["mmd"],
+    "math_inline_delimiters": ["$", "$"],
+    "math_display_delimiters": ["$$", "$$"],
+    "include_annotated_image": True,
+    "include_image_links": True,
+    "include_line_data": True,
+    "include_diagram": True,
+    "include_diagram_text": True,
+    "rm_spaces": True,
+    "rm_fonts": False,
+    "numbers_default_to_math": True
+}
 
-def convert_md_to_json_final(md_file_path: str) -> str:
+# Tùy chọn /v3/pdf cho job PDF gộp nhiều ảnh: kết quả chỉ đọc từ lines.json nên không cần
+# convert md/docx (kết quả khác /v3/text -> khóa cache riêng "mathpix-packed")
+MATHPIX_PACKED_PDF_OPTIONS = {
+    "conversion_formats": {},
+    "math_inline_delimiters": ["$", "$"],
+    "math_display_delimiters": ["$$", "$$"],
+    "rm_spaces": True,
+    "rm_fonts": False,
+    "numbers_default_to_math": True
+}
+
+def convert_md_to_json_final(md_file_path: str, fused: bool = False) -> str:
     """
     Wrapper function để chuyển đổi MD thành JSON sử dụng logic từ md2json.py
     
     Args:
         md_file_path: Đường dẫn file .md cần chuyển đổi
+        fused: file chưa mapping - ghép lời giải ngay khi dựng JSON và ghi lại .md đã mapping
         
     Returns:
         Đường dẫn file JSON đã tạo hoặc None nếu lỗi
     """
     try:
         print(f"🔄 Đang chuyển đổi MD sang JSON: {os.path.basename(md_file_path)}")
-        result = process_markdown_with_vertex_ai(md_file_path)
+        result = process_markdown_with_vertex_ai(md_file_path, fused=fused)
         
         if result[1]:  # result[1] là đường dẫn JSON output
             print(f"✅ Đã tạo JSON: {os.path.basename(result[1])}")
@@ -60,6 +119,40 @@ def convert_md_to_json_final(md_file_path: str) -> str:
         print(f"❌ Lỗi không xác định khi chuyển đổi MD sang JSON: {str(e)}")
         return None
 
+def import_pandoc_media(content: str, media_dir, media_dir_str: str) -> str:
+    """
+    Nhập media pandoc đã extract vào asset store và thay đường dẫn trong markdown
+    
+    Args:
+        content: Nội dung markdown từ pandoc
+        media_dir: Thư mục media đã truyền cho --extract-media
+        media_dir_str: Đường dẫn media_dir dạng forward slash (như trong markdown)
+        
+    Returns:
+        str: Markdown với đường dẫn ảnh trỏ vào asset store (URL public nếu có ASSET_BASE_URL,
+             ngược lại đường dẫn tương đối so với thư mục làm việc)
+    """
+    imported = asset_store.import_tree(media_dir, remove=True)
+    if not imported:
+        return content
+    
+    replacements = {}
+    for file_path, asset in imported.items():
+        relative = os.path.relpath(file_path, media_dir).replace("\\", "/")
+        if asset_store.base_url:
+            target = asset.url
+        else:
+            try:
+                target = os.path.relpath(asset.path)
+            except ValueError:
+                # Windows: store nằm ở ổ đĩa khác thư mục làm việc
+                target = asset.path
+        replacements[f"{media_dir_str}/{relative}"] = target.replace("\\", "/")
+    
+    pattern = re.compile("|".join(re.escape(p) for p in sorted(replacements, key=len, reverse=True)))
+    print(f"🖼️ Đã nhập {len(imported)} media vào asset store")
+    return pattern.sub(lambda m: replacements[m.group(0)], content)
+
 def convert_docx_to_markdown(docx_path: str) -> str:
     """
     Convert DOCX to Markdown using pandoc với logic từ processors/docx_to_markdown.py
@@ -70,6 +163,7 @@ def convert_docx_to_markdown(docx_path: str) -> str:
     Returns:
         str: Nội dung markdown hoặc None nếu lỗi
     """
+    temp_outdir = None
     try:
         from pathlib import Path
         
@@ -81,7 +175,11 @@ def convert_docx_to_markdown(docx_path: str) -> str:
         
         # Setup paths với forward slash đồng nhất
         src_path = Path(docx_path)
-        outdir = Path("data") / "diagrams" / "docx_conversion"
+        if asset_store.enabled:
+            # Thư mục tạm riêng cho mỗi lần convert, media được nhập vào asset store sau đó
+            outdir = temp_outdir = Path(tempfile.mkdtemp(prefix="qprocess_docx_"))
+        else:
+            outdir = Path("data") / "diagrams" / "docx_conversion"
         
         # Sử dụng target_paths để tạo đường dẫn chuẩn
         md_path, media_dir = target_paths(src_path, outdir, f"{src_path.stem}_media")
@@ -112,6 +210,10 @@ def convert_docx_to_markdown(docx_path: str) -> str:
             
             print(f"✅ Đã convert DOCX thành Markdown ({len(content)} ký tự)")
             
+            if asset_store.enabled:
+                # Media pandoc -> asset store (tên theo sha256), sửa đường dẫn trong markdown
+                return import_pandoc_media(content, media_dir, media_dir_str)
+            
             # Dọn dẹp temp files (giữ lại media nếu có)
             try:
                 md_path.unlink()  # Xóa file .md tạm
@@ -130,74 +232,10 @@ def convert_docx_to_markdown(docx_path: str) -> str:
         import traceback
         traceback.print_exc()
         return None
-
-def convert_pdf_to_images(pdf_path, dpi=200):
-    """
-    Convert PDF thành list các ảnh để xử lý bằng Vertex AI
-    Args:
-        pdf_path: đường dẫn file PDF
-        dpi: độ phân giải (200 DPI = balance quality vs speed)
-    Returns:
-        list các đường dẫn ảnh tạm hoặc None nếu lỗi
-    """
-    if not PDF_SUPPORT:
-        print("❌ PDF support không khả dụng!")
-        return None
-    
-    try:
-        print(f"🔄 Đang convert PDF thành ảnh: {os.path.basename(pdf_path)}")
-        
-        # Convert PDF to images với optimization
-        images = convert_from_path(
-            pdf_path, 
-            dpi=dpi,
-            fmt='JPEG',  # Format ảnh output
-            thread_count=mp.cpu_count(),  # Sử dụng multiple threads
-            use_pdftocairo=True  # Faster rendering
-        )
-        
-        print(f"✅ Đã convert thành {len(images)} ảnh")
-        
-        # Lưu ảnh tạm
-        temp_image_paths = []
-        temp_dir = tempfile.mkdtemp(prefix="qprocess_pdf_")
-        
-        for i, image in enumerate(images):
-            temp_path = os.path.join(temp_dir, f"page_{i+1:03d}.png")
-            image.save(temp_path, 'PNG', optimize=True)
-            temp_image_paths.append(temp_path)
-            print(f"💾 Trang {i+1}: {os.path.basename(temp_path)}")
-        
-        return temp_image_paths
-        
-    except Exception as e:
-        print(f"❌ Lỗi convert PDF: {str(e)}")
-        return None
-
-def cleanup_temp_images(image_paths):
-    """
-    Dọn dẹp các file ảnh tạm
-    Args:
-        image_paths: list đường dẫn ảnh tạm
-    """
-    if not image_paths:
-        return
-    
-    try:
-        # Xóa file
-        for path in image_paths:
-            if os.path.exists(path):
-                os.remove(path)
-        
-        # Xóa thư mục tạm
-        temp_dir = os.path.dirname(image_paths[0])
-        if os.path.exists(temp_dir):
-            os.rmdir(temp_dir)
-            
-        print(f"🧹 Đã dọn dẹp {len(image_paths)} file ảnh tạm")
-        
-    except Exception as e:
-        print(f"⚠️ Lỗi dọn dẹp temp files: {str(e)}")
+    finally:
+        # Thư mục tạm (asset store) luôn được xóa, kể cả khi pandoc / nhập media lỗi
+        if temp_outdir is not None:
+            shutil.rmtree(temp_outdir, ignore_errors=True)
 
 def process_single_docx_direct(docx_path, mode_name, index=None, show_result=False):
     """
@@ -210,7 +248,7 @@ def process_single_docx_direct(docx_path, mode_name, index=None, show_result=Fal
     Returns:
         tuple: (mapped_content, success, error_msg)
     """
-    if not DOCX_SUPPORT:
+    if not check_docx_support():
         error_msg = "DOCX support không khả dụng!"
         print(f"❌ {error_msg}")
         return (None, False, error_msg)
@@ -284,96 +322,19 @@ def ocr_single_pdf_vertex_ai(pdf_path, index=None, show_result=False):
                 print(f"❌ {error_msg}")
                 return (None, False, error_msg)
         
-        # Convert PDF thành ảnh
-        temp_image_paths = convert_pdf_to_images(pdf_path, dpi=150)  # Lower DPI for speed
-        
-        if not temp_image_paths:
-            error_msg = "Không thể convert PDF thành ảnh"
-            if index is not None:
-                return (index, None, pdf_path, False, error_msg)
-            else:
-                print(f"❌ {error_msg}")
-                return (None, False, error_msg)
-        
-        # Xử lý từng trang bằng Vertex AI với multiprocessing
+        # Render streaming + OCR song song: trang đầu được gửi OCR ngay khi render xong
         if index is None:
-            print(f"🔄 Xử lý {len(temp_image_paths)} trang bằng Vertex AI (multiprocessing)...")
-        
-        # Sử dụng multiprocessing để xử lý các trang song song
-        if len(temp_image_paths) > 1:
-            # Tạo list (page_index, image_path) 
-            page_info_list = [(i, path) for i, path in enumerate(temp_image_paths)]
-            
-            # Xử lý song song với số workers = min(số trang, số CPU)
-            max_workers = min(len(temp_image_paths), mp.cpu_count())
-            page_results = []
-            
-            try:
-                with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                    # Submit jobs
-                    future_to_page = {
-                        executor.submit(ocr_single_image, image_path, page_idx, False): (page_idx, image_path)
-                        for page_idx, image_path in page_info_list
-                    }
-                    
-                    # Collect results
-                    for future in as_completed(future_to_page):
-                        try:
-                            result = future.result()
-                            page_results.append(result)
-                        except Exception as e:
-                            page_idx, image_path = future_to_page[future]
-                            print(f"⚠️ Lỗi xử lý trang {page_idx + 1}: {str(e)}")
-                            page_results.append((page_idx, None, image_path, False, str(e)))
-                
-                # Sắp xếp kết quả theo thứ tự trang
-                page_results.sort(key=lambda x: x[0])
-                
-            except Exception as e:
-                print(f"⚠️ Lỗi multiprocessing, chuyển sang xử lý tuần tự: {str(e)}")
-                # Fallback to sequential processing
-                page_results = []
-                for i, image_path in enumerate(temp_image_paths):
-                    result = ocr_single_image(image_path, index=None, show_result=False)
-                    if result:
-                        page_results.append((i, result[0], image_path, result[1], result[2]))
-                    else:
-                        page_results.append((i, None, image_path, False, "Unknown error"))
-        else:
-            # Chỉ có 1 trang, xử lý trực tiếp
-            result = ocr_single_image(temp_image_paths[0], index=None, show_result=False)
-            if result:
-                page_results = [(0, result[0], temp_image_paths[0], result[1], result[2])]
-            else:
-                page_results = [(0, None, temp_image_paths[0], False, "Unknown error")]
+            print("🔄 Render và xử lý các trang bằng Vertex AI (pipeline streaming)...")
         
-        # Tổng hợp kết quả
-        all_results = []
-        successful_pages = 0
-        
-        for page_idx, result_text, image_path, success, error_msg in page_results:
-            page_num = page_idx + 1
-            
-            if success and result_text:
-                all_results.append(f"## Trang {page_num}\n\n{result_text}")
-                successful_pages += 1
-            else:
-                if index is None:
-                    print(f"⚠️ Lỗi trang {page_num}: {error_msg}")
-                all_results.append(f"## Trang {page_num}\n\n❌ Lỗi xử lý: {error_msg}")
-        
-        # Dọn dẹp temp files
-        cleanup_temp_images(temp_image_paths)
+        _, combined_text, _, success, error_msg = ocr_documents_vertex_ai([pdf_path])[0]
         
         # Tổng hợp kết quả
-        if successful_pages > 0:
-            combined_text = "\n\n".join(all_results)
-            
+        if success:
             if index is not None:
-                print(f"✅ {prefix} Hoàn thành: {successful_pages}/{len(temp_image_paths)} trang")
+                print(f"✅ {prefix} Hoàn thành: {os.path.basename(pdf_path)}")
                 return (index, combined_text, pdf_path, True, None)
             else:
-                print(f"✅ Hoàn thành PDF: {successful_pages}/{len(temp_image_paths)} trang thành công")
+                print(f"✅ Hoàn thành PDF: {os.path.basename(pdf_path)}")
                 if show_result:
                     print("\n" + "="*60)
                     print("📄 KẾT QUẢ OCR PDF (VERTEX AI):")
@@ -382,7 +343,6 @@ def ocr_single_pdf_vertex_ai(pdf_path, index=None, show_result=False):
                     print("="*60)
                 return (combined_text, True, None)
         else:
-            error_msg = f"Không có trang nào xử lý thành công (0/{len(temp_image_paths)})"
             if index is not None:
                 return (index, None, pdf_path, False, error_msg)
             else:
@@ -399,135 +359,312 @@ def ocr_single_pdf_vertex_ai(pdf_path, index=None, show_result=False):
             traceback.print_exc()
             return (None, False, error_msg)
 
-def ocr_single_image(image_path, index=None, show_result=False):
+def combine_page_results(page_results, verbose=False):
+    """
+    Ghép kết quả OCR các trang thành một văn bản theo thứ tự trang
+    Args:
+        page_results: list tuple (page_idx, result_text, image_path, success, error_msg)
+        verbose: có in lỗi từng trang không
+    Returns:
+        tuple (combined_text, successful_pages)
+    """
+    all_results = []
+    successful_pages = 0
+    
+    for page_idx, result_text, image_path, success, error_msg in sorted(page_results, key=lambda x: x[0]):
+        page_num = page_idx + 1
+        
+        if success and result_text:
+            all_results.append(f"## Trang {page_num}\n\n{result_text}")
+            successful_pages += 1
+        else:
+            if verbose:
+                print(f"⚠️ Lỗi trang {page_num}: {error_msg}")
+            all_results.append(f"## Trang {page_num}\n\n❌ Lỗi xử lý: {error_msg}")
+    
+    return "\n\n".join(all_results), successful_pages
+
+def ocr_documents_vertex_ai(file_paths, max_workers=None):
+    """
+    OCR nhiều tài liệu (PDF/ảnh) bằng Vertex AI với một hàng đợi trang chung cho cả batch.
+    PDF được render streaming từng cụm trang, mỗi trang vào hàng đợi OCR ngay khi render xong
+    dưới dạng PageImage trong RAM (không ghi file ảnh tạm).
+    Args:
+        file_paths: list đường dẫn PDF hoặc ảnh
+        max_workers: số worker cố định (mặc định = số CPU; chế độ async dùng OCR_MAX_CONCURRENCY)
+    Returns:
+        list tuple (index, result_text, file_path, success, error_msg) theo thứ tự input
+    """
+    use_async = app_config.execution_mode == "async"
+    max_workers = max_workers or mp.cpu_count()
+    
+    page_counts = {}      # index -> số trang
+    errors = {}           # index -> lỗi trước khi OCR
+    
+    if use_async:
+        print(f"🚀 Hàng đợi trang chung: {len(file_paths)} tài liệu (asyncio, {app_config.max_concurrency} request đồng thời)")
+    else:
+        print(f"🚀 Hàng đợi trang chung: {len(file_paths)} tài liệu, {max_workers} processes")
+    
+    def iter_document_pages(doc_index, file_path):
+        """Yield (page_idx, image_path | PageImage) của tài liệu; PDF được render streaming"""
+        if not os.path.exists(file_path):
+            errors[doc_index] = f"File không tồn tại: {file_path}"
+            return
+        if not file_path.lower().endswith('.pdf'):
+            page_counts[doc_index] = 1
+            yield 0, file_path
+            return
+        if not PDF_SUPPORT:
+            errors[doc_index] = "PDF support không khả dụng (thiếu pdf2image)"
+            return
+        
+        try:
+            page_count = get_pdf_page_count(file_path)
+        except Exception as e:
+            errors[doc_index] = f"Không thể đọc thông tin PDF: {str(e)}"
+            return
+        
+        page_counts[doc_index] = page_count
+        print(f"🔄 Đang render streaming {page_count} trang: {os.path.basename(file_path)}")
+        try:
+            yield from iter_pdf_page_images(
+                file_path, dpi=150,  # Lower DPI for speed
+                page_count=page_count,
+                window=app_config.raster_window_pages,
+                buffer_size=app_config.raster_buffer_pages,
+                quality=app_config.raster_jpeg_quality
+            )
+        except Exception as e:
+            print(f"❌ Lỗi render PDF {os.path.basename(file_path)}: {str(e)}")
+    
+    if use_async:
+        def page_stream():
+            for doc_index, file_path in enumerate(file_paths):
+                for page_idx, image_path in iter_document_pages(doc_index, file_path):
+                    yield (doc_index, page_idx), image_path
+        
+        page_results = {}
+        for (doc_index, page_idx), result_text, image_path, success, error_msg in ocr_page_stream_vertex_async(page_stream()):
+            page_results.setdefault(doc_index, []).append((page_idx, result_text, image_path, success, error_msg))
+    else:
+        # Trang vào pool ngay khi render xong; submit_page chờ khi quá nhiều trang đang chờ OCR
+        max_pending = max_workers + app_config.raster_buffer_pages
+        # Trang PDF đi qua shared memory, chỉ trang vượt PAGE_SHM_SPILL_MB mới ghi ra đĩa
+        spill_threshold = int(app_config.page_shm_spill_mb * 1024 * 1024)
+        with PageScheduler(ocr_single_image, max_workers=max_workers, initializer=init_worker,
+                           initargs=(get_shared_state(),), max_pending=max_pending,
+                           spill_threshold=spill_threshold) as scheduler:
+            for doc_index, file_path in enumerate(file_paths):
+                registered = False
+                for page_idx, image_path in iter_document_pages(doc_index, file_path):
+                    if not registered:
+                        scheduler.add_document(doc_index, page_counts[doc_index])
+                        registered = True
+                    scheduler.submit_page(doc_index, page_idx, image_path)
+            
+            total_pages = sum(page_counts.get(i, 0) for i in range(len(file_paths)) if i not in errors)
+            progress = {"done": 0}
+            
+            def on_page_done(doc_index, page_idx, success):
+                progress["done"] += 1
+                status = "✅" if success else "❌"
+                print(f"📊 Tiến độ: {progress['done']}/{total_pages} trang {status} "
+                      f"({os.path.basename(file_paths[doc_index])} - trang {page_idx + 1})")
+            
+            page_results = scheduler.collect(on_page_done)
+    
+    # Gom kết quả theo từng tài liệu
+    results = []
+    for doc_index, file_path in enumerate(file_paths):
+        if doc_index in errors:
+            results.append((doc_index, None, file_path, False, errors[doc_index]))
+            continue
+        
+        pages = page_results.get(doc_index, [])
+        if file_path.lower().endswith('.pdf'):
+            combined_text, successful_pages = combine_page_results(pages)
+            page_count = page_counts.get(doc_index, len(pages))
+            if successful_pages > 0:
+                print(f"✅ [{os.path.basename(file_path)}] Hoàn thành: {successful_pages}/{page_count} trang")
+                results.append((doc_index, combined_text, file_path, True, None))
+            else:
+                error_msg = f"Không có trang nào xử lý thành công (0/{page_count})"
+                results.append((doc_index, None, file_path, False, error_msg))
+        elif pages:
+            _, result_text, _, success, error_msg = pages[0]
+            results.append((doc_index, result_text if success else None, file_path, success, error_msg))
+        else:
+            results.append((doc_index, None, file_path, False, "Không có kết quả OCR"))
+    
+    return results
+
+def ocr_single_image(image_path, index=None, show_result=False, on_chunk=None):
     """
     Xử lý OCR một ảnh đơn lẻ - function chung cho cả single mode và multiprocessing
     Args:
-        image_path: đường dẫn ảnh
+        image_path: đường dẫn ảnh, PageImage hoặc PageHandle (trang PDF trong shared memory)
         index: index của ảnh (cho multiprocessing), None cho single mode
         show_result: có hiển thị kết quả chi tiết không (cho single mode)
+        on_chunk: callback(chunk_text) nhận kết quả theo từng đoạn token (bật streaming),
+                  callback(None) khi lần thử trước bị hủy và kết quả được stream lại từ đầu
     Returns:
         tuple (result_text, success, error_msg) cho single mode
         tuple (index, result_text, image_path, success, error_msg) cho multiprocessing
     """
+    # Trang trong RAM -> trả về tên trang thay vì object chứa bytes
+    source = image_path
+    image_name = page_name(image_path)
+    if not isinstance(image_path, str):
+        image_path = image_name
+    
     try:
         # Xác định prefix cho log messages
         prefix = f"[Process {index}]" if index is not None else ""
         
         if index is not None:
-            print(f"🔄 {prefix} Bắt đầu xử lý: {os.path.basename(image_path)}")
+            print(f"🔄 {prefix} Bắt đầu xử lý: {image_name}")
         else:
             print("=== TEST OCR IMAGE VỚI VERTEX AI ===")
-            print(f"📷 Đang xử lý ảnh: {os.path.basename(image_path)}")
-            
-        if not app_config.vertex_ai.initialize_vertex_ai():
-            error_msg = "Không thể khởi tạo Vertex AI!"
-            if index is not None:
-                return (index, None, image_path, False, error_msg)
-            else:
-                print(f"❌ {error_msg}")
-                return (None, False, error_msg)
-        
-        # Tạo model
-        model = GenerativeModel(app_config.vertex_ai.model_name)
-        if index is None:
-            print(f"✅ Đã khởi tạo model: {app_config.vertex_ai.model_name}")
+            print(f"📷 Đang xử lý ảnh: {image_name}")
         
-        # Đọc ảnh và tạo Part object
+        # Đọc ảnh
         if index is None:
             print("📖 Đang đọc và xử lý ảnh...")
             
-        with open(image_path, "rb") as image_file:
-            image_bytes = image_file.read()
-        
-        # Xác định mime type
-        ext = os.path.splitext(image_path)[1].lower()
-        if ext == '.png': 
-            mime_type = 'image/png'
-        elif ext in ('.jpg', '.jpeg'): 
-            mime_type = 'image/jpeg'
-        elif ext == '.gif': 
-            mime_type = 'image/gif'
-        elif ext == '.webp': 
-            mime_type = 'image/webp'
-        else: 
-            mime_type = 'image/png'
-        
-        image_part = Part.from_data(data=image_bytes, mime_type=mime_type)
-        if index is None:
-            print(f"✅ Đã tạo image part với mime type: {mime_type}")
-        
-        text_part = Part.from_text(VERTEX_AI_OCR)
-        
-        # Tạo generation config
-        generation_config = GenerationConfig(
-            temperature=0.1,
-            top_p=0.8,
-            max_output_tokens=15000
+        page = load_page(source)
+        image_bytes = page.data
+        
+        # Generation config (dùng chung cho request và khóa cache)
+        generation_params = VERTEX_OCR_GENERATION_PARAMS
+        
+        cache_key = ocr_cache.build_key(
+            digest_bytes(image_bytes),
+            engine="vertex_ai",
+            model_name=app_config.vertex_ai.model_name,
+            generation_config=generation_params,
+            prompt=VERTEX_AI_OCR,
+            upload_profile=payload_optimizer.profile
         )
         
-        # Gọi API với retry logic
-        if index is None:
-            print("🔄 Đang gửi request đến Vertex AI...")
+        max_retries = max_retry_attempts()
+        call_errors = []
+        # Streaming cho lần chạy đơn lẻ (tương tác) hoặc khi caller đăng ký callback
+        stream_output = bool(on_chunk or (index is None and app_config.generation_streaming))
+        
+        def call_vertex_ai():
+            """Gọi Vertex AI với retry logic, trả về text hoặc None"""
+            # Model được cache theo process (khởi tạo sẵn trong init_worker)
+            model = app_config.vertex_ai.get_model()
+            if model is None:
+                call_errors.append("Không thể khởi tạo Vertex AI!")
+                return None
             
-        prompt_parts = [text_part, image_part]
-        max_retries = 3
-        
-        for attempt in range(max_retries):
-            try:
-                if index is not None:
-                    print(f"🔄 {prefix} Thử lần {attempt + 1}/{max_retries}...")
-                else:
-                    print(f"🔄 Thử lần {attempt + 1}/{max_retries}...")
-                
-                response = model.generate_content(
-                    prompt_parts, 
-                    generation_config=generation_config, 
-                    stream=False
-                )
+            if index is None:
+                print(f"✅ Đã khởi tạo model: {app_config.vertex_ai.model_name}")
+            
+            # Encode lại ảnh theo ngân sách upload (chỉ khi thật sự gọi API, cache hit thì bỏ qua)
+            upload_page, _ = payload_optimizer.optimize(page)
+            image_part = Part.from_data(data=upload_page.data, mime_type=upload_page.mime_type)
+            if index is None:
+                print(f"✅ Đã tạo image part với mime type: {upload_page.mime_type} "
+                      f"({len(image_bytes) // 1024}KB -> {len(upload_page.data) // 1024}KB)")
+            
+            text_part = Part.from_text(VERTEX_AI_OCR)
+            generation_config = GenerationConfig(**generation_params)
+            
+            # Gọi API với retry logic
+            if index is None:
+                print("🔄 Đang gửi request đến Vertex AI...")
                 
-                if response and response.text:
-                    # Thành công
+            prompt_parts = [text_part, image_part]
+            
+            # Quota dùng chung giữa các process (RPM/TPM) + backoff có jitter thay vì sleep cố định
+            backoff = Backoff()
+            request_tokens = estimate_tokens(VERTEX_AI_OCR, images=1)
+            sink = StreamSink(stream_path(image_name, "ocr.md"), on_chunk) if stream_output else None
+            
+            for attempt in range(max_retries):
+                try:
                     if index is not None:
-                        print(f"✅ {prefix} Hoàn thành: {os.path.basename(image_path)}")
-                        return (index, response.text, image_path, True, None)
+                        print(f"🔄 {prefix} Thử lần {attempt + 1}/{max_retries}...")
+                    else:
+                        print(f"🔄 Thử lần {attempt + 1}/{max_retries}...")
+                    
+                    vertex_limiter.acquire(request_tokens)
+                    if sink is not None:
+                        # Ghi dần ra file stream (lần thử lại ghi lại từ đầu, callback nhận None trước)
+                        text, usage = generate_streaming(model, prompt_parts, sink,
+                                                         generation_config=generation_config)
                     else:
-                        print("✅ Đã nhận được kết quả OCR!")
-                        if show_result:
-                            print("\n" + "="*60)
-                            print("📄 KẾT QUẢ OCR:")
-                            print("="*60)
-                            print(response.text)
-                            print("="*60)
-                        return (response.text, True, None)
-                else:
+                        response = model.generate_content(
+                            prompt_parts, 
+                            generation_config=generation_config, 
+                            stream=False
+                        )
+                        usage = getattr(response, "usage_metadata", None)
+                        text = response.text if response else None
+                    vertex_limiter.charge(getattr(usage, "candidates_token_count", 0) or 0)
+                    
+                    if text:
+                        return text
+                    
                     # Không có kết quả
                     retry_msg = f"Lần thử {attempt + 1}: Không nhận được kết quả từ Vertex AI"
                     if index is not None:
                         print(f"⚠️ {prefix} {retry_msg}")
                     else:
                         print(f"⚠️ {retry_msg}")
-                        
-                    if attempt < max_retries - 1:  # Không sleep ở lần thử cuối
-                        if index is None:
-                            print("⏳ Đợi 2 giây trước khi thử lại...")
-                        time.sleep(2)
-                        
-            except Exception as api_error:
-                # Lỗi API
-                error_msg = f"Lần thử {attempt + 1}: Lỗi API - {str(api_error)}"
-                if index is not None:
-                    print(f"⚠️ {prefix} {error_msg}")
-                else:
-                    print(f"⚠️ {error_msg}")
+                    delay = backoff.next_delay()
+                            
+                except Exception as api_error:
+                    # Lỗi API
+                    retryable, status, retry_after = classify_error(api_error)
+                    error_msg = f"Lần thử {attempt + 1}: Lỗi API - {str(api_error)}"
+                    if index is not None:
+                        print(f"⚠️ {prefix} {error_msg}")
+                    else:
+                        print(f"⚠️ {error_msg}")
                     
+                    if not retryable:
+                        # 400/401/403/404: gửi lại cũng không thành công
+                        call_errors.append(f"Lỗi API không thể retry (HTTP {status}) - {str(api_error)}")
+                        break
+                    # 429/Retry-After: tạm dừng Vertex AI trên tất cả process
+                    delay = vertex_limiter.retry_delay(backoff, status, retry_after)
+                
                 if attempt < max_retries - 1:  # Không sleep ở lần thử cuối
                     if index is None:
-                        print("⏳ Đợi 2 giây trước khi thử lại...")
-                    time.sleep(2)
+                        print(f"⏳ Đợi {delay:.1f} giây trước khi thử lại...")
+                    time.sleep(delay)
+            
+            return None
+        
+        result_text, from_cache = ocr_cache.get_or_compute(cache_key, call_vertex_ai)
+        
+        if result_text:
+            # Thành công
+            if index is not None:
+                cache_note = " (cache)" if from_cache else ""
+                print(f"✅ {prefix} Hoàn thành{cache_note}: {image_name}")
+                return (index, result_text, image_path, True, None)
+            else:
+                if from_cache:
+                    print("♻️ Dùng kết quả OCR từ cache (bỏ qua gọi Vertex AI)")
+                print("✅ Đã nhận được kết quả OCR!")
+                if show_result:
+                    print("\n" + "="*60)
+                    print("📄 KẾT QUẢ OCR:")
+                    print("="*60)
+                    print(result_text)
+                    print("="*60)
+                return (result_text, True, None)
         
         # Nếu tất cả attempts đều thất bại
-        final_error = f"Không nhận được kết quả từ Vertex AI sau {max_retries} lần thử"
+        if call_errors:
+            final_error = call_errors[-1]
+        else:
+            final_error = f"Không nhận được kết quả từ Vertex AI sau {max_retries} lần thử"
         if index is not None:
             return (index, None, image_path, False, final_error)
         else:
@@ -597,45 +734,28 @@ def ocr_single_image_mathpix(image_path, index=None, show_result=False):
                 return (None, False, error_msg)
         
         # Tùy chọn OCR
-        mathpix_options = {
-            "formats": ["mmd"],
-            "math_inline_delimiters": ["$", "$"],
-            "math_display_delimiters": ["$$", "$$"],
-            "include_annotated_image": True,
-            "include_image_links": True,
-            "include_line_data": True,
-            "include_diagram": True,
-            "include_diagram_text": True,
-            "rm_spaces": True,
-            "rm_fonts": False,
-            "numbers_default_to_math": True
-        }
+        mathpix_options = MATHPIX_IMAGE_OPTIONS
         
         if index is None:
             print("🔄 Đang gửi request đến Mathpix API...")
         
-        # Gọi Mathpix API
-        result = app_config.mathpix.ocr_image(image_path, mathpix_options)
+        # Gọi Mathpix API (qua OCR cache - ảnh không đổi sẽ không gửi lại)
+        cache_key = ocr_cache.build_key(
+            digest_file(image_path),
+            engine="mathpix",
+            prompt=mathpix_options,
+            upload_profile=payload_optimizer.profile
+        )
+        result, from_cache = ocr_cache.get_or_compute(
+            cache_key,
+            lambda: app_config.mathpix.ocr_image(image_path, mathpix_options)
+        )
+        if from_cache:
+            print(f"♻️ {prefix} Dùng kết quả Mathpix từ cache: {os.path.basename(image_path)}")
         
-        diagram_files = save_diagrams_from_line_data(image_path, result, base_outdir="data/diagrams")
+        augmented_text = build_mathpix_image_text(image_path, result)
 
-        if diagram_files:
-            print(f"🖼️ Đã lưu {len(diagram_files)} hình diagram vào:", os.path.dirname(diagram_files[0]["path"]))
-            # In kèm id & bbox để debug
-            for d in diagram_files:
-                print(f"   - {os.path.basename(d['path'])}  id={d['id']}  bbox={d['bbox']}")
-
-        if result and result.get('text'):
-            # Post-process kết quả để phù hợp với format đề thi
-            processed_text = post_process_mathpix_result(result)
-
-            augmented_text = insert_diagrams_into_text(
-                raw_text=processed_text,
-                result=result,
-                diagram_files=diagram_files,
-                min_gap_px=8
-            )
-            
+        if augmented_text is not None:
             if index is not None:
                 print(f"✅ {prefix} Hoàn thành: {os.path.basename(image_path)}")
                 return (index, augmented_text, image_path, True, None)
@@ -670,6 +790,36 @@ def ocr_single_image_mathpix(image_path, index=None, show_result=False):
             traceback.print_exc()
             return (None, False, error_msg)
 
+def build_mathpix_image_text(image_path, result):
+    """
+    Crop diagram từ line_data, post-process và chèn diagram vào text của kết quả Mathpix
+    Args:
+        image_path: đường dẫn ảnh gốc
+        result: dict kết quả từ Mathpix /v3/text
+    Returns:
+        str: text đã xử lý hoặc None nếu kết quả rỗng
+    """
+    diagram_files = save_diagrams_from_line_data(image_path, result, base_outdir="data/diagrams")
+
+    if diagram_files:
+        print(f"🖼️ Đã lưu {len(diagram_files)} hình diagram vào:", os.path.dirname(diagram_files[0]["path"]))
+        # In kèm id & bbox để debug
+        for d in diagram_files:
+            print(f"   - {os.path.basename(d['path'])}  id={d['id']}  bbox={d['bbox']}")
+
+    if not result or not result.get('text'):
+        return None
+
+    # Post-process kết quả để phù hợp với format đề thi
+    processed_text = post_process_mathpix_result(result)
+
+    return insert_diagrams_into_text(
+        raw_text=processed_text,
+        result=result,
+        diagram_files=diagram_files,
+        min_gap_px=8
+    )
+
 def post_process_mathpix_result(mathpix_result):
     """
     Post-process kết quả từ Mathpix để phù hợp với format đề thi
@@ -771,11 +921,20 @@ def ocr_single_document_mathpix(document_path, index=None, show_result=False):
             print(f"🔄 Đang xử lý {file_type} với Mathpix API...")
         
         # Gọi Mathpix PDF API (hỗ trợ cả PDF và DOCX)
-        result_text = app_config.mathpix.process_pdf(document_path, timeout=120)
+        page_processed = False
+        if file_ext == '.pdf' and app_config.mathpix_pdf_streaming:
+            # Từng trang được crop diagram + post-process ngay khi Mathpix xử lý xong trang đó
+            result_text = ocr_pdf_mathpix_streaming(document_path, timeout=300)
+            page_processed = True
+        elif file_ext == '.pdf' and ASYNC_HTTP_SUPPORT and app_config.mathpix_pdf_chunk_pages:
+            # PDF lớn: chia cụm trang, upload song song, ghép lại theo thứ tự
+            result_text = process_pdf_mathpix_chunked(document_path, timeout=120)
+        else:
+            result_text = app_config.mathpix.process_pdf(document_path, timeout=120)
         
         if result_text and not result_text.startswith("PK"):  # Không phải binary
-            # Post-process kết quả để phù hợp với format đề thi
-            processed_text = post_process_mathpix_result({'text': result_text})
+            # Post-process kết quả để phù hợp với format đề thi (streaming đã xử lý theo trang)
+            processed_text = result_text if page_processed else post_process_mathpix_result({'text': result_text})
             
             if index is not None:
                 print(f"✅ {prefix} Hoàn thành: {os.path.basename(document_path)}")
@@ -807,6 +966,123 @@ def ocr_single_document_mathpix(document_path, index=None, show_result=False):
             traceback.print_exc()
             return (None, False, error_msg)
 
+def build_mathpix_page_text(document_path, page_no, text, line_data, page_size, work_dir):
+    """
+    Xử lý một trang PDF Mathpix: crop diagram từ line_data (render lại trang đúng hệ tọa độ
+    page_size của Mathpix), post-process và chèn diagram vào text
+    Args:
+        work_dir: thư mục tạm chứa ảnh trang đã render
+    Returns:
+        str: text đã xử lý của trang
+    """
+    result = {'text': text, 'line_data': line_data}
+    has_diagram = any(line.get("type") == "diagram" and line.get("cnt") for line in line_data or [])
+    if not (has_diagram and page_size and PDF_SUPPORT):
+        # Không có diagram / không biết hệ tọa độ của line_data -> chỉ post-process
+        return post_process_mathpix_result(result)
+    
+    base_name = os.path.splitext(os.path.basename(document_path))[0]
+    page_path = os.path.join(work_dir, f"{base_name}_page_{page_no:03d}.png")
+    try:
+        image = render_pdf_page(document_path, page_no, size=page_size)
+        image.save(page_path)
+        image.close()
+        return build_mathpix_image_text(page_path, result) or ''
+    except Exception as e:
+        print(f"⚠️ Không crop được diagram trang {page_no}: {str(e)}")
+        return post_process_mathpix_result(result)
+    finally:
+        if os.path.exists(page_path):
+            os.remove(page_path)
+
+def ocr_pdf_mathpix_streaming(document_path, timeout=300):
+    """
+    OCR PDF qua Mathpix theo từng trang: mỗi trang được xử lý (crop + chèn diagram, post-process)
+    trong thread nền ngay khi Mathpix trả về, trong lúc các trang còn lại vẫn đang được OCR
+    Args:
+        document_path: đường dẫn PDF
+        timeout: thời gian chờ tối đa (giây)
+    Returns:
+        text đã xử lý, ghép theo thứ tự trang, hoặc None nếu không có trang nào
+    """
+    name = os.path.basename(document_path)
+    work_dir = tempfile.mkdtemp(prefix="qprocess_pdfpage_")
+    futures = {}
+    try:
+        workers = max(1, app_config.diagram_encode_workers)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mathpix-page") as executor:
+            for page_no, text, line_data, page_size in app_config.mathpix.iter_pdf_pages(document_path, timeout=timeout):
+                print(f"📄 [{name}] Đã nhận trang {page_no}")
+                futures[page_no] = executor.submit(build_mathpix_page_text, document_path, page_no,
+                                                   text, line_data, page_size, work_dir)
+            pages = {page_no: future.result() for page_no, future in futures.items()}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    if not pages:
+        return None
+    return "\n\n".join(pages[page_no] for page_no in sorted(pages))
+
+def process_pdf_mathpix_chunked(document_path, timeout=120):
+    """
+    Xử lý một PDF qua Mathpix theo cụm trang song song (gọi từ code đồng bộ)
+    Returns:
+        text content hoặc None nếu lỗi
+    """
+    async def runner():
+        async with AsyncOCREngine() as engine:
+            return await engine.process_pdf_mathpix_chunked(document_path, timeout=timeout)
+    
+    return run_async(runner())
+
+def ocr_images_mathpix_packed(image_paths):
+    """
+    OCR nhiều ảnh nhỏ bằng Mathpix qua các job PDF gộp nhiều ảnh (ảnh đã có trong cache thì bỏ qua)
+    Args:
+        image_paths: list đường dẫn ảnh
+    Returns:
+        list tuple (index, result_text, image_path, success, error_msg) theo thứ tự input
+    """
+    # Kết quả /v3/text (ảnh đơn lẻ) và kết quả tách từ job PDF gộp được cache theo khóa riêng:
+    # lần chạy không gộp chỉ đọc khóa "mathpix", lần chạy gộp dùng được cả hai
+    digests = [digest_file(path) for path in image_paths]
+    image_keys = [
+        ocr_cache.build_key(digest, engine="mathpix", prompt=MATHPIX_IMAGE_OPTIONS,
+                            upload_profile=payload_optimizer.profile)
+        for digest in digests
+    ]
+    packed_keys = [
+        ocr_cache.build_key(digest, engine="mathpix-packed", prompt=MATHPIX_PACKED_PDF_OPTIONS,
+                            upload_profile=payload_optimizer.profile)
+        for digest in digests
+    ]
+    results = [ocr_cache.get(image_key) or ocr_cache.get(packed_key)
+               for image_key, packed_key in zip(image_keys, packed_keys)]
+    
+    missing = [i for i, result in enumerate(results) if result is None]
+    if len(missing) < len(image_paths):
+        print(f"♻️ Dùng kết quả Mathpix từ cache cho {len(image_paths) - len(missing)} ảnh")
+    if missing:
+        packed = ocr_images_packed([image_paths[i] for i in missing], MATHPIX_PACKED_PDF_OPTIONS,
+                                   image_options=MATHPIX_IMAGE_OPTIONS)
+        for i, result in zip(missing, packed):
+            results[i] = result
+            if result is not None:
+                ocr_cache.put(packed_keys[i] if result.get("packed") else image_keys[i], result)
+    
+    outputs = []
+    for index, (image_path, result) in enumerate(zip(image_paths, results)):
+        try:
+            processed_text = build_mathpix_image_text(image_path, result)
+        except Exception as e:
+            outputs.append((index, None, image_path, False, f"Lỗi khi xử lý ảnh với Mathpix {image_path}: {str(e)}"))
+            continue
+        if processed_text:
+            outputs.append((index, processed_text, image_path, True, None))
+        else:
+            outputs.append((index, None, image_path, False, "Không nhận được kết quả từ Mathpix API"))
+    return outputs
+
 def process_single_image_mathpix(image_info):
     """
     Wrapper cho multiprocessing - gọi ocr_single_image_mathpix
@@ -836,6 +1112,106 @@ def process_single_file_mathpix(file_info):
     else:
         return ocr_single_image_mathpix(file_path, index=index, show_result=False)
 
+def ocr_page_stream_vertex_async(page_stream, max_concurrency=None):
+    """
+    OCR các trang bằng Vertex AI ở chế độ asyncio khi trang còn đang được sinh ra (streaming)
+    Args:
+        page_stream: iterator (key, image_path | PageImage); được đọc trong thread nên có thể block (render PDF)
+        max_concurrency: số request đồng thời (mặc định OCR_MAX_CONCURRENCY)
+    Returns:
+        list tuple (key, result_text, image_path, success, error_msg) theo thứ tự của stream
+    """
+    async def ocr_one(engine, key, image):
+        # Kết quả chỉ giữ tên trang, bytes của PageImage được giải phóng khi task xong
+        image_path = image if isinstance(image, str) else page_name(image)
+        try:
+            result_text, from_cache = await engine.ocr_image_vertex(
+                image, VERTEX_AI_OCR, VERTEX_OCR_GENERATION_PARAMS
+            )
+        except Exception as e:
+            return (key, None, image_path, False, f"Lỗi khi xử lý ảnh {image_path}: {str(e)}")
+        
+        if result_text:
+            cache_note = " (cache)" if from_cache else ""
+            print(f"✅ [Async {key}] Hoàn thành{cache_note}: {page_name(image_path)}")
+            return (key, result_text, image_path, True, None)
+        return (key, None, image_path, False, "Không nhận được kết quả từ Vertex AI")
+    
+    async def runner():
+        async with AsyncOCREngine(max_concurrency) as engine:
+            # Giới hạn số trang đang chờ để renderer không chạy quá xa so với OCR
+            pending = asyncio.Semaphore(engine.max_concurrency + app_config.raster_buffer_pages)
+            iterator = iter(page_stream)
+            done = object()
+            tasks = []
+            
+            while True:
+                await pending.acquire()
+                item = await asyncio.to_thread(next, iterator, done)
+                if item is done:
+                    pending.release()
+                    break
+                key, image = item
+                task = asyncio.ensure_future(ocr_one(engine, key, image))
+                task.add_done_callback(lambda _: pending.release())
+                tasks.append(task)
+            
+            return await asyncio.gather(*tasks)
+    
+    return list(run_async(runner()))
+
+def ocr_images_vertex_async(image_paths, max_concurrency=None):
+    """
+    OCR nhiều ảnh bằng Vertex AI ở chế độ asyncio (một process, nhiều request đồng thời)
+    Args:
+        image_paths: list đường dẫn ảnh
+        max_concurrency: số request đồng thời (mặc định OCR_MAX_CONCURRENCY)
+    Returns:
+        list tuple (index, result_text, image_path, success, error_msg) theo thứ tự input
+    """
+    return ocr_page_stream_vertex_async(enumerate(image_paths), max_concurrency)
+
+def ocr_files_mathpix_async(file_paths, max_concurrency=None):
+    """
+    OCR nhiều file (ảnh/PDF/DOCX) bằng Mathpix ở chế độ asyncio
+    Args:
+        file_paths: list đường dẫn file
+        max_concurrency: số request đồng thời (mặc định OCR_MAX_CONCURRENCY)
+    Returns:
+        list tuple (index, result_text, file_path, success, error_msg) theo thứ tự input
+    """
+    async def ocr_one(engine, index, file_path):
+        ext = os.path.splitext(file_path)[1].lower()
+        try:
+            if ext == '.pdf':
+                # PDF lớn được chia cụm trang xử lý song song
+                result_text = await engine.process_pdf_mathpix_chunked(file_path, timeout=120)
+                processed_text = post_process_mathpix_result({'text': result_text}) if result_text else None
+            elif ext == '.docx':
+                result_text = await engine.process_pdf_mathpix(file_path, timeout=120)
+                processed_text = post_process_mathpix_result({'text': result_text}) if result_text else None
+            elif app_config.mathpix.is_supported_image(file_path):
+                result, _ = await engine.ocr_image_mathpix(file_path, MATHPIX_IMAGE_OPTIONS)
+                # Crop diagram là việc CPU local -> chạy trong thread để không chặn event loop
+                processed_text = await asyncio.to_thread(build_mathpix_image_text, file_path, result)
+            else:
+                return (index, None, file_path, False, f"Format file không được hỗ trợ: {file_path}")
+        except Exception as e:
+            return (index, None, file_path, False, f"Lỗi khi xử lý với Mathpix {file_path}: {str(e)}")
+        
+        if processed_text:
+            print(f"✅ [Async {index}] Hoàn thành: {os.path.basename(file_path)}")
+            return (index, processed_text, file_path, True, None)
+        return (index, None, file_path, False, "Không nhận được kết quả từ Mathpix API")
+    
+    async def runner():
+        async with AsyncOCREngine(max_concurrency) as engine:
+            return await asyncio.gather(*(
+                ocr_one(engine, i, path) for i, path in enumerate(file_paths)
+            ))
+    
+    return list(run_async(runner()))
+
 def process_multiple_images(image_paths, max_workers=None):
     """
     Xử lý nhiều ảnh đồng thời bằng multiprocessing
@@ -849,11 +1225,16 @@ def process_multiple_images(image_paths, max_workers=None):
         print("❌ Không có ảnh nào để xử lý!")
         return []
     
+    use_async = app_config.execution_mode == "async"
+    
     # Xác định số workers
     if max_workers is None:
         max_workers = min(len(image_paths), mp.cpu_count())
     
-    print(f"🚀 Bắt đầu xử lý {len(image_paths)} ảnh với {max_workers} processes")
+    if use_async:
+        print(f"🚀 Bắt đầu xử lý {len(image_paths)} ảnh (asyncio, {app_config.max_concurrency} request đồng thời)")
+    else:
+        print(f"🚀 Bắt đầu xử lý {len(image_paths)} ảnh với {max_workers} processes")
     
     # Tạo list (index, image_path) để giữ thứ tự
     image_info_list = [(i, path) for i, path in enumerate(image_paths)]
@@ -863,49 +1244,60 @@ def process_multiple_images(image_paths, max_workers=None):
     
     start_time = time.time()
     
-    try:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            # Submit tất cả tasks
-            future_to_info = {
-                executor.submit(ocr_single_image, image_path, index): (index, image_path) 
-                for index, image_path in image_info_list
+    if use_async:
+        for index, result_text, image_path, success, error_msg in ocr_images_vertex_async(image_paths):
+            results[index] = {
+                'index': index,
+                'image_path': image_path,
+                'result_text': result_text,
+                'success': success,
+                'error_msg': error_msg
             }
+    else:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                     initargs=(get_shared_state(),)) as executor:
+                # Submit tất cả tasks
+                future_to_info = {
+                    executor.submit(ocr_single_image, image_path, index): (index, image_path) 
+                    for index, image_path in image_info_list
+                }
             
-            # Collect results khi hoàn thành
-            completed_count = 0
-            for future in as_completed(future_to_info):
-                try:
-                    index, result_text, image_path, success, error_msg = future.result()
+                # Collect results khi hoàn thành
+                completed_count = 0
+                for future in as_completed(future_to_info):
+                    try:
+                        index, result_text, image_path, success, error_msg = future.result()
                     
-                    # Lưu kết quả theo đúng thứ tự
-                    results[index] = {
-                        'index': index,
-                        'image_path': image_path,
-                        'result_text': result_text,
-                        'success': success,
-                        'error_msg': error_msg
-                    }
+                        # Lưu kết quả theo đúng thứ tự
+                        results[index] = {
+                            'index': index,
+                            'image_path': image_path,
+                            'result_text': result_text,
+                            'success': success,
+                            'error_msg': error_msg
+                        }
                     
-                    completed_count += 1
-                    print(f"📊 Tiến độ: {completed_count}/{len(image_paths)} ảnh hoàn thành")
+                        completed_count += 1
+                        print(f"📊 Tiến độ: {completed_count}/{len(image_paths)} ảnh hoàn thành")
                     
-                except Exception as e:
-                    # Lấy thông tin từ future_to_info nếu có lỗi
-                    info = future_to_info[future]
-                    index, image_path = info
-                    results[index] = {
-                        'index': index,
-                        'image_path': image_path,
-                        'result_text': None,
-                        'success': False,
-                        'error_msg': f"Lỗi future: {str(e)}"
-                    }
-                    completed_count += 1
-                    print(f"❌ Lỗi xử lý ảnh {image_path}: {str(e)}")
+                    except Exception as e:
+                        # Lấy thông tin từ future_to_info nếu có lỗi
+                        info = future_to_info[future]
+                        index, image_path = info
+                        results[index] = {
+                            'index': index,
+                            'image_path': image_path,
+                            'result_text': None,
+                            'success': False,
+                            'error_msg': f"Lỗi future: {str(e)}"
+                        }
+                        completed_count += 1
+                        print(f"❌ Lỗi xử lý ảnh {image_path}: {str(e)}")
     
-    except Exception as e:
-        print(f"❌ Lỗi nghiêm trọng trong multiprocessing: {str(e)}")
-        return []
+        except Exception as e:
+            print(f"❌ Lỗi nghiêm trọng trong multiprocessing: {str(e)}")
+            return []
     
     end_time = time.time()
     total_time = end_time - start_time
@@ -940,11 +1332,19 @@ def process_multiple_files_mathpix(file_paths, max_workers=None):
     pdf_count = sum(1 for f in file_paths if os.path.splitext(f)[1].lower() == '.pdf')
     docx_count = sum(1 for f in file_paths if os.path.splitext(f)[1].lower() == '.docx')
     
+    use_async = app_config.execution_mode == "async"
+    if use_async and not ASYNC_HTTP_SUPPORT:
+        print("⚠️ Chế độ async cho Mathpix cần aiohttp (pip install aiohttp), chuyển sang multiprocessing")
+        use_async = False
+    
     # Xác định số workers
     if max_workers is None:
         max_workers = min(len(file_paths), mp.cpu_count())
     
-    print(f"🚀 Bắt đầu xử lý {len(file_paths)} file với Mathpix API ({max_workers} processes)")
+    if use_async:
+        print(f"🚀 Bắt đầu xử lý {len(file_paths)} file với Mathpix API (asyncio, {app_config.max_concurrency} request đồng thời)")
+    else:
+        print(f"🚀 Bắt đầu xử lý {len(file_paths)} file với Mathpix API ({max_workers} processes)")
     print(f"   📷 Ảnh: {image_count}")
     print(f"   📄 PDF: {pdf_count}")
     print(f"   📄 DOCX: {docx_count}")
@@ -957,55 +1357,117 @@ def process_multiple_files_mathpix(file_paths, max_workers=None):
     
     start_time = time.time()
     
-    try:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            # Submit tất cả tasks
-            future_to_info = {
-                executor.submit(process_single_file_mathpix, info): info 
-                for info in file_info_list
+    # Nhiều ảnh nhỏ -> gộp thành job PDF Mathpix thay vì mỗi ảnh một request
+    pack_info_list = []
+    if app_config.mathpix_pack_images:
+        image_info_list = [info for info in file_info_list
+                           if os.path.splitext(info[1])[1].lower() not in ['.pdf', '.docx']
+                           and app_config.mathpix.is_supported_image(info[1])]
+        if should_pack([path for _, path in image_info_list]):
+            pack_info_list = image_info_list
+    if pack_info_list:
+        pack_indexes = {index for index, _ in pack_info_list}
+        file_info_list = [info for info in file_info_list if info[0] not in pack_indexes]
+        packed_results = ocr_images_mathpix_packed([path for _, path in pack_info_list])
+        for local_index, result_text, file_path, success, error_msg in packed_results:
+            index = pack_info_list[local_index][0]
+            results[index] = {
+                'index': index,
+                'image_path': file_path,  # Keep key name for compatibility
+                'result_text': result_text,
+                'success': success,
+                'error_msg': error_msg
+            }
+        print(f"📊 Tiến độ: {len(pack_info_list)}/{len(file_paths)} file hoàn thành (ảnh gộp PDF)")
+    
+    if use_async:
+        async_results = ocr_files_mathpix_async([path for _, path in file_info_list])
+        for local_index, result_text, file_path, success, error_msg in async_results:
+            index = file_info_list[local_index][0]
+            results[index] = {
+                'index': index,
+                'image_path': file_path,  # Keep key name for compatibility
+                'result_text': result_text,
+                'success': success,
+                'error_msg': error_msg
             }
+    else:
+        # PDF/DOCX chủ yếu là chờ Mathpix xử lý -> một poller asyncio trong process chính
+        # theo dõi tất cả job, không chiếm mỗi job một process
+        if ASYNC_HTTP_SUPPORT:
+            doc_info_list = [info for info in file_info_list
+                             if os.path.splitext(info[1])[1].lower() in ['.pdf', '.docx']]
+        else:
+            doc_info_list = []
+        doc_indexes = {index for index, _ in doc_info_list}
+        process_info_list = [info for info in file_info_list if info[0] not in doc_indexes]
+        
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                     initargs=(get_shared_state(),)) as executor:
+                # Submit tất cả tasks
+                future_to_info = {
+                    executor.submit(process_single_file_mathpix, info): info 
+                    for info in process_info_list
+                }
             
-            # Collect results khi hoàn thành
-            completed_count = 0
-            for future in as_completed(future_to_info):
-                try:
-                    index, result_text, file_path, success, error_msg = future.result()
+                # Collect results khi hoàn thành
+                completed_count = 0
+                
+                # Document chạy song song với ảnh đang xử lý trong pool
+                if doc_info_list:
+                    doc_results = ocr_files_mathpix_async([path for _, path in doc_info_list])
+                    for local_index, result_text, file_path, success, error_msg in doc_results:
+                        index = doc_info_list[local_index][0]
+                        results[index] = {
+                            'index': index,
+                            'image_path': file_path,  # Keep key name for compatibility
+                            'result_text': result_text,
+                            'success': success,
+                            'error_msg': error_msg
+                        }
+                        completed_count += 1
+                    print(f"📊 Tiến độ: {completed_count}/{len(file_paths)} file hoàn thành (PDF/DOCX)")
+                
+                for future in as_completed(future_to_info):
+                    try:
+                        index, result_text, file_path, success, error_msg = future.result()
                     
-                    # Lưu kết quả theo đúng thứ tự
-                    results[index] = {
-                        'index': index,
-                        'image_path': file_path,  # Keep key name for compatibility
-                        'result_text': result_text,
-                        'success': success,
-                        'error_msg': error_msg
-                    }
+                        # Lưu kết quả theo đúng thứ tự
+                        results[index] = {
+                            'index': index,
+                            'image_path': file_path,  # Keep key name for compatibility
+                            'result_text': result_text,
+                            'success': success,
+                            'error_msg': error_msg
+                        }
                     
-                    completed_count += 1
-                    if file_path.endswith('.pdf'):
-                        file_type = "PDF"
-                    elif file_path.endswith('.docx'):
-                        file_type = "DOCX"
-                    else:
-                        file_type = "Image"
-                    print(f"📊 Tiến độ: {completed_count}/{len(file_paths)} file hoàn thành ({file_type})")
+                        completed_count += 1
+                        if file_path.endswith('.pdf'):
+                            file_type = "PDF"
+                        elif file_path.endswith('.docx'):
+                            file_type = "DOCX"
+                        else:
+                            file_type = "Image"
+                        print(f"📊 Tiến độ: {completed_count}/{len(file_paths)} file hoàn thành ({file_type})")
                     
-                except Exception as e:
-                    # Lấy thông tin từ future_to_info nếu có lỗi
-                    info = future_to_info[future]
-                    index, file_path = info
-                    results[index] = {
-                        'index': index,
-                        'image_path': file_path,
-                        'result_text': None,
-                        'success': False,
-                        'error_msg': f"Lỗi future: {str(e)}"
-                    }
-                    completed_count += 1
-                    print(f"❌ Lỗi xử lý file {file_path}: {str(e)}")
+                    except Exception as e:
+                        # Lấy thông tin từ future_to_info nếu có lỗi
+                        info = future_to_info[future]
+                        index, file_path = info
+                        results[index] = {
+                            'index': index,
+                            'image_path': file_path,
+                            'result_text': None,
+                            'success': False,
+                            'error_msg': f"Lỗi future: {str(e)}"
+                        }
+                        completed_count += 1
+                        print(f"❌ Lỗi xử lý file {file_path}: {str(e)}")
     
-    except Exception as e:
-        print(f"❌ Lỗi nghiêm trọng trong multiprocessing: {str(e)}")
-        return []
+        except Exception as e:
+            print(f"❌ Lỗi nghiêm trọng trong multiprocessing: {str(e)}")
+            return []
     
     end_time = time.time()
     total_time = end_time - start_time
@@ -1278,11 +1740,16 @@ def single_file_mode_vertex_ai(file_path):
         result = ocr_single_image(file_path, index=None, show_result=True)
 
     if result and result[1]:  # result[1] là success flag
-        # Áp dụng mapping
-        final_content = post_process_with_mapping(result[0], os.path.basename(file_path), "Vertex AI")
+        output_file = None
+        if file_path.endswith('.docx') and app_config.md2json_fused_mapping:
+            output_file = save_fused_result_to_markdown(result[0], file_path, app_config.output_folder, "Vertex AI")
         
-        # Lưu kết quả
-        output_file = save_ocr_result_to_markdown(final_content, file_path, app_config.output_folder)
+        if not output_file:
+            # Áp dụng mapping
+            final_content = post_process_with_mapping(result[0], os.path.basename(file_path), "Vertex AI")
+            
+            # Lưu kết quả
+            output_file = save_ocr_result_to_markdown(final_content, file_path, app_config.output_folder)
         
         if output_file:
             print(f"💾 Đã lưu kết quả vào: {os.path.basename(output_file)}")
@@ -1310,15 +1777,21 @@ def single_file_mode_mathpix(file_path):
         result = ocr_single_image_mathpix(file_path, index=None, show_result=True)
 
     if result and result[1]:  # result[1] là success flag
-        # Áp dụng mapping nếu user muốn
-        final_content = post_process_with_mapping(result[0], os.path.basename(file_path), "Mathpix API")
-        
-        # Lưu kết quả sử dụng function mới
-        output_file = save_single_result_to_markdown_mathpix(
-            final_content,  # result_text đã được mapping
-            file_path,  # file_path
-            app_config.output_folder
-        )
+        output_file = None
+        if file_path.endswith('.docx') and app_config.md2json_fused_mapping:
+            output_file = save_fused_result_to_markdown(result[0], file_path, app_config.output_folder,
+                                                        "Mathpix API", prefix="mathpix_result")
+        
+        if not output_file:
+            # Áp dụng mapping nếu user muốn
+            final_content = post_process_with_mapping(result[0], os.path.basename(file_path), "Mathpix API")
+            
+            # Lưu kết quả sử dụng function mới
+            output_file = save_single_result_to_markdown_mathpix(
+                final_content,  # result_text đã được mapping
+                file_path,  # file_path
+                app_config.output_folder
+            )
         
         if output_file:
             print(f"💾 Đã lưu kết quả vào: {os.path.basename(output_file)}")
@@ -1391,6 +1864,41 @@ def save_individual_results(results, output_folder):
     
     print(f"💾 Đã lưu {successful_count} file kết quả riêng lẻ")
 
+def save_fused_result_to_markdown(content, file_path, output_folder, mode_name, prefix="ocr_result"):
+    """
+    DOCX/Markdown: một lần gọi AI từ markdown thô sang JSON (câu hỏi đã ghép lời giải),
+    file .md đã mapping được suy ra từ JSON thay vì gọi AI mapping riêng
+    Args:
+        content: markdown chưa mapping
+        file_path: file input gốc
+        output_folder: thư mục output
+        mode_name: tên mode (đặt tên file mapping)
+        prefix: tiền tố tên file .md
+    Returns:
+        đường dẫn file .md hoặc None nếu thất bại (caller chạy lại pipeline mapping → JSON)
+    """
+    try:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_file = os.path.join(output_folder, f"{prefix}_{timestamp}.md")
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(content)
+        
+        print(f"\n⚡ MAPPING + JSON TRONG MỘT LẦN GỌI AI ({mode_name})")
+        if not convert_md_to_json_final(output_file, fused=True):
+            print("↩️ Chuyển sang pipeline mapping → JSON")
+            os.remove(output_file)
+            return None
+        
+        with open(output_file, "r", encoding="utf-8") as f:
+            save_mapping_result(f.read(), os.path.basename(file_path), mode_name)
+        print(f"✅ Hoàn thành pipeline: MD → JSON (đã mapping)")
+        return output_file
+        
+    except Exception as e:
+        print(f"❌ Lỗi trong pipeline một lần gọi AI: {e}")
+        traceback.print_exc()
+        return None
+
 def save_ocr_result_to_markdown(result_text, image_path, output_folder):
     """Lưu kết quả OCR thành file markdown và chuyển đổi sang JSON"""
     try:
@@ -1458,23 +1966,32 @@ def multiple_pdfs_mode_vertex_ai(pdf_paths, max_workers):
     
     start_time = time.time()
     
-    # Xử lý tuần tự từng PDF (vì mỗi PDF đã multiprocessing internally)
+    # OCR tất cả trang của tất cả PDF qua một hàng đợi chung
+    ocr_results = ocr_documents_vertex_ai(pdf_paths, max_workers)
+    
     combined_results = []
     successful_count = 0
     failed_files = []
     
+    # Gửi mapping của tất cả file vào hàng đợi trước để chạy chồng lên nhau
+    mapping_futures = {
+        i: submit_mapping(result[1], os.path.basename(pdf_paths[i]))
+        for i, result in enumerate(ocr_results)
+        if result[3] and result[1]
+    }
+    
     for i, pdf_path in enumerate(pdf_paths):
         filename = os.path.basename(pdf_path)
-        print(f"\n📄 [{i+1}/{len(pdf_paths)}] Đang xử lý: {filename}")
+        print(f"\n📄 [{i+1}/{len(pdf_paths)}] Mapping & lưu: {filename}")
         
-        # Gọi function xử lý PDF đơn lẻ (có multiprocessing cho các trang)
-        result = ocr_single_pdf_vertex_ai(pdf_path, index=i, show_result=False)
+        result = ocr_results[i]
         
-        if result[1] and result[1]:  # success và có result_text
+        if result[3] and result[1]:  # success và có result_text
             successful_count += 1
             
             # Áp dụng mapping cho từng file
-            mapped_content = post_process_with_mapping(result[1], filename, "Vertex AI")
+            mapped_content = post_process_with_mapping(result[1], filename, "Vertex AI",
+                                                       future=mapping_futures.get(i))
             combined_results.append(f"# {filename}\n\n{mapped_content}")
             
             # Lưu file riêng lẻ với pipeline đầy đủ (MD → JSON)
@@ -1484,7 +2001,7 @@ def multiple_pdfs_mode_vertex_ai(pdf_paths, max_workers):
             else:
                 print(f"⚠️ [File {i+1}] Lỗi lưu {filename}")
         else:
-            error_msg = result[2] if len(result) > 2 else "Unknown error"
+            error_msg = result[4] or "Unknown error"
             failed_files.append((filename, error_msg))
             print(f"❌ [File {i+1}] Lỗi {filename}: {error_msg}")
     
@@ -1559,13 +2076,29 @@ def save_mapping_result(mapped_content, input_filename, mode_name):
         print(f"⚠️ Lỗi khi lưu kết quả mapping: {str(e)}")
         return None
 
-def post_process_with_mapping(content, input_filename, mode_name):
+def submit_mapping(content, input_filename):
+    """
+    Đưa nội dung OCR vào hàng đợi mapping dùng chung (không chờ kết quả)
+    Returns:
+        Future nhận MappingResult hoặc None nếu model mapping không khả dụng
+    """
+    try:
+        service = get_mapper_service()
+        if not service.ready:
+            return None
+        return service.submit(content, input_filename)
+    except Exception as e:
+        print(f"❌ Lỗi khi gửi yêu cầu mapping: {e}")
+        return None
+
+def post_process_with_mapping(content, input_filename, mode_name, future=None):
     """
     Xử lý nội dung sau OCR để mapping câu hỏi với lời giải
     Args:
         content: Nội dung OCR đã xử lý
         input_filename: Tên file input gốc
         mode_name: Tên mode (để ghi trong output)
+        future: Future từ submit_mapping nếu đã gửi trước (mapping nhiều file chồng lên nhau)
     Returns:
         str: Nội dung đã được mapping (nếu có) hoặc nội dung gốc
     """
@@ -1574,23 +2107,19 @@ def post_process_with_mapping(content, input_filename, mode_name):
         print("━" * 50)
         print(f"🤖 Tự động mapping câu hỏi với lời giải bằng AI ({mode_name})")
         
-        # Khởi tạo mapper
-        print("🔄 Khởi tạo AI mapper...")
-        mapper = QuestionAnswerMapper()
+        # Mapper dùng chung trong process (model đã warm), chỉ khởi tạo ở lần đầu
+        if future is None:
+            print(f"🤖 Đang gửi {len(content):,} ký tự cho AI...")
+            future = submit_mapping(content, input_filename)
         
-        if not mapper.model:
+        if future is None:
             print("❌ Không thể khởi tạo AI model cho mapping")
             print("⏭️ Tiếp tục với nội dung OCR gốc")
             return content
         
-        # Gửi trực tiếp nội dung cho AI để xử lý
-        print(f"🤖 Đang gửi {len(content):,} ký tự cho AI...")
-        start_time = datetime.now()
-        
-        mapped_content = mapper.process_content(content)
-        
-        end_time = datetime.now()
-        processing_time = (end_time - start_time).total_seconds()
+        result = future.result()
+        mapped_content = result.content
+        processing_time = result.total_seconds
         
         if mapped_content:
             print(f"✅ Mapping thành công! ({processing_time:.2f}s)")
@@ -1613,6 +2142,7 @@ def post_process_with_mapping(content, input_filename, mode_name):
 def main():
     # Hiển thị thông tin cấu hình
     app_config.get_config_summary()
+    check_docx_support()
     print()
     
     # Lấy tất cả file ảnh, PDF và DOCX trong thư mục input
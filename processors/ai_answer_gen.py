@@ -3,11 +3,12 @@ import re
 from typing import List, Dict, Any
 from config.response_schema import AI_ANSWER_GEN
 import vertexai
-from vertexai.generative_models import  GenerativeModel,Tool,FunctionDeclaration 
+from vertexai.generative_models import Tool, FunctionDeclaration
 from vertexai.generative_models._generative_models import ToolConfig
 
 import copy
 from config.vertex_ai_config import vertex_ai_config 
+from config.rate_limiter import vertex_limiter, estimate_tokens, call_with_retry
 TYPE_ANSWER_DATA = [
     { "id": 0, "text": 'Trắc nghiệm 1 đáp án', "disabled": False },
     { "id": 1, "text": 'Trắc nghiệm nhiều đáp án có thể là dạng đúng sai', "disabled": False },
@@ -109,8 +110,10 @@ def giai_cau_hoi_bang_ai(json_input) :
     data=json_input
 
     # Cấu hình model với function calling
-    model = GenerativeModel(
+    # Model có tools được cache theo process, không tạo lại mỗi lần gọi
+    model = vertex_ai_config.get_model(
         "gemini-2.5-pro",
+        cache_key="tools:giai_cau_hoi",
         tools=[Tool(function_declarations=[
             FunctionDeclaration(
                 name="giai_cau_hoi",
@@ -119,6 +122,9 @@ def giai_cau_hoi_bang_ai(json_input) :
             )
         ])]
     )
+    if model is None:
+        print("Lỗi: Không thể khởi tạo model giải câu hỏi.")
+        return data
 
    
     tool_config = ToolConfig(
@@ -152,7 +158,9 @@ def giai_cau_hoi_bang_ai(json_input) :
                     
                     # Gọi API
                     print("promt cho ai ",prompt)
-                    response = model.generate_content(prompt, tool_config=tool_config)
+                    response = call_with_retry(
+                        lambda: model.generate_content(prompt, tool_config=tool_config),
+                        vertex_limiter, tokens=estimate_tokens(prompt), label="ai-answer-gen")
                     
                     # Xử lý và cập nhật kết quả
                     try:
@@ -188,7 +196,9 @@ def giai_cau_hoi_bang_ai(json_input) :
                 {json.dumps(clean_question_json, indent=2, ensure_ascii=False)}
                 """
                 print("promt cho ai ",prompt)
-                response = model.generate_content(prompt, tool_config=tool_config)
+                response = call_with_retry(
+                    lambda: model.generate_content(prompt, tool_config=tool_config),
+                    vertex_limiter, tokens=estimate_tokens(prompt), label="ai-answer-gen")
                 
                 try:
                     args = response.candidates[0].content.parts[0].function_call.args
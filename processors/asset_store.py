@@ -0,0 +1,128 @@
+"""
+Asset Store - Kho ảnh đánh địa chỉ theo nội dung (sha256) dùng chung cho toàn bộ pipeline
+
+Ảnh từ md2json, diagram crop từ Mathpix line_data và media pandoc đều được lưu tại
+<root>/<ab>/<cd>/<sha256>.<ext>:
+- Ảnh giống nhau (trong một tài liệu hoặc giữa các tài liệu) chỉ lưu một lần
+- Không đụng tên file giữa các lần chạy song song (tên = hash nội dung)
+- JSON output tham chiếu ảnh bằng hash + URL thay vì nhúng base64
+"""
+import os
+import hashlib
+import threading
+from pathlib import Path
+
+from config.app_config import app_config
+
+_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+    "image/bmp": ".bmp",
+    "image/tiff": ".tiff",
+}
+
+
+class Asset:
+    """Một file trong asset store"""
+
+    def __init__(self, digest, path, url, mime_type, size):
+        self.digest = digest
+        self.path = path
+        self.url = url
+        self.mime_type = mime_type
+        self.size = size
+
+    @property
+    def ref(self):
+        """Tham chiếu theo nội dung, vd. sha256:ab12..."""
+        return f"sha256:{self.digest}"
+
+    def to_dict(self):
+        return {"hash": self.ref, "url": self.url, "path": self.path,
+                "mimeType": self.mime_type, "size": self.size}
+
+
+class AssetStore:
+    """Lưu bytes theo sha256, ghi atomic (tmp + rename) nên an toàn giữa thread/process"""
+
+    def __init__(self, root, base_url=None, enabled=True):
+        """
+        Args:
+            root: thư mục gốc của store
+            base_url: URL public trỏ tới root (None -> dùng file:// URI)
+            enabled: False -> các nguồn ảnh giữ cách lưu cũ (thư mục theo tên)
+        """
+        self.root = os.path.abspath(root)
+        self.base_url = (base_url or "").rstrip("/") or None
+        self.enabled = enabled
+
+    @staticmethod
+    def extension_for(mime_type=None, name=None):
+        """Extension theo mime type, hoặc theo tên file gốc"""
+        if mime_type in _EXTENSIONS:
+            return _EXTENSIONS[mime_type]
+        ext = os.path.splitext(name or "")[1].lower()
+        return ".jpg" if ext == ".jpeg" else (ext or ".bin")
+
+    def _relative_path(self, digest, ext):
+        return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+    def _asset(self, digest, ext, mime_type, size):
+        rel = self._relative_path(digest, ext)
+        path = os.path.join(self.root, *rel.split("/"))
+        url = f"{self.base_url}/{rel}" if self.base_url else Path(path).as_uri()
+        return Asset(digest, path, url, mime_type, size)
+
+    def put_bytes(self, data, mime_type=None, name=None):
+        """
+        Lưu bytes vào store (bỏ qua nếu đã có)
+        Args:
+            data: nội dung file
+            mime_type: mime type (quyết định extension)
+            name: tên/đường dẫn gốc, dùng lấy extension khi không có mime type
+        Returns:
+            Asset
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        asset = self._asset(digest, self.extension_for(mime_type, name), mime_type, len(data))
+        if not os.path.exists(asset.path):
+            os.makedirs(os.path.dirname(asset.path), exist_ok=True)
+            tmp_path = f"{asset.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, asset.path)
+        return asset
+
+    def put_file(self, file_path, mime_type=None, remove=False):
+        """Nhập một file vào store; remove=True xóa file gốc sau khi nhập"""
+        with open(file_path, "rb") as f:
+            asset = self.put_bytes(f.read(), mime_type, name=file_path)
+        if remove:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        return asset
+
+    def import_tree(self, directory, remove=True):
+        """
+        Nhập mọi file trong thư mục (vd. media pandoc) vào store
+        Returns:
+            dict đường dẫn file gốc -> Asset
+        """
+        imported = {}
+        for path in sorted(Path(directory).rglob("*")):
+            if path.is_file():
+                imported[str(path)] = self.put_file(str(path), remove=remove)
+        return imported
+
+
+# Instance global dùng chung
+asset_store = AssetStore(
+    root=app_config.asset_store_folder,
+    base_url=app_config.asset_base_url,
+    enabled=app_config.asset_store_enabled
+)
@@ -0,0 +1,380 @@
+"""
+Async OCR Engine - Chạy OCR bằng asyncio cho các API bị giới hạn bởi network latency
+
+Một process nhẹ giữ được hàng chục request đồng thời (Vertex AI generate_content_async,
+Mathpix /v3/text và /v3/pdf qua aiohttp) thay vì mỗi request chiếm một process.
+Số request đồng thời cấu hình qua OCR_MAX_CONCURRENCY, độc lập với số CPU.
+"""
+import os
+import json
+import asyncio
+
+from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
+
+from config.app_config import app_config
+from config.rate_limiter import (vertex_limiter, mathpix_limiter, Backoff, classify_error,
+                                 estimate_tokens, max_retry_attempts, response_status)
+from processors.ocr_cache import ocr_cache, digest_bytes, is_cacheable
+from processors.page_image import load_page
+from processors.mathpix_poller import MathpixPDFPoller
+from processors.pdf_chunker import PDF_SPLIT_SUPPORT, count_pdf_pages, plan_page_chunks, split_pdf_chunks
+from processors.payload_optimizer import payload_optimizer, rescale_line_data
+
+try:
+    import aiohttp
+    ASYNC_HTTP_SUPPORT = True
+except ImportError:
+    ASYNC_HTTP_SUPPORT = False
+
+
+def _read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+class AsyncOCREngine:
+    """Engine OCR asyncio với giới hạn số request đồng thời"""
+
+    def __init__(self, max_concurrency=None, max_retries=None):
+        self.max_concurrency = max_concurrency or app_config.max_concurrency
+        self.max_retries = max_retries or max_retry_attempts()
+        self.vertex_ai = app_config.vertex_ai
+        self.mathpix = app_config.mathpix
+
+        self._semaphore = None
+        self._session = None
+        self._inflight = {}
+        self._vertex_model = None
+        self.pdf_poller = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if ASYNC_HTTP_SUPPORT:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=None, connect=30, sock_read=180)
+            )
+        # Một poller cho tất cả PDF job đang chờ Mathpix xử lý
+        self.pdf_poller = MathpixPDFPoller(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.pdf_poller is not None:
+            await self.pdf_poller.close()
+            self.pdf_poller = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._vertex_model = None
+
+    def _require_http(self):
+        if self._session is None:
+            raise RuntimeError("Chế độ async cho Mathpix cần aiohttp. Cài đặt: pip install aiohttp")
+
+    # ------------------------------------------------------------------
+    # Cache + single-flight trong event loop
+    # ------------------------------------------------------------------
+    async def _cached(self, key, compute):
+        """
+        Trả về (value, from_cache). compute là coroutine function, chỉ chạy một lần
+        cho mỗi key; các task khác cùng key chờ chung kết quả
+        """
+        cached = await asyncio.to_thread(ocr_cache.get, key)
+        if cached is not None:
+            return cached, True
+
+        task = self._inflight.get(key)
+        if task is not None:
+            # Dùng chung kết quả của task đang chạy; chỉ coi là cache khi task thành công
+            value = await task
+            return value, is_cacheable(value)
+
+        task = asyncio.ensure_future(compute())
+        self._inflight[key] = task
+        try:
+            value = await task
+        finally:
+            self._inflight.pop(key, None)
+
+        if is_cacheable(value):
+            await asyncio.to_thread(ocr_cache.put, key, value)
+        return value, False
+
+    # ------------------------------------------------------------------
+    # Vertex AI
+    # ------------------------------------------------------------------
+    def _get_vertex_model(self):
+        """
+        GenerativeModel riêng của engine: transport async gắn với event loop đang chạy,
+        nên không dùng model cache của process (run_async tạo event loop mới mỗi batch)
+        """
+        if self._vertex_model is None and self.vertex_ai.initialize_vertex_ai():
+            self._vertex_model = GenerativeModel(self.vertex_ai.model_name)
+        return self._vertex_model
+
+    async def ocr_image_vertex(self, image_path, prompt, generation_params):
+        """
+        OCR một ảnh bằng Vertex AI (generate_content_async)
+        Args:
+            image_path: đường dẫn ảnh hoặc PageImage (trang render trong RAM)
+            prompt: prompt OCR
+            generation_params: dict generation config
+        Returns:
+            tuple (result_text hoặc None, from_cache)
+        """
+        page = await asyncio.to_thread(load_page, image_path)
+        image_bytes = page.data
+        key = ocr_cache.build_key(
+            digest_bytes(image_bytes),
+            engine="vertex_ai",
+            model_name=self.vertex_ai.model_name,
+            generation_config=generation_params,
+            prompt=prompt,
+            upload_profile=payload_optimizer.profile
+        )
+
+        async def compute():
+            model = self._get_vertex_model()
+            if model is None:
+                return None
+
+            upload_page, _ = await asyncio.to_thread(payload_optimizer.optimize, page)
+            prompt_parts = [Part.from_text(prompt),
+                            Part.from_data(data=upload_page.data, mime_type=upload_page.mime_type)]
+            generation_config = GenerationConfig(**generation_params)
+            name = page.name
+            backoff = Backoff()
+            request_tokens = estimate_tokens(prompt, images=1)
+
+            for attempt in range(self.max_retries):
+                try:
+                    await vertex_limiter.acquire_async(request_tokens)
+                    async with self._semaphore:
+                        response = await model.generate_content_async(
+                            prompt_parts,
+                            generation_config=generation_config
+                        )
+                    usage = getattr(response, "usage_metadata", None)
+                    vertex_limiter.charge(getattr(usage, "candidates_token_count", 0) or 0)
+                    if response and response.text:
+                        return response.text
+                    print(f"⚠️ [{name}] Lần thử {attempt + 1}: Không nhận được kết quả từ Vertex AI")
+                    delay = backoff.next_delay()
+                except Exception as api_error:
+                    print(f"⚠️ [{name}] Lần thử {attempt + 1}: Lỗi API - {str(api_error)}")
+                    retryable, status, retry_after = classify_error(api_error)
+                    if not retryable:
+                        return None
+                    delay = vertex_limiter.retry_delay(backoff, status, retry_after)
+
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(delay)
+            return None
+
+        return await self._cached(key, compute)
+
+    # ------------------------------------------------------------------
+    # Mathpix
+    # ------------------------------------------------------------------
+    async def _mathpix_request(self, method, url, handle, form_factory=None):
+        """
+        Gửi request Mathpix qua rate limiter, retry 429/5xx/lỗi mạng với backoff
+        Args:
+            method: "GET" hoặc "POST"
+            url: URL endpoint
+            handle: coroutine function(response) -> kết quả (gọi cho response cuối cùng)
+            form_factory: hàm tạo FormData mới cho mỗi lần thử (FormData chỉ gửi được một lần)
+        """
+        self._require_http()
+        backoff = Backoff()
+
+        for attempt in range(self.max_retries):
+            last_attempt = attempt == self.max_retries - 1
+            await mathpix_limiter.acquire_async()
+            try:
+                async with self._semaphore:
+                    async with self._session.request(method, url, headers=self.mathpix.get_headers(),
+                                                     data=form_factory() if form_factory else None) as response:
+                        retryable, status, retry_after = response_status(response)
+                        if not retryable or last_attempt:
+                            return await handle(response)
+                print(f"⚠️ Mathpix HTTP {status} (lần thử {attempt + 1})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+                status, retry_after = None, None
+                print(f"⚠️ Lỗi kết nối Mathpix (lần thử {attempt + 1}): {str(e)}")
+
+            await asyncio.sleep(mathpix_limiter.retry_delay(backoff, status, retry_after))
+
+    async def ocr_image_mathpix(self, image_path, options=None):
+        """
+        OCR một ảnh (đường dẫn hoặc PageImage) bằng Mathpix /v3/text
+        Returns:
+            tuple (dict kết quả hoặc None, from_cache)
+        """
+        self._require_http()
+        page = await asyncio.to_thread(load_page, image_path)
+        key = ocr_cache.build_key(digest_bytes(page.data), engine="mathpix", prompt=options,
+                                  upload_profile=payload_optimizer.profile)
+
+        async def compute():
+            upload_page, scale = await asyncio.to_thread(payload_optimizer.optimize, page)
+            options_json = json.dumps(self.mathpix.build_image_options(options))
+
+            def build_form():
+                form = aiohttp.FormData()
+                form.add_field("file", upload_page.data, filename=upload_page.name,
+                               content_type=upload_page.mime_type)
+                form.add_field("options_json", options_json)
+                return form
+
+            async def handle(response):
+                if response.status == 200:
+                    # Tọa độ line_data quy đổi về ảnh gốc (để crop diagram đúng vị trí)
+                    return rescale_line_data(await response.json(), scale)
+                print(f"❌ Lỗi API Mathpix: {response.status} - {await response.text()}")
+                return None
+
+            return await self._mathpix_request("POST", self.mathpix.get_image_url(), handle, build_form)
+
+        return await self._cached(key, compute)
+
+    async def upload_pdf_mathpix(self, document_path, options=None, file_bytes=None):
+        """
+        Upload PDF/DOCX lên Mathpix /v3/pdf, trả về pdf_id hoặc None
+        Args:
+            file_bytes: nội dung file đã có trong RAM (vd. cụm trang tách từ PDF lớn)
+        """
+        self._require_http()
+        if file_bytes is None:
+            file_bytes = await asyncio.to_thread(_read_file, document_path)
+        options_json = json.dumps(self.mathpix.build_pdf_options(options))
+
+        def build_form():
+            form = aiohttp.FormData()
+            form.add_field("file", file_bytes, filename=os.path.basename(document_path))
+            form.add_field("options_json", options_json)
+            return form
+
+        async def handle(response):
+            if response.status != 200:
+                print(f"❌ Lỗi upload: {response.status} - {await response.text()}")
+                return None
+            return await response.json()
+
+        result = await self._mathpix_request("POST", self.mathpix.get_upload_url(), handle, build_form)
+        if not result:
+            return None
+
+        for key in ("pdf_id", "id", "document_id", "file_id", "processing_id"):
+            if result.get(key):
+                return result[key]
+        print(f"❌ Không tìm thấy Document ID trong response! Keys: {list(result.keys())}")
+        return None
+
+    async def check_pdf_status_mathpix(self, pdf_id):
+        """Lấy trạng thái xử lý PDF trên Mathpix, trả về dict hoặc None"""
+        async def handle(response):
+            if response.status == 200:
+                return await response.json()
+            print(f"❌ Lỗi check status: {response.status}")
+            return None
+
+        return await self._mathpix_request("GET", self.mathpix.get_status_url(pdf_id), handle)
+
+    async def download_pdf_result_mathpix(self, pdf_id, format_type="md"):
+        """Download kết quả text của PDF đã xử lý xong, trả về str hoặc None"""
+        async def handle(response):
+            if response.status == 200:
+                return await response.text()
+            print(f"❌ Lỗi download: {response.status} - {await response.text()}")
+            return None
+
+        return await self._mathpix_request("GET", self.mathpix.get_download_url(pdf_id, format_type), handle)
+
+    async def process_pdf_mathpix(self, document_path, options=None, timeout=120, file_bytes=None, name=None):
+        """
+        Xử lý document hoàn chỉnh qua Mathpix: upload -> chờ -> download (không chiếm process khi chờ).
+        Trạng thái được theo dõi bởi poller dùng chung (interval thích ứng), download bởi worker của poller
+        Returns:
+            text content hoặc None nếu lỗi
+        """
+        name = name or os.path.basename(document_path)
+        pdf_id = await self.upload_pdf_mathpix(document_path, options, file_bytes=file_bytes)
+        if not pdf_id:
+            return None
+
+        print(f"⏳ [{name}] Đã upload, chờ xử lý ({self.pdf_poller.pending + 1} job đang chờ)")
+        return await self.pdf_poller.wait(pdf_id, name, timeout)
+
+
+    async def process_pdf_mathpix_chunked(self, document_path, chunk_pages=None, options=None,
+                                          timeout=120, chunk_retries=None):
+        """
+        Chia PDF lớn thành các cụm chunk_pages trang, xử lý các cụm song song trên Mathpix
+        và ghép kết quả theo thứ tự trang. Cụm lỗi được retry riêng
+        Args:
+            document_path: đường dẫn PDF
+            chunk_pages: số trang mỗi cụm (mặc định MATHPIX_PDF_CHUNK_PAGES, 0 = không chia)
+            options: options cho /v3/pdf
+            timeout: thời gian chờ tối đa cho mỗi cụm (giây)
+            chunk_retries: số lần retry một cụm lỗi (mặc định MATHPIX_CHUNK_RETRIES)
+        Returns:
+            text content hoặc None nếu tất cả các cụm đều lỗi
+        """
+        chunk_pages = app_config.mathpix_pdf_chunk_pages if chunk_pages is None else chunk_pages
+        chunk_retries = app_config.mathpix_chunk_retries if chunk_retries is None else chunk_retries
+        name = os.path.basename(document_path)
+
+        page_count = await asyncio.to_thread(count_pdf_pages, document_path) if chunk_pages else None
+        if not page_count or page_count <= chunk_pages:
+            return await self.process_pdf_mathpix(document_path, options, timeout=timeout)
+
+        chunks = plan_page_chunks(page_count, chunk_pages)
+        print(f"✂️ [{name}] Chia {page_count} trang thành {len(chunks)} cụm ({chunk_pages} trang/cụm)")
+
+        # Tách local mọi cụm trong một thread (PdfReader không thread-safe) -> chỉ upload các trang của cụm
+        split_chunks = None
+        if PDF_SPLIT_SUPPORT:
+            split_chunks = await asyncio.to_thread(split_pdf_chunks, document_path, chunks)
+
+        async def process_chunk(chunk_index, first, last):
+            chunk_name = f"{name} [trang {first}-{last}]"
+            if split_chunks is not None:
+                chunk_bytes = split_chunks[chunk_index]
+                chunk_options = options
+            else:
+                chunk_bytes = None
+                chunk_options = dict(options or {}, page_ranges=f"{first}-{last}")
+
+            for attempt in range(chunk_retries + 1):
+                result_text = await self.process_pdf_mathpix(
+                    document_path, chunk_options, timeout=timeout, file_bytes=chunk_bytes, name=chunk_name
+                )
+                if result_text:
+                    return result_text
+                if attempt < chunk_retries:
+                    print(f"🔁 [{chunk_name}] Retry cụm lỗi ({attempt + 1}/{chunk_retries})")
+            return None
+
+        chunk_texts = await asyncio.gather(*(process_chunk(i, first, last)
+                                             for i, (first, last) in enumerate(chunks)))
+
+        successful = sum(1 for text in chunk_texts if text)
+        if not successful:
+            return None
+
+        parts = []
+        for (first, last), text in zip(chunks, chunk_texts):
+            if text:
+                parts.append(text.strip())
+            else:
+                parts.append(f"❌ Lỗi xử lý Mathpix (trang {first}-{last})")
+        print(f"✅ [{name}] Ghép {successful}/{len(chunks)} cụm thành công")
+        return "\n\n".join(parts)
+
+
+def run_async(coro):
+    """Chạy coroutine từ code đồng bộ"""
+    return asyncio.run(coro)
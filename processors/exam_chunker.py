@@ -0,0 +1,222 @@
+"""
+Exam Chunker - Chia nội dung đề thi theo ranh giới phần / câu hỏi để gọi AI song song
+
+- split_markdown_sections: chia theo phần (md2json), phần quá dài chia tiếp theo câu hỏi
+- plan_mapping_chunks: chia theo câu hỏi cho QuestionAnswerMapper, lời giải nằm ở phần
+  "Lời giải"/"Đáp án" cuối đề được định tuyến về đoạn chứa câu hỏi tương ứng
+"""
+import re
+from bisect import bisect_left
+
+from config.rate_limiter import estimate_tokens
+
+# Đầu một phần của đề: "**Phần I**", "## PHẦN 2", "Part II", ... (group 1 = số phần)
+SECTION_HEADING_PATTERN = re.compile(
+    r"^[ \t>#*_]*(?:PHẦN|Phần|PART|Part)\s+([IVXLC]+|\d+)\b", re.MULTILINE
+)
+_ROMAN_VALUES = {"I": 1, "V": 5, "X": 10, "L": 50, "C": 100}
+# Các dòng tiêu đề phần ở đầu một đoạn (tiêu đề phần lặp lại trong khối lời giải)
+_LEADING_SECTION_LINES = re.compile(
+    r"\A(?:[ \t]*\n|[ \t>#*_]*(?:PHẦN|Phần|PART|Part)\s+(?:[IVXLC]+|\d+)\b[^\n]*(?:\n|\Z))+"
+)
+# Đầu một câu hỏi: "Câu 1", "**Câu 12.**", "Question 3"
+QUESTION_HEADING_PATTERN = re.compile(r"^[ \t>#*_]*(?:Câu|CÂU|Question)\s+(\d+)", re.MULTILINE)
+# Tiêu đề đáp án / lời giải: "ĐÁP ÁN", "Lời giải", "HƯỚNG DẪN GIẢI CHI TIẾT", "ĐÁP ÁN VÀ HƯỚNG DẪN GIẢI"...
+# (cũng khớp dòng "Lời giải" ngay dưới từng câu - dùng find_answer_section để lấy phần tách riêng cuối đề)
+ANSWER_SECTION_PATTERN = re.compile(
+    r"^[ \t>#*_]*(?:BẢNG[ \t]+)?(?:ĐÁP ÁN|LỜI GIẢI|HƯỚNG DẪN(?:[ \t]+GIẢI)?)"
+    r"(?:[ \t]+(?:VÀ|CHI TIẾT|THAM KHẢO|ĐÁP ÁN|LỜI GIẢI|HƯỚNG DẪN|GIẢI|&|-))*[ \t*_:.]*$",
+    re.MULTILINE | re.IGNORECASE
+)
+
+
+def split_at(text, pattern):
+    """Cắt text tại đầu mỗi dòng khớp pattern (phần trước match đầu tiên gộp vào đoạn đầu)"""
+    starts = [m.start() for m in pattern.finditer(text)]
+    if not starts:
+        return [text]
+    starts[0] = 0
+    return [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)])]
+
+
+def split_markdown_sections(markdown_content, max_chars):
+    """
+    Chia markdown theo ranh giới phần của đề, phần quá dài được chia tiếp tại ranh giới câu hỏi
+    Args:
+        markdown_content: markdown đã thay ảnh bằng placeholder
+        max_chars: số ký tự tối đa mỗi đoạn (0 = không giới hạn)
+    Returns:
+        list tuple (section_no, chunk_text): các đoạn cùng section_no thuộc cùng một phần
+    """
+    chunks = []
+    for section_no, section in enumerate(split_at(markdown_content, SECTION_HEADING_PATTERN)):
+        if not max_chars or len(section) <= max_chars:
+            chunks.append((section_no, section))
+            continue
+
+        match = SECTION_HEADING_PATTERN.search(section)
+        heading = section[match.start():].split("\n", 1)[0] if match else ""
+        current = ""
+        for question in split_at(section, QUESTION_HEADING_PATTERN):
+            if current and len(current) + len(question) > max_chars:
+                chunks.append((section_no, current))
+                # Đoạn tiếp theo mang lại tiêu đề phần để model giữ ngữ cảnh
+                current = f"{heading}\n" if heading else ""
+            current += question
+        if current.strip():
+            chunks.append((section_no, current))
+    return chunks
+
+
+def section_number(label):
+    """Số thứ tự của nhãn phần: "II" -> 2, "3" -> 3"""
+    if label.isdigit():
+        return int(label)
+    values = [_ROMAN_VALUES[char] for char in label.upper()]
+    return sum(-value if value < following else value
+               for value, following in zip(values, values[1:] + [0]))
+
+
+def find_answer_section(content):
+    """
+    Vị trí bắt đầu phần lời giải/đáp án tách riêng ở cuối đề
+    Chỉ nhận tiêu đề mà sau nó không còn câu hỏi mới (bảng đáp án), hoặc đề được đánh số lại từ đầu:
+    - có tiêu đề phần trước câu tiếp theo: số phần quay về phần đầu tiên của đề ("PHẦN I" lặp lại)
+    - không có tiêu đề phần: số câu quay lại (Câu 1 sau Câu 40)
+    Dòng "Lời giải" ngay dưới một câu hỏi (câu tiếp theo vẫn tăng số, hoặc sang phần kế tiếp)
+    nghĩa là lời giải nằm tại chỗ -> None
+    Returns:
+        offset hoặc None nếu lời giải nằm ngay dưới từng câu / không có phần lời giải
+    """
+    questions = [(m.start(), int(m.group(1))) for m in QUESTION_HEADING_PATTERN.finditer(content)]
+    if not questions:
+        return None
+    starts = [start for start, _ in questions]
+    first_section = SECTION_HEADING_PATTERN.search(content)
+
+    for match in ANSWER_SECTION_PATTERN.finditer(content, questions[0][0] + 1):
+        i = bisect_left(starts, match.start())
+        if i == len(questions):
+            return match.start()
+        previous_number = questions[i - 1][1]
+        next_start, next_number = questions[i]
+        section = SECTION_HEADING_PATTERN.search(content, match.end(), next_start)
+        if section is None:
+            if next_number <= previous_number:
+                return match.start()
+        elif (first_section.start() < match.start()
+              and section_number(section.group(1)) <= section_number(first_section.group(1))):
+            return match.start()
+        # Tiêu đề lời giải nằm giữa các câu hỏi: lời giải viết ngay dưới từng câu
+        return None
+    return None
+
+
+def _question_units(text, restart_sections):
+    """
+    Chia text thành các đơn vị câu hỏi
+    Args:
+        restart_sections: coi số câu lùi lại (Câu 1 sau Câu 18) là sang phần mới
+                          (phần lời giải thường không lặp lại tiêu đề phần)
+    Returns:
+        list [section_ordinal, number, text]; phần mở đầu dính vào câu đầu tiên,
+        text không có câu hỏi nào trả về một đơn vị với number None
+    """
+    boundaries = sorted(
+        [(m.start(), "section", None) for m in SECTION_HEADING_PATTERN.finditer(text)] +
+        [(m.start(), "question", int(m.group(1))) for m in QUESTION_HEADING_PATTERN.finditer(text)]
+    )
+    units = []
+    section = 0
+    previous = 0
+    pending_start = 0
+    seen_question = False
+    for i, (start, kind, number) in enumerate(boundaries):
+        end = boundaries[i + 1][0] if i + 1 < len(boundaries) else len(text)
+        if kind == "section":
+            if seen_question:
+                section += 1
+                previous = 0
+            continue
+        if restart_sections and seen_question and number <= previous:
+            section += 1
+        # Tiêu đề phần / phần mở đầu dính vào câu hỏi ngay sau nó
+        units.append([section, number, text[pending_start:end]])
+        pending_start = end
+        previous = number
+        seen_question = True
+
+    if not units:
+        return [[0, None, text]] if text.strip() else []
+    units[-1][2] += text[pending_start:]
+    return units
+
+
+def plan_mapping_chunks(content, max_tokens):
+    """
+    Chia nội dung cho QuestionAnswerMapper thành các đoạn giới hạn token tại ranh giới câu hỏi
+    Lời giải trong phần "Lời giải"/"Đáp án" cuối đề được gắn vào ngay sau câu hỏi tương ứng,
+    nên mỗi đoạn tự chứa đủ câu hỏi + lời giải của nó
+    Args:
+        content: nội dung .md (OCR)
+        max_tokens: số token ước lượng tối đa mỗi đoạn
+    Returns:
+        list chuỗi nội dung theo thứ tự tài liệu (1 phần tử nếu không cần chia)
+    """
+    if not max_tokens or estimate_tokens(content) <= max_tokens:
+        return [content]
+
+    answer_start = find_answer_section(content)
+    question_text = content if answer_start is None else content[:answer_start]
+    answer_text = "" if answer_start is None else content[answer_start:]
+
+    units = _question_units(question_text, restart_sections=False)
+    if len(units) <= 1:
+        return [content]
+
+    by_key = {(section, number): i for i, (section, number, _) in enumerate(units) if number is not None}
+    numbers = [number for _, number, _ in units if number is not None]
+    by_number = {number: i for i, (_, number, _) in enumerate(units)
+                 if number is not None and numbers.count(number) == 1}
+
+    # Bỏ dòng tiêu đề "Lời giải"/"Đáp án" của phần cuối, mỗi lời giải được gắn nhãn lại cạnh câu hỏi
+    first_answer = QUESTION_HEADING_PATTERN.search(answer_text)
+    if answer_text:
+        heading_end = answer_text.find("\n") + 1 or len(answer_text)
+        preamble = answer_text[heading_end:first_answer.start()] if first_answer else ""
+        if not first_answer or SECTION_HEADING_PATTERN.sub("", preamble).strip(" \t\n*_:.>#"):
+            # Bảng đáp án không theo "Câu N" (vd. 1A 2B 3C...) hoặc có nội dung trước lời giải
+            # đầu tiên (ngoài tiêu đề phần) -> không định tuyến chắc chắn được, gửi nguyên văn
+            return [content]
+        # Giữ tiêu đề phần lặp lại để _question_units đếm phần của lời giải
+        answer_text = answer_text[heading_end:]
+
+    answer_units = _question_units(answer_text, restart_sections=True)
+    # Định tuyến lời giải theo (phần trong khối lời giải, số câu); chỉ khi khối lời giải không chia
+    # phần (một dãy số câu) mới được dò theo số câu, và chỉ với số câu duy nhất trong đề
+    single_section = all(section == 0 for section, _, _ in answer_units)
+    answers = [[] for _ in units]
+    for section, number, text in answer_units:
+        target = by_key.get((section, number))
+        if target is None and single_section:
+            target = by_number.get(number)
+        if target is None:
+            # Lời giải không xác định được câu hỏi -> không chia, tránh đặt sai chỗ
+            return [content]
+        answers[target].append(_LEADING_SECTION_LINES.sub("", text))
+
+    chunks = []
+    current = ""
+    for (_, _, text), unit_answers in zip(units, answers):
+        piece = text
+        if unit_answers:
+            if not piece.endswith("\n"):
+                piece += "\n"
+            piece += "Lời giải\n" + "".join(unit_answers)
+        if current and estimate_tokens(current + piece) > max_tokens:
+            chunks.append(current)
+            current = ""
+        current += piece
+    if current.strip():
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,211 @@
+"""
+Image Fetcher - Tải ảnh (URL / file local) song song, có cache HTTP trên đĩa
+
+- Session requests dùng chung (keep-alive pool) thay vì requests.get từng ảnh
+- Pool thread giới hạn số tải đồng thời
+- Cache trên đĩa theo URL: còn hạn (Cache-Control max-age) thì dùng luôn,
+  hết hạn thì revalidate bằng ETag / Last-Modified (304 -> dùng lại bản cũ)
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config.app_config import app_config
+
+
+def is_remote(path_or_url):
+    return path_or_url.lower().startswith(("http://", "https://"))
+
+
+def source_key(path_or_url):
+    """Khóa de-duplicate: URL giữ nguyên, đường dẫn local chuẩn hóa tuyệt đối"""
+    path_or_url = path_or_url.strip()
+    if is_remote(path_or_url):
+        return path_or_url
+    return os.path.normcase(os.path.abspath(path_or_url))
+
+
+def _max_age(headers):
+    """Đọc max-age từ Cache-Control (no-store/no-cache -> 0)"""
+    cache_control = (headers.get("Cache-Control") or "").lower()
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "max-age":
+            try:
+                return max(0, int(value))
+            except ValueError:
+                return 0
+    return 0
+
+
+class ImageFetcher:
+    """Tải ảnh với session pool, cache HTTP trên đĩa và tải song song"""
+
+    def __init__(self, cache_dir, max_workers=8, timeout=20, cache_enabled=True):
+        """
+        Args:
+            cache_dir: thư mục cache HTTP
+            max_workers: số ảnh tải đồng thời
+            timeout: timeout đọc mỗi request (giây)
+            cache_enabled: tắt cache trên đĩa nếu False
+        """
+        self.cache_dir = cache_dir
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.cache_enabled = cache_enabled
+
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    def get_session(self):
+        """requests.Session dùng chung trong process hiện tại (tạo lại sau fork)"""
+        if self._session is not None and self._session_pid == os.getpid():
+            return self._session
+
+        with self._session_lock:
+            if self._session is None or self._session_pid != os.getpid():
+                adapter = HTTPAdapter(
+                    pool_connections=8,
+                    pool_maxsize=self.max_workers,
+                    max_retries=Retry(total=2, connect=2, read=2, status=0, backoff_factor=0.3,
+                                      allowed_methods=frozenset({"GET"}), raise_on_status=False)
+                )
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+                self._session_pid = os.getpid()
+        return self._session
+
+    # ------------------------------------------------------------------
+    # Cache HTTP trên đĩa
+    # ------------------------------------------------------------------
+    def _cache_paths(self, url):
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, digest[:2], digest)
+        return base + ".bin", base + ".json"
+
+    def _read_cache(self, url):
+        if not self.cache_enabled:
+            return None, None
+        body_path, meta_path = self._cache_paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                return f.read(), meta
+        except (OSError, ValueError):
+            return None, None
+
+    def _write_cache(self, url, body, meta):
+        if not self.cache_enabled:
+            return
+        body_path, meta_path = self._cache_paths(url)
+        try:
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            if body is not None:
+                tmp_path = f"{body_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(body)
+                os.replace(tmp_path, body_path)
+            tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+        except OSError as e:
+            print(f"  ⚠️ Không ghi được cache ảnh: {e}")
+
+    # ------------------------------------------------------------------
+    # Tải
+    # ------------------------------------------------------------------
+    def fetch_url(self, url):
+        """
+        Tải ảnh từ URL qua cache HTTP
+        Returns:
+            tuple (bytes, content_type hoặc None)
+        Raises:
+            requests.exceptions.RequestException
+        """
+        body, meta = self._read_cache(url)
+        now = time.time()
+        if body is not None and meta.get("expires", 0) > now:
+            print(f"  ♻️ Dùng ảnh từ cache: {url}")
+            return body, meta.get("content_type")
+
+        headers = {}
+        if body is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        print(f"  Đang tải từ URL {url}...")
+        response = self.get_session().get(url, headers=headers, timeout=(10, self.timeout))
+
+        if response.status_code == 304 and body is not None:
+            meta["expires"] = now + _max_age(response.headers)
+            self._write_cache(url, None, meta)
+            return body, meta.get("content_type")
+
+        response.raise_for_status()
+        content_type = (response.headers.get("Content-Type") or "").split(";")[0].strip() or None
+        self._write_cache(url, response.content, {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_type": content_type,
+            "expires": now + _max_age(response.headers),
+        })
+        return response.content, content_type
+
+    @staticmethod
+    def fetch_file(file_path):
+        """Đọc ảnh từ file local -> (bytes, None)"""
+        print(f"  Đang đọc từ đường dẫn file {file_path}...")
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"Tệp không tồn tại tại '{file_path}'")
+        with open(file_path, "rb") as image_file:
+            return image_file.read(), None
+
+    def fetch(self, path_or_url):
+        """Tải một ảnh (URL hoặc file local) -> (bytes, content_type hoặc None)"""
+        if is_remote(path_or_url):
+            return self.fetch_url(path_or_url)
+        return self.fetch_file(path_or_url)
+
+    def fetch_many(self, sources):
+        """
+        Tải nhiều ảnh song song (mỗi nguồn một lần)
+        Returns:
+            dict nguồn -> (bytes, content_type) hoặc Exception nếu lỗi
+        """
+        unique = list(dict.fromkeys(sources))
+
+        def fetch_one(source):
+            try:
+                return self.fetch(source)
+            except (requests.exceptions.RequestException, IOError) as e:
+                return e
+
+        workers = min(self.max_workers, len(unique)) or 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-fetch") as executor:
+            return dict(zip(unique, executor.map(fetch_one, unique)))
+
+
+# Instance global dùng trong md2json
+image_fetcher = ImageFetcher(
+    cache_dir=app_config.image_http_cache_folder,
+    max_workers=app_config.image_fetch_workers,
+    timeout=app_config.image_fetch_timeout,
+    cache_enabled=app_config.image_http_cache_enabled
+)
@@ -0,0 +1,186 @@
+"""
+Image Packer - Gộp nhiều ảnh nhỏ thành một job PDF Mathpix
+
+Thư mục ảnh chụp điện thoại (mỗi ảnh một câu hỏi) tốn một request /v3/text cho mỗi ảnh,
+overhead mỗi request lớn hơn thời gian OCR. Gộp K ảnh thành PDF nhiều trang, upload một lần
+qua upload_pdf rồi tách kết quả .lines.json theo trang về lại từng ảnh gốc
+(kể cả tọa độ line_data để crop diagram).
+"""
+import io
+import os
+import math
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from config.app_config import app_config
+from processors.page_image import PageImage
+from processors.payload_optimizer import payload_optimizer
+
+# Mô hình chi phí ước lượng (giây) cho heuristic
+IMAGE_REQUEST_SECONDS = 2.0      # Một request /v3/text
+PDF_JOB_OVERHEAD_SECONDS = 10.0  # Upload + xếp hàng + poll + download một job PDF
+PDF_PAGE_SECONDS = 0.5           # Thời gian xử lý thêm cho mỗi trang trong job
+
+
+def should_pack(image_paths, concurrency=None, min_images=None, max_image_kb=None):
+    """
+    Heuristic: gộp ảnh thành PDF khi có đủ nhiều ảnh nhỏ và tổng thời gian ước lượng
+    (hoặc số request tiêu tốn quota) của cách gộp tốt hơn gọi từng ảnh
+    Args:
+        image_paths: list đường dẫn ảnh
+        concurrency: số request /v3/text đồng thời có thể chạy
+        min_images: số ảnh tối thiểu để cân nhắc gộp
+        max_image_kb: ảnh lớn hơn ngưỡng này không được coi là "nhỏ"
+    Returns:
+        bool
+    """
+    min_images = min_images or app_config.mathpix_pack_min_images
+    max_image_kb = max_image_kb or app_config.mathpix_pack_max_image_kb
+    concurrency = max(1, concurrency or app_config.max_concurrency)
+
+    if len(image_paths) < min_images:
+        return False
+
+    sizes = [os.path.getsize(path) for path in image_paths if os.path.exists(path)]
+    if not sizes or sum(sizes) / len(sizes) > max_image_kb * 1024:
+        return False
+
+    pack_size = app_config.mathpix_pack_size
+    count = len(sizes)
+    per_image_seconds = math.ceil(count / concurrency) * IMAGE_REQUEST_SECONDS
+    packs = math.ceil(count / pack_size)
+    # Các job PDF chạy song song, job dài nhất quyết định
+    packed_seconds = PDF_JOB_OVERHEAD_SECONDS + min(pack_size, count) * PDF_PAGE_SECONDS
+
+    # Giảm request (quota RPM) là lợi ích chính; không gộp nếu chậm hơn quá nhiều
+    return packs * 4 <= count and packed_seconds <= per_image_seconds * 2
+
+
+def build_packed_pdf(image_paths):
+    """
+    Ghép ảnh thành một PDF nhiều trang (mỗi ảnh một trang, 1 pixel = 1 point)
+    Returns:
+        tuple (pdf_bytes, list kích thước gốc (w, h) của từng ảnh)
+    """
+    pages = []
+    original_sizes = []
+    for path in image_paths:
+        page = PageImage.from_file(path)
+        with Image.open(io.BytesIO(page.data)) as original:
+            original_sizes.append(original.size)
+
+        # Giới hạn kích thước/dung lượng từng trang như khi upload ảnh lẻ
+        upload_page, _ = payload_optimizer.optimize(page)
+        image = Image.open(io.BytesIO(upload_page.data))
+        pages.append(image.convert("RGB"))
+
+    buffer = io.BytesIO()
+    pages[0].save(buffer, "PDF", save_all=True, append_images=pages[1:], resolution=72.0)
+    for image in pages:
+        image.close()
+    return buffer.getvalue(), original_sizes
+
+
+def _page_to_image_result(text, lines, original_size, page_size):
+    """
+    Chuyển kết quả một trang (.lines.json) thành dạng kết quả /v3/text của ảnh gốc:
+    tọa độ cnt được quy đổi từ không gian trang về pixel của ảnh gốc
+    """
+    orig_w, orig_h = original_size
+    page_w, page_h = page_size
+    scale_x = orig_w / page_w if page_w else 1.0
+    scale_y = orig_h / page_h if page_h else 1.0
+
+    line_data = []
+    for line in lines or []:
+        mapped = dict(line)
+        cnt = line.get("cnt")
+        if cnt:
+            mapped["cnt"] = [[p[0] * scale_x, p[1] * scale_y] for p in cnt
+                             if isinstance(p, (list, tuple)) and len(p) == 2]
+        line_data.append(mapped)
+
+    return {
+        "text": text,
+        "line_data": line_data,
+        "image_width": orig_w,
+        "image_height": orig_h,
+        "packed": True,
+    }
+
+
+def _ocr_pack(mathpix, image_paths, options, timeout):
+    """OCR một cụm ảnh qua một job PDF, trả về list kết quả theo thứ tự (None nếu trang lỗi)"""
+    pdf_bytes, original_sizes = build_packed_pdf(image_paths)
+
+    fd, pdf_path = tempfile.mkstemp(prefix="qprocess_pack_", suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf_bytes)
+
+        upload_result = mathpix.upload_pdf(pdf_path, options)
+        if not upload_result or not upload_result.get("pdf_id"):
+            return [None] * len(image_paths)
+        pdf_id = upload_result["pdf_id"]
+    finally:
+        try:
+            os.remove(pdf_path)
+        except OSError:
+            pass
+
+    if not mathpix.wait_for_pdf(pdf_id, timeout=timeout):
+        return [None] * len(image_paths)
+
+    results = [None] * len(image_paths)
+    for page_no, text, lines, page_size in mathpix.download_pdf_lines(pdf_id, with_page_size=True):
+        idx = page_no - 1
+        if 0 <= idx < len(image_paths) and text:
+            results[idx] = _page_to_image_result(text, lines, original_sizes[idx], page_size)
+    return results
+
+
+def ocr_images_packed(image_paths, options=None, pack_size=None, timeout=300, max_workers=None,
+                      image_options=None):
+    """
+    OCR nhiều ảnh bằng cách gộp mỗi pack_size ảnh thành một job PDF Mathpix
+    Ảnh không có kết quả trong job (trang lỗi/job lỗi) được OCR lại từng ảnh qua /v3/text
+    Args:
+        image_paths: list đường dẫn ảnh
+        options: options cho /v3/pdf
+        image_options: options /v3/text cho ảnh OCR lại từng ảnh (line_data, diagram...)
+        pack_size: số ảnh mỗi PDF (mặc định MATHPIX_PACK_SIZE)
+        timeout: thời gian chờ tối đa mỗi job (giây)
+        max_workers: số job PDF chạy song song
+    Returns:
+        list dict kết quả kiểu /v3/text (text, line_data) hoặc None, theo thứ tự input;
+        kết quả lấy từ job PDF có "packed": True
+    """
+    mathpix = app_config.mathpix
+    pack_size = pack_size or app_config.mathpix_pack_size
+    packs = [image_paths[i:i + pack_size] for i in range(0, len(image_paths), pack_size)]
+    print(f"📦 Gộp {len(image_paths)} ảnh thành {len(packs)} job PDF ({pack_size} ảnh/job)")
+
+    max_workers = max(1, min(max_workers or len(packs), mathpix.pool_size))
+    def run_pack(pack):
+        try:
+            return _ocr_pack(mathpix, pack, options, timeout)
+        except Exception as e:
+            print(f"❌ Lỗi job PDF gộp ảnh: {str(e)}")
+            return [None] * len(pack)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mathpix-pack") as executor:
+        pack_results = list(executor.map(run_pack, packs))
+
+    results = [result for pack in pack_results for result in pack]
+
+    # Fallback từng ảnh cho trang lỗi
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        print(f"🔁 {len(missing)} ảnh không có kết quả trong job PDF, OCR lại từng ảnh")
+        retry = mathpix.batch_ocr_images([image_paths[i] for i in missing], image_options)
+        for i, item in zip(missing, retry):
+            results[i] = item["result"]
+
+    return results
@@ -1,6 +1,26 @@
-import os, json, re
+import os, io, json
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image, ImageDraw
 
+from config.app_config import app_config
+from processors.asset_store import asset_store
+
+_IMAGE_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+def guess_image_mime_type(image_path, default="image/png"):
+    """Xác định mime type của ảnh theo extension (mặc định image/png)"""
+    ext = os.path.splitext(image_path)[1].lower()
+    return _IMAGE_MIME_TYPES.get(ext, default)
+
 def _clamp_bbox(bbox, w, h):
     l, t, r, b = bbox
     l = max(0, min(int(l), w))
@@ -11,10 +31,68 @@ def _clamp_bbox(bbox, w, h):
     if b <= t: b = min(h, t + 1)
     return (l, t, r, b)
 
+def _polygon_points(poly):
+    """Lọc các điểm [x, y] hợp lệ của cnt -> mảng float (n, 2)"""
+    points = [p[:2] for p in poly if isinstance(p, (list, tuple)) and len(p) == 2]
+    try:
+        return np.asarray(points, dtype=float).reshape(-1, 2)
+    except (TypeError, ValueError):
+        return np.empty((0, 2))
+
+def _diagram_region(poly, w, h):
+    """
+    Tính bbox và polygon (tọa độ nguyên, nằm trong ảnh) của một diagram
+    Returns:
+        tuple (bbox, polygon) - polygon None nếu không đủ 3 điểm (crop theo bbox)
+        hoặc None nếu cnt không có điểm hợp lệ
+    """
+    points = _polygon_points(poly)
+    if not len(points):
+        return None
+
+    # Ép int & lọc điểm nằm trong ảnh (vector hóa)
+    rounded = np.rint(points).astype(np.int64)
+    inside = ((rounded[:, 0] >= 0) & (rounded[:, 0] <= w) &
+              (rounded[:, 1] >= 0) & (rounded[:, 1] <= h))
+    valid = rounded[inside]
+
+    if len(valid) < 3:
+        # Polygon không đủ điểm -> fallback bbox từ min/max
+        (l, t), (r, b) = points.min(axis=0), points.max(axis=0)
+        return _clamp_bbox((l, t, r, b), w, h), None
+
+    (l, t), (r, b) = valid.min(axis=0), valid.max(axis=0)
+    return _clamp_bbox((l, t, r, b), w, h), [tuple(p) for p in valid.tolist()]
+
+def _render_diagram(img, bbox, polygon):
+    """
+    Cắt vùng diagram; ngoài polygon (trong bbox) được tô nền trắng.
+    Mask chỉ có kích thước bbox thay vì cả trang.
+    """
+    region = img.crop(bbox)
+    if polygon is None:
+        return region
+
+    l, t = bbox[0], bbox[1]
+    mask = Image.new("L", region.size, 0)
+    ImageDraw.Draw(mask).polygon([(x - l, y - t) for x, y in polygon], fill=255, outline=255)
+    background = Image.new("RGB", region.size, (255, 255, 255))
+    return Image.composite(region, background, mask)
+
+def _diagram_save_options():
+    """Format / extension / tham số encoder cho ảnh diagram (DIAGRAM_* trong .env)"""
+    fmt = app_config.diagram_format
+    if fmt in ("jpeg", "jpg"):
+        return "JPEG", ".jpg", {"quality": app_config.diagram_jpeg_quality, "optimize": app_config.diagram_optimize}
+    if fmt == "webp":
+        return "WEBP", ".webp", {"quality": app_config.diagram_jpeg_quality, "method": 4}
+    return "PNG", ".png", {"optimize": app_config.diagram_optimize,
+                           "compress_level": app_config.diagram_png_compress_level}
+
 def save_diagrams_from_line_data(image_path, result, base_outdir="data/diagrams"):
     """
     Quét result['line_data'] -> crop tất cả vùng type=='diagram' theo polygon `cnt`.
-    Trả về: list[dict] gồm id, path, bbox, polygon.
+    Trả về: list[dict] gồm id, path, bbox, polygon (và hash nếu lưu vào asset store).
     """
     line_data = (result or {}).get("line_data") or []
     diagrams = [ln for ln in line_data if ln.get("type") == "diagram" and ln.get("cnt")]
@@ -22,79 +100,114 @@ def save_diagrams_from_line_data(image_path, result, base_outdir="data/diagrams"
     if not diagrams:
         return []
 
-    # Thư mục lưu theo tên ảnh gốc để đỡ lẫn
-    image_name = os.path.splitext(os.path.basename(image_path))[0]
-    outdir = os.path.join(base_outdir, image_name)
-    os.makedirs(outdir, exist_ok=True)
-
-    img = Image.open(image_path).convert("RGBA")
+    # Decode & convert một lần cho tất cả diagram
+    with Image.open(image_path) as src:
+        img = src.convert("RGB")
     w, h = img.size
-    saved = []
+    fmt, ext, save_kwargs = _diagram_save_options()
+
+    # Không dùng asset store: lưu theo tên ảnh gốc để đỡ lẫn
+    outdir = None
+    if not asset_store.enabled:
+        image_name = os.path.splitext(os.path.basename(image_path))[0]
+        outdir = os.path.join(base_outdir, image_name)
+        os.makedirs(outdir, exist_ok=True)
 
+    jobs = []
+    saved = []
     for idx, d in enumerate(diagrams):
-        poly = d.get("cnt")  # [[x,y], ...]
-        # Ép int & lọc điểm hợp lệ
-        poly_tuples = []
-        for p in poly:
-            try:
-                x, y = int(round(p[0])), int(round(p[1]))
-                if 0 <= x <= w and 0 <= y <= h:
-                    poly_tuples.append((x, y))
-            except Exception:
-                pass
-
-        if len(poly_tuples) < 3:
-            # Polygon không đủ điểm -> fallback bbox từ min/max
-            xs = [p[0] for p in poly if isinstance(p, (list, tuple)) and len(p) == 2]
-            ys = [p[1] for p in poly if isinstance(p, (list, tuple)) and len(p) == 2]
-            if not xs or not ys:
-                continue
-            bbox = _clamp_bbox((min(xs), min(ys), max(xs), max(ys)), w, h)
-            crop = img.crop(bbox).convert("RGB")
-            out_path = os.path.join(outdir, f"diagram_{idx:02d}.png")
-            crop.save(out_path)
-            saved.append({
-                "id": d.get("id"),
-                "path": out_path,
-                "bbox": bbox,
-                "polygon": None
-            })
+        region = _diagram_region(d.get("cnt"), w, h)
+        if region is None:
             continue
-
-        # Bbox gọn để cắt mask
-        xs = [x for x, _ in poly_tuples]
-        ys = [y for _, y in poly_tuples]
-        bbox = _clamp_bbox((min(xs), min(ys), max(xs), max(ys)), w, h)
-
-        # Tạo mask polygon & cắt chính xác
-        mask_full = Image.new("L", (w, h), 0)
-        draw = ImageDraw.Draw(mask_full)
-        draw.polygon(poly_tuples, fill=255, outline=255)
-
-        # Cắt theo bbox để nhẹ
-        mask_crop = mask_full.crop(bbox)
-        region = img.crop(bbox)
-
-        # Áp mask để nền ngoài polygon trong bbox trong suốt, rồi lưu RGB (nền trắng)
-        out_rgba = Image.new("RGBA", region.size)
-        out_rgba.paste(region, (0, 0), mask_crop)
-
-        # Nếu muốn nền trắng:
-        bg = Image.new("RGB", region.size, (255, 255, 255))
-        bg.paste(out_rgba, mask=out_rgba.split()[-1])
-
-        out_path = os.path.join(outdir, f"diagram_{idx:02d}.png")
-        bg.save(out_path, optimize=True)
-
+        bbox, polygon = region
+        jobs.append((idx, bbox, polygon))
         saved.append({
             "id": d.get("id"),
-            "path": out_path,
+            "path": None,
             "bbox": bbox,
-            "polygon": poly_tuples
+            "polygon": polygon
         })
 
+    def encode(job):
+        idx, bbox, polygon = job
+        crop = _render_diagram(img, bbox, polygon)
+        if outdir is not None:
+            out_path = os.path.join(outdir, f"diagram_{idx:02d}{ext}")
+            crop.save(out_path, fmt, **save_kwargs)
+            return out_path, None
+        # Asset store: tên file = sha256 nội dung, không đụng nhau giữa các lần chạy song song
+        buffer = io.BytesIO()
+        crop.save(buffer, fmt, **save_kwargs)
+        asset = asset_store.put_bytes(buffer.getvalue(), mime_type=Image.MIME.get(fmt))
+        return asset.path, asset.ref
+
+    # Encode (zlib/libjpeg nhả GIL) song song trong thread pool
+    workers = max(1, min(app_config.diagram_encode_workers, len(jobs)))
+    if workers == 1:
+        outputs = [encode(job) for job in jobs]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="diagram-encode") as executor:
+            outputs = list(executor.map(encode, jobs))
+
+    for item, (out_path, asset_ref) in zip(saved, outputs):
+        item["path"] = out_path
+        if asset_ref:
+            item["hash"] = asset_ref
+
     return saved
 
+class _SnippetMatcher:
+    """Aho-Corasick: tìm vị trí xuất hiện đầu tiên của nhiều chuỗi trong một lần quét text"""
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pattern in set(patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(pattern)
+        self._patterns = len(set(patterns))
+
+        # Fail link theo BFS; output của node gồm cả output của fail node
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = fail if fail != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def first_occurrences(self, text):
+        """dict pattern -> offset bắt đầu của lần xuất hiện đầu tiên (pattern không có thì bỏ qua)"""
+        found = {}
+        if not self._patterns:
+            return found
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for pattern in out[node]:
+                if pattern not in found:
+                    found[pattern] = i - len(pattern) + 1
+                    if len(found) == self._patterns:
+                        return found
+        return found
+
 def insert_diagrams_into_text(raw_text, result, diagram_files, min_gap_px=8):
     """
     Chèn ảnh diagram (đã crop) vào chuỗi text theo thứ tự đọc.
@@ -146,66 +259,48 @@ def insert_diagrams_into_text(raw_text, result, diagram_files, min_gap_px=8):
     # Chia text hiện có thành các dòng (đơn giản) để tìm vị trí chèn.
     # Mẹo: ta sẽ chèn theo nhóm đoạn (đệm 1 dòng trống trước/sau ảnh).
     lines = raw_text.splitlines()
+    joined = "\n".join(lines)
+
+    # Bảng offset đầu mỗi dòng: offset -> chỉ số dòng bằng bisect
+    line_starts = [0]
+    for line in lines[:-1]:
+        line_starts.append(line_starts[-1] + len(line) + 1)
 
-    # Một index chỉ báo chúng ta đang ở đoạn nào theo chiều dọc.
-    # Tạo mốc theo thứ tự text_nodes.
-    text_order = [{"top": n["top"], "left": n["left"], "text": n["text"]} for n in text_nodes]
-
-    # Map: top của text_node -> (chỉ số dòng “gần nhất” trong raw_text)
-    # Cách đơn giản: khớp đoạn text ngắn (tối đa ~40 ký tự) để tìm vị trí xuất hiện đầu tiên.
-    def find_line_index_for_text(snippet):
-        if not snippet:
-            return None
-        snip = snippet.strip()
-        if not snip:
-            return None
-        # Lấy 30–50 ký tự đầu để tránh trùng quá nhiều
-        probe = snip[:50]
-        # escape regex special
-        pat = re.escape(probe)
-        joined = "\n".join(lines)
-        m = re.search(pat, joined)
-        if not m:
-            return None
-        # Quy đổi offset -> chỉ số dòng
-        upto = joined[:m.start()]
-        line_idx = upto.count("\n")
-        return line_idx
+    # Khớp đoạn text ngắn (30–50 ký tự đầu, tránh trùng quá nhiều) của mọi text node
+    # trong một lần quét -> vị trí xuất hiện đầu tiên
+    probes = [(n["text"] or "").strip()[:50] for n in text_nodes]
+    first_match = _SnippetMatcher([p for p in probes if p]).first_occurrences(joined)
 
+    # Map: top của text_node -> chỉ số dòng “gần nhất” trong raw_text
     text_line_map = []
-    for n in text_order:
-        line_idx = find_line_index_for_text(n["text"])
-        if line_idx is not None:
-            text_line_map.append({"top": n["top"], "line_idx": line_idx})
+    for n, probe in zip(text_nodes, probes):
+        start = first_match.get(probe) if probe else None
+        if start is not None:
+            text_line_map.append((n["top"], bisect_right(line_starts, start) - 1))
 
     # Nếu không khớp được gì, trả nguyên văn
     if not text_line_map:
         return raw_text
 
     # Sắp xếp theo top tăng dần
-    text_line_map.sort(key=lambda x: x["top"])
-
-    # Hàm: tìm vị trí dòng để chèn ảnh dựa trên top của ảnh
-    def find_insert_line_for_diagram(di_top):
-        # tìm text node đầu tiên có top > di_top - min_gap_px
-        for i, m in enumerate(text_line_map):
-            if di_top <= m["top"] + min_gap_px:
-                return m["line_idx"]
-        # nếu ảnh nằm cuối trang: chèn cuối file
-        return len(lines)
-
-    # Chèn lần lượt (đi từ dưới lên để không xô lệch chỉ số dòng)
-    inserts = []
+    text_line_map.sort(key=lambda x: x[0])
+    tops = [top for top, _ in text_line_map]
+
+    # Vị trí dòng để chèn ảnh: text node đầu tiên có top >= top ảnh - min_gap_px;
+    # ảnh nằm cuối trang thì chèn cuối file
+    inserts = {}
     for d in diagram_nodes:
-        insert_at = find_insert_line_for_diagram(d["top"])
-        md_img = f"![]({id2path[d['id']]})"
-        # chèn 1 block trống trước/sau cho sạch
-        block = ["", md_img, ""]
-        inserts.append((insert_at, block))
-
-    # Thực hiện chèn từ insert cuối cùng
-    inserts.sort(key=lambda x: x[0], reverse=True)
-    for pos, block in inserts:
-        lines[pos:pos] = block
-
-    return "\n".join(lines)
\ No newline at end of file
+        i = bisect_left(tops, d["top"] - min_gap_px)
+        insert_at = text_line_map[i][1] if i < len(tops) else len(lines)
+        inserts.setdefault(insert_at, []).append(f"![]({id2path[d['id']]})")
+
+    # Ghép một lần; nhiều ảnh cùng vị trí giữ thứ tự như khi chèn lần lượt từ dưới lên
+    out = []
+    for pos in range(len(lines) + 1):
+        for md_img in reversed(inserts.get(pos, ())):
+            # chèn 1 block trống trước/sau cho sạch
+            out.extend(["", md_img, ""])
+        if pos < len(lines):
+            out.append(lines[pos])
+
+    return "\n".join(out)
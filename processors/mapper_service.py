@@ -0,0 +1,110 @@
+"""
+Mapper Service - QuestionAnswerMapper dùng chung trong process với hàng đợi request
+
+Một mapper (model đã warm) cho cả lần chạy thay vì tạo mới cho mỗi file; nhiều caller
+submit đồng thời vào hàng đợi (thread pool giới hạn), mapping của N tài liệu chạy chồng lên
+nhau. Mỗi request được ghi lại thời gian chờ trong hàng đợi và thời gian gọi AI.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config.app_config import app_config
+from processors.question_answer_mapper import QuestionAnswerMapper
+
+
+class MappingResult:
+    """Kết quả một request mapping kèm latency"""
+
+    def __init__(self, label, content, queue_seconds, run_seconds):
+        self.label = label
+        self.content = content
+        self.queue_seconds = queue_seconds
+        self.run_seconds = run_seconds
+
+    @property
+    def success(self):
+        return bool(self.content)
+
+    @property
+    def total_seconds(self):
+        return self.queue_seconds + self.run_seconds
+
+
+class MapperService:
+    """Hàng đợi mapping câu hỏi - lời giải dùng chung một QuestionAnswerMapper"""
+
+    def __init__(self, max_workers=None):
+        """
+        Args:
+            max_workers: số tài liệu mapping đồng thời (mặc định MAPPER_SERVICE_WORKERS)
+        """
+        self.max_workers = max(1, max_workers or app_config.mapper_service_workers)
+        self.mapper = QuestionAnswerMapper()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mapper-service")
+        self._stats_lock = threading.Lock()
+        self._calls = 0
+        self._failed = 0
+        self._run_seconds = 0.0
+
+    @property
+    def ready(self):
+        """Model đã khởi tạo được"""
+        return self.mapper.model is not None
+
+    def submit(self, content, label=None, on_chunk=None):
+        """
+        Đưa một tài liệu vào hàng đợi mapping
+        Args:
+            content: nội dung .md cần mapping
+            label: tên hiển thị trong log (vd. tên file), cũng là tên file stream
+            on_chunk: callback streaming (xem QuestionAnswerMapper.process_content_rewrite)
+        Returns:
+            Future nhận MappingResult
+        """
+        submitted = time.perf_counter()
+        return self._executor.submit(self._run, content, label or "mapping", submitted, on_chunk)
+
+    def map(self, content, label=None, on_chunk=None):
+        """Mapping đồng bộ (chờ tới lượt trong hàng đợi) -> MappingResult"""
+        return self.submit(content, label, on_chunk).result()
+
+    def _run(self, content, label, submitted, on_chunk=None):
+        started = time.perf_counter()
+        mapped_content = self.mapper.process_content(content, label, on_chunk)
+        finished = time.perf_counter()
+
+        result = MappingResult(label, mapped_content, started - submitted, finished - started)
+        with self._stats_lock:
+            self._calls += 1
+            self._failed += 0 if result.success else 1
+            self._run_seconds += result.run_seconds
+        print(f"⏱️ [Mapper] {label}: chờ {result.queue_seconds:.2f}s, AI {result.run_seconds:.2f}s")
+        return result
+
+    def stats(self):
+        """Thống kê các request đã xử lý"""
+        with self._stats_lock:
+            average = self._run_seconds / self._calls if self._calls else 0.0
+            return {"calls": self._calls, "failed": self._failed, "average_seconds": average}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+_service = None
+_service_pid = None
+_service_lock = threading.Lock()
+
+
+def get_mapper_service():
+    """MapperService dùng chung trong process hiện tại (tạo lazy, tạo lại sau fork)"""
+    global _service, _service_pid
+    if _service is not None and _service_pid == os.getpid():
+        return _service
+    with _service_lock:
+        if _service is None or _service_pid != os.getpid():
+            _service = MapperService()
+            _service_pid = os.getpid()
+    return _service
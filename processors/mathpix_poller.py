@@ -0,0 +1,210 @@
+"""
+Mathpix PDF Poller - Một poller asyncio theo dõi đồng thời nhiều pdf_id
+
+Thay vì mỗi PDF chiếm một process ngủ trong vòng lặp check status 2 giây/lần,
+một task duy nhất poll tất cả job đang chờ với interval thích ứng:
+- Job mới poll nhanh, job chạy lâu giãn dần interval
+- Nếu Mathpix trả percent_done thì ước lượng thời gian còn lại để chọn interval
+Job hoàn thành được đẩy vào hàng đợi download, xử lý bởi một nhóm worker download.
+"""
+import asyncio
+
+from config.app_config import app_config
+
+
+class _PDFJob:
+    """Trạng thái một pdf_id đang chờ"""
+
+    def __init__(self, pdf_id, name, future, deadline, interval, now):
+        self.pdf_id = pdf_id
+        self.name = name
+        self.future = future
+        self.deadline = deadline
+        self.interval = interval
+        self.next_poll = now + interval
+        self.last_percent = None
+        self.last_poll = now
+
+
+class MathpixPDFPoller:
+    """Poller dùng chung cho tất cả PDF job của một AsyncOCREngine"""
+
+    def __init__(self, engine, min_interval=None, max_interval=None, download_workers=None,
+                 formats=("md", "txt")):
+        """
+        Args:
+            engine: AsyncOCREngine (dùng check_pdf_status_mathpix / download_pdf_result_mathpix)
+            min_interval: interval poll nhỏ nhất (giây)
+            max_interval: interval poll lớn nhất (giây)
+            download_workers: số worker download kết quả song song
+            formats: thứ tự format thử khi download
+        """
+        self.engine = engine
+        self.min_interval = min_interval or app_config.mathpix_poll_min_interval
+        self.max_interval = max_interval or app_config.mathpix_poll_max_interval
+        self.download_workers = download_workers or app_config.mathpix_download_workers
+        self.formats = formats
+
+        self._jobs = {}
+        self._wakeup = asyncio.Event()
+        self._downloads = asyncio.Queue()
+        self._poll_task = None
+        self._download_tasks = []
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+    async def wait(self, pdf_id, name=None, timeout=120):
+        """
+        Đăng ký pdf_id và chờ kết quả text
+        Args:
+            pdf_id: ID document đã upload
+            name: tên hiển thị trong log
+            timeout: thời gian chờ xử lý tối đa (giây)
+        Returns:
+            text content hoặc None nếu lỗi/timeout
+        """
+        return await self.submit(pdf_id, name, timeout)
+
+    def submit(self, pdf_id, name=None, timeout=120):
+        """Đăng ký pdf_id, trả về Future nhận text (hoặc None) khi download xong"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        now = loop.time()
+        self._jobs[pdf_id] = _PDFJob(pdf_id, name or pdf_id, future, now + timeout, self.min_interval, now)
+        self._ensure_running()
+        self._wakeup.set()
+        return future
+
+    @property
+    def pending(self):
+        """Số job đang chờ Mathpix xử lý"""
+        return len(self._jobs)
+
+    async def close(self):
+        """Hủy poller và worker download"""
+        tasks = [t for t in [self._poll_task, *self._download_tasks] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._poll_task = None
+        self._download_tasks = []
+        for job in self._jobs.values():
+            if not job.future.done():
+                job.future.set_result(None)
+        self._jobs = {}
+
+    # ------------------------------------------------------------------
+    # Poll loop
+    # ------------------------------------------------------------------
+    def _ensure_running(self):
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.ensure_future(self._poll_loop())
+        if not self._download_tasks:
+            self._download_tasks = [
+                asyncio.ensure_future(self._download_worker())
+                for _ in range(self.download_workers)
+            ]
+
+    async def _poll_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._jobs:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = loop.time()
+            due = [job for job in self._jobs.values() if job.next_poll <= now]
+            if not due:
+                # Ngủ tới job gần nhất hoặc tới khi có job mới
+                sleep_for = min(job.next_poll for job in self._jobs.values()) - now
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, sleep_for))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await asyncio.gather(*(self._poll(job) for job in due))
+
+    async def _poll(self, job):
+        loop = asyncio.get_running_loop()
+        try:
+            status_result = await self.engine.check_pdf_status_mathpix(job.pdf_id)
+        except Exception as e:
+            print(f"⚠️ [{job.name}] Lỗi check status: {str(e)}")
+            status_result = None
+
+        now = loop.time()
+        status = (status_result or {}).get("status", "unknown")
+
+        if status == "completed":
+            self._jobs.pop(job.pdf_id, None)
+            print(f"✅ [{job.name}] Mathpix xử lý xong, đang download...")
+            self._downloads.put_nowait(job)
+            return
+        if status == "error":
+            self._finish(job, None)
+            print(f"❌ [{job.name}] Xử lý thất bại!")
+            return
+        if now >= job.deadline:
+            self._finish(job, None)
+            print(f"⏰ [{job.name}] Timeout!")
+            return
+
+        percent = self._percent_done(status_result)
+        job.interval = self._next_interval(job, percent, now)
+        job.last_percent = percent
+        job.last_poll = now
+        job.next_poll = min(now + job.interval, job.deadline)
+        if percent is not None:
+            print(f"📊 [{job.name}] {status} {percent:.0f}% (poll lại sau {job.interval:.1f}s)")
+
+    @staticmethod
+    def _percent_done(status_result):
+        if not status_result:
+            return None
+        percent = status_result.get("percent_done")
+        if isinstance(percent, (int, float)):
+            return float(percent)
+        total = status_result.get("num_pages")
+        done = status_result.get("num_pages_completed")
+        if isinstance(total, (int, float)) and total and isinstance(done, (int, float)):
+            return 100.0 * done / total
+        return None
+
+    def _next_interval(self, job, percent, now):
+        """
+        Interval thích ứng: có tiến độ thì poll khoảng nửa thời gian còn lại ước lượng,
+        không có thì giãn dần x1.5 (job càng lâu càng poll thưa)
+        """
+        interval = job.interval * 1.5
+        if percent is not None and job.last_percent is not None and percent > job.last_percent:
+            rate = (percent - job.last_percent) / max(1e-6, now - job.last_poll)
+            interval = (100.0 - percent) / rate / 2
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    # ------------------------------------------------------------------
+    # Download workers
+    # ------------------------------------------------------------------
+    async def _download_worker(self):
+        while True:
+            job = await self._downloads.get()
+            result_text = None
+            try:
+                for format_type in self.formats:
+                    result_text = await self.engine.download_pdf_result_mathpix(job.pdf_id, format_type)
+                    if result_text and not result_text.startswith("PK"):  # Không phải binary
+                        break
+                    result_text = None
+            except Exception as e:
+                print(f"❌ [{job.name}] Lỗi download: {str(e)}")
+            finally:
+                self._finish(job, result_text)
+                self._downloads.task_done()
+
+    def _finish(self, job, result_text):
+        self._jobs.pop(job.pdf_id, None)
+        if not job.future.done():
+            job.future.set_result(result_text)
@@ -2,41 +2,34 @@ import re
 import json
 import os
 import base64
-from typing import Dict, Tuple, Optional, Union, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple, Optional, Any
 # --- CÁC IMPORT CẦN THIẾT ---
 from vertexai.preview.generative_models import GenerativeModel, Part, GenerationConfig
 import requests
 # Import cấu hình và schema của bạn
 from config.vertex_ai_config import vertex_ai_config 
+from config.app_config import app_config
+from config.rate_limiter import vertex_limiter, estimate_tokens, call_with_retry
 from config.response_schema import ARRAY_BASED_SCHEMA
-from data.prompt.prompts import MD2JSON
+from data.prompt.prompts import MD2JSON, MD2JSON_FUSED
 from processors.ai_answer_gen import giai_cau_hoi_bang_ai
+from processors.image_fetcher import image_fetcher, source_key
+from processors.asset_store import asset_store
+from processors.exam_chunker import split_markdown_sections, find_answer_section
+from processors.stream_output import StreamSink, stream_path, generate_streaming
 
-def deep_replace_placeholders(data_structure: Union[Dict, list, str, Any], 
-                            replacement_mapping: Dict[str, str]) -> Union[Dict, list, str, Any]:
+def compile_placeholder_pattern(replacement_mapping: Dict[str, str]) -> Tuple[Any, str]:
     """
-    Duyệt đệ quy qua cấu trúc dữ liệu và thay thế các placeholder bằng giá trị 
-    tương ứng từ mapping (trong trường hợp này là thẻ <img> Base64).
+    Biên dịch một regex duy nhất khớp mọi placeholder trong mapping.
 
-    Args:
-        data_structure: Dict hoặc List cần được xử lý.
-        replacement_mapping: Dictionary map từ placeholder sang giá trị thay thế.
-    
     Returns:
-        Cấu trúc dữ liệu đã được cập nhật.
-    """
-    if isinstance(data_structure, dict):
-        return {key: deep_replace_placeholders(value, replacement_mapping) for key, value in data_structure.items()}
-    elif isinstance(data_structure, list):
-        return [deep_replace_placeholders(item, replacement_mapping) for item in data_structure]
-    elif isinstance(data_structure, str):
-        processed_string = data_structure
-        # Logic thay thế đã được tổng quát hóa
-        for placeholder, replacement_value in replacement_mapping.items():
-            processed_string = processed_string.replace(placeholder, replacement_value)
-        return processed_string
-    else:
-        return data_structure
+        Tuple (pattern, prefix): prefix chung của các placeholder (vd. "[IMAGE_")
+        dùng để bỏ qua nhanh các chuỗi không chứa placeholder.
+    """
+    placeholders = sorted(replacement_mapping, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(placeholder) for placeholder in placeholders))
+    return pattern, os.path.commonprefix(placeholders)
 
 
 def validate_vertex_ai_config() -> bool:
@@ -101,30 +94,24 @@ def extract_image_urls(markdown_content: str) -> Tuple[str, Dict[str, str]]:
         Tuple[str, Dict[str, str]]: (markdown_đã_sửa, mapping_placeholder_to_url)
     """
     image_url_mapping = {} 
+    # Cùng URL/đường dẫn (vd. logo lặp lại mỗi trang) dùng chung một placeholder
+    placeholder_by_source = {}
     
     def image_replacer(match):
         url = match.group(1)
-        placeholder = f"[IMAGE_{len(image_url_mapping)}]"
-        image_url_mapping[placeholder] = url
+        key = source_key(url)
+        placeholder = placeholder_by_source.get(key)
+        if placeholder is None:
+            placeholder = f"[IMAGE_{len(image_url_mapping)}]"
+            placeholder_by_source[key] = placeholder
+            image_url_mapping[placeholder] = url
         return placeholder
 
     # Pattern cho markdown image syntax: ![alt](url)
     markdown_image_pattern = re.compile(r"!\[.*?\]\((.*?)\)")
         
-    # Pattern cho HTML img tag: <img src="url" ...>
+    # Pattern cho HTML img tag: <img src="url" ...> (bao gồm cả <img class="imgSvg" src="data:...">)
     html_img_pattern = re.compile(r'<img[^>]+src\s*=\s*["\']([^"\']+)["\'][^>]*>', re.IGNORECASE)
-        
-    # Pattern cho HTML img tag với class imgSvg và base64 data: <img class="imgSvg" id="..." src="data:image/svg+xml;base64,...">
-    svg_img_pattern = re.compile(r'<img[^>]*class\s*=\s*["\']imgSvg["\'][^>]*src\s*=\s*["\']([^"\']+)["\'][^>]*>', re.IGNORECASE)
-        
-    # Xử lý markdown images trước
-    modified_markdown_content = markdown_image_pattern.sub(image_replacer, markdown_content)
-        
-    # Sau đó xử lý HTML img tags với class imgSvg
-    modified_markdown_content = svg_img_pattern.sub(image_replacer, modified_markdown_content)
-        
-    # Cuối cùng xử lý HTML img tags thông thường
-    modified_markdown_content = html_img_pattern.sub(image_replacer, modified_markdown_content)
     
     # Xử lý markdown images trước
     modified_content = markdown_image_pattern.sub(image_replacer, markdown_content)
@@ -148,10 +135,8 @@ def load_image_from_url(url: str) -> bytes:
     Raises:
         requests.exceptions.RequestException: Lỗi khi tải ảnh từ URL
     """
-    print(f"  Đang tải từ URL {url}...")
-    response = requests.get(url, timeout=20)
-    response.raise_for_status()
-    return response.content
+    image_bytes, _ = image_fetcher.fetch_url(url)
+    return image_bytes
 
 
 def load_image_from_file(file_path: str) -> bytes:
@@ -168,25 +153,22 @@ def load_image_from_file(file_path: str) -> bytes:
         FileNotFoundError: File không tồn tại
         IOError: Lỗi khi đọc file
     """
-    print(f"  Đang đọc từ đường dẫn file {file_path}...")
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"Tệp không tồn tại tại '{file_path}'")
-    
-    with open(file_path, 'rb') as image_file:
-        return image_file.read()
+    image_bytes, _ = image_fetcher.fetch_file(file_path)
+    return image_bytes
 
 
-def determine_mime_type(path_or_url: str) -> str:
+def determine_mime_type(path_or_url: str, content_type: Optional[str] = None) -> str:
     """
     Xác định MIME type dựa trên extension của file.
     
     Args:
         path_or_url: Đường dẫn hoặc URL của ảnh
+        content_type: Content-Type server trả về (dùng khi URL không có extension ảnh)
         
     Returns:
         str: MIME type của ảnh
     """
-    _, extension = os.path.splitext(path_or_url.lower())
+    _, extension = os.path.splitext(path_or_url.lower().split("?", 1)[0])
     mime_mapping = {
         ".png": "image/png",
         ".gif": "image/gif",
@@ -194,6 +176,8 @@ def determine_mime_type(path_or_url: str) -> str:
         ".jpg": "image/jpeg",
         ".jpeg": "image/jpeg"
     }
+    if extension not in mime_mapping and content_type and content_type.startswith("image/"):
+        return content_type
     return mime_mapping.get(extension, "image/jpeg")
 
 
@@ -213,26 +197,45 @@ def encode_image_to_base64_html(image_bytes: bytes, mime_type: str) -> str:
     return html_tag
 
 
-def process_single_image(placeholder: str, path_or_url: str) -> str:
+def asset_image_html(asset) -> str:
+    """
+    Tạo thẻ HTML img tham chiếu ảnh trong asset store (URL + hash nội dung) thay vì base64.
+    
+    Args:
+        asset: Asset trả về từ asset_store
+        
+    Returns:
+        str: Thẻ HTML img
+    """
+    return f'<img src="{asset.url}" data-asset="{asset.ref}" alt="" style="max-width: 100%;">'
+
+
+def process_single_image(placeholder: str, path_or_url: str, fetched=None) -> str:
     """
     Xử lý một ảnh đơn lẻ: tải, mã hóa Base64 và tạo thẻ HTML.
     
     Args:
         placeholder: Placeholder string trong markdown
         path_or_url: Đường dẫn hoặc URL của ảnh
+        fetched: (bytes, content_type) đã tải sẵn hoặc Exception từ image_fetcher.fetch_many
         
     Returns:
         str: Thẻ HTML img hoặc thông báo lỗi
     """
     try:
-        # Xác định loại nguồn ảnh và tải
-        if path_or_url.lower().startswith(('http://', 'https://')):
-            image_bytes = load_image_from_url(path_or_url)
-        else:
-            image_bytes = load_image_from_file(path_or_url)
-
-        # Xác định MIME type và mã hóa
-        mime_type = determine_mime_type(path_or_url)
+        # Xác định loại nguồn ảnh và tải (nếu chưa tải sẵn)
+        if fetched is None:
+            fetched = image_fetcher.fetch(path_or_url)
+        if isinstance(fetched, Exception):
+            raise fetched
+        image_bytes, content_type = fetched
+
+        # Xác định MIME type và mã hóa (hoặc lưu vào asset store và tham chiếu theo hash)
+        mime_type = determine_mime_type(path_or_url, content_type)
+        if app_config.json_image_mode == "asset":
+            html_tag = asset_image_html(asset_store.put_bytes(image_bytes, mime_type, name=path_or_url))
+            print(f"  {placeholder}: Đã lưu vào asset store.")
+            return html_tag
         html_tag = encode_image_to_base64_html(image_bytes, mime_type)
         
         print(f"  {placeholder}: Đã mã hóa thành công.")
@@ -246,6 +249,7 @@ def process_single_image(placeholder: str, path_or_url: str) -> str:
 def process_images_to_base64(image_url_mapping: Dict[str, str]) -> Dict[str, str]:
     """
     Xử lý tất cả ảnh và chuyển đổi sang Base64.
+    Ảnh được tải song song (pool giới hạn) qua cache HTTP; mỗi nguồn chỉ tải một lần.
     
     Args:
         image_url_mapping: Dictionary mapping từ placeholder sang URL/path
@@ -257,21 +261,32 @@ def process_images_to_base64(image_url_mapping: Dict[str, str]) -> Dict[str, str
         return {}
     
     print(f"Tìm thấy {len(image_url_mapping)} ảnh. Đang xử lý...")
-    base64_replacement_mapping = {}
+    # data URI (vd. SVG base64 inline) đã là ảnh nhúng -> giữ nguyên thẻ, không tải
+    sources = [path_or_url for path_or_url in image_url_mapping.values()
+               if not path_or_url.lower().startswith("data:")]
+    fetched = image_fetcher.fetch_many(sources)
     
+    base64_replacement_mapping = {}
     for placeholder, path_or_url in image_url_mapping.items():
-        html_tag = process_single_image(placeholder, path_or_url)
+        if path_or_url.lower().startswith("data:"):
+            base64_replacement_mapping[placeholder] = f'<img src="{path_or_url}" alt="" style="max-width: 100%;">'
+            continue
+        html_tag = process_single_image(placeholder, path_or_url, fetched.get(path_or_url))
         base64_replacement_mapping[placeholder] = html_tag
     
     return base64_replacement_mapping
 
 
-def call_vertex_ai_model(modified_markdown_content: str) -> str:
+def call_vertex_ai_model(modified_markdown_content: str, stream_name: Optional[str] = None,
+                         on_chunk=None, fused: bool = False) -> str:
     """
     Gọi Vertex AI model để chuyển đổi markdown sang JSON.
     
     Args:
         modified_markdown_content: Nội dung markdown đã được xử lý
+        stream_name: tên tài liệu; với GENERATION_STREAMING, JSON thô được ghi dần vào file stream
+        on_chunk: callback(chunk_text) nhận JSON theo từng đoạn token (bật streaming)
+        fused: markdown chưa mapping, AI ghép lời giải vào explainQuestion (MD2JSON_FUSED)
         
     Returns:
         str: JSON string từ AI model
@@ -279,7 +294,8 @@ def call_vertex_ai_model(modified_markdown_content: str) -> str:
     Raises:
         Exception: Lỗi khi gọi AI model hoặc xử lý response
     """
-    prompt_text = MD2JSON.format(modified_markdown_content=modified_markdown_content)
+    prompt_template = MD2JSON_FUSED if fused else MD2JSON
+    prompt_text = prompt_template.format(modified_markdown_content=modified_markdown_content)
    
     generation_config = GenerationConfig(
         temperature=0.2,
@@ -288,16 +304,30 @@ def call_vertex_ai_model(modified_markdown_content: str) -> str:
         response_schema=ARRAY_BASED_SCHEMA
     )
    
-    model = GenerativeModel(vertex_ai_config.model_name)
+    model = vertex_ai_config.get_model(model_cls=GenerativeModel)
+    if model is None:
+        raise Exception("Không thể khởi tạo Vertex AI model")
    
     print("Đang gửi yêu cầu (chỉ văn bản) đến Vertex AI...")
-    response = model.generate_content(
-        contents=[prompt_text],
-        generation_config=generation_config,
-        stream=False
-    )
-    
-    response_text = response.text.strip()
+    sink = None
+    if on_chunk or (stream_name and app_config.generation_streaming):
+        sink = StreamSink(stream_path(stream_name or "md2json", "json"), on_chunk)
+    
+    def generate():
+        if sink is not None:
+            text, _ = generate_streaming(model, [prompt_text], sink,
+                                         generation_config=generation_config)
+            return text
+        response = model.generate_content(
+            contents=[prompt_text],
+            generation_config=generation_config,
+            stream=False
+        )
+        return response.text
+    
+    # Rate limit + retry 429/503 (tôn trọng Retry-After)
+    response_text = call_with_retry(generate, vertex_limiter, tokens=estimate_tokens(prompt_text),
+                                    label="md2json").strip()
     
     if not response_text:
         raise Exception("AI không trả về nội dung")
@@ -309,16 +339,157 @@ def call_vertex_ai_model(modified_markdown_content: str) -> str:
     return response_text
 
 
-def save_json_result(json_object: Any, output_path: str) -> None:
+def merge_section_results(chunk_results: list) -> Dict[str, Any]:
     """
-    Lưu kết quả JSON vào file.
+    Gộp quizParts của các đoạn và đánh lại sectionIndex / indexPart / numberId.
+    
+    Args:
+        chunk_results: list tuple (section_no, json_object) theo thứ tự tài liệu
+        
+    Returns:
+        Dict[str, Any]: {"quizParts": [...]} như khi chuyển cả tài liệu một lần
+    """
+    merged = []
+    last_part = {}  # section_no -> quizPart cuối cùng của phần đó
+    for section_no, json_object in chunk_results:
+        for local_index, part in enumerate(json_object.get("quizParts", [])):
+            # Đoạn tiếp theo của cùng một phần: quizPart đầu tiên nối vào phần đang mở
+            target = last_part.get(section_no) if local_index == 0 else None
+            if target is None:
+                target = dict(part, questions=[])
+                merged.append(target)
+            else:
+                for field in ("sectionTitle", "sectionDescription", "maxScore"):
+                    if not target.get(field) and part.get(field):
+                        target[field] = part[field]
+            target["questions"].extend(part.get("questions") or [])
+            last_part[section_no] = target
+    
+    for section_index, part in enumerate(merged):
+        part["sectionIndex"] = section_index
+        previous = 0
+        for question in part["questions"]:
+            question["indexPart"] = section_index
+            number_id = question.get("numberId")
+            # Số câu lấy từ đề được giữ; thiếu hoặc lùi lại (đoạn đánh số lại từ 1) thì nối tiếp
+            if not isinstance(number_id, int) or number_id <= previous:
+                number_id = previous + 1
+            question["numberId"] = number_id
+            previous = number_id
+    
+    return {"quizParts": merged}
+
+
+def convert_markdown_to_json(modified_markdown_content: str, stream_name: Optional[str] = None,
+                             on_chunk=None, fused: bool = False) -> Dict[str, Any]:
+    """
+    Chuyển markdown sang JSON: tài liệu nhiều phần/dài được chia đoạn và gọi AI song song.
+    Đề có phần lời giải tách riêng cuối đề luôn được gửi một lần (lời giải cần thấy câu hỏi).
+    
+    Args:
+        modified_markdown_content: Markdown đã thay ảnh bằng placeholder
+        stream_name / on_chunk: streaming khi gọi AI một lần (xem call_vertex_ai_model)
+        fused: markdown chưa mapping câu hỏi - lời giải (xem call_vertex_ai_model)
+        
+    Returns:
+        Dict[str, Any]: JSON object với quizParts
+        
+    Raises:
+        json.JSONDecodeError: Một đoạn trả về JSON không hợp lệ
+    """
+    chunks = []
+    # Khối lời giải cuối đề (kể cả khi lặp lại tiêu đề "PHẦN I/II") không được chia thành phần riêng
+    if (app_config.md2json_section_parallel
+            and find_answer_section(modified_markdown_content) is None):
+        chunks = [(section_no, text) for section_no, text in
+                  split_markdown_sections(modified_markdown_content, app_config.md2json_max_chunk_chars)
+                  if text.strip()]
+    if len(chunks) <= 1:
+        response_text = call_vertex_ai_model(modified_markdown_content, stream_name, on_chunk, fused)
+        try:
+            return json.loads(response_text)
+        except json.JSONDecodeError:
+            print(f"Nội dung từ AI:\n{response_text}\n")
+            raise
+    
+    print(f"Chia tài liệu thành {len(chunks)} đoạn theo phần, xử lý song song...")
+    
+    def convert_chunk(chunk):
+        section_no, text = chunk
+        response_text = call_vertex_ai_model(text, fused=fused)
+        try:
+            return section_no, json.loads(response_text)
+        except json.JSONDecodeError:
+            print(f"Nội dung từ AI (phần {section_no}):\n{response_text}\n")
+            raise
+    
+    workers = max(1, min(app_config.md2json_max_workers, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunk_results = list(executor.map(convert_chunk, chunks))
+    
+    return merge_section_results(chunk_results)
+
+
+def json_to_markdown(json_object: Dict[str, Any],
+                     image_url_mapping: Optional[Dict[str, str]] = None) -> str:
+    """
+    Dựng lại markdown đã mapping ("**Câu N:** ... Lời giải ...") từ JSON quizParts, không gọi AI.
+    
+    Args:
+        json_object: JSON với quizParts (câu hỏi đã có explainQuestion)
+        image_url_mapping: placeholder -> URL/đường dẫn ảnh gốc, placeholder được trả lại thành ![](...)
+        
+    Returns:
+        str: Nội dung markdown
+    """
+    blocks = []
+    for part in json_object.get("quizParts", []):
+        title = (part.get("sectionTitle") or "").strip()
+        if title:
+            blocks.append(f"**{title}**")
+        description = (part.get("sectionDescription") or "").strip()
+        if description:
+            blocks.append(description)
+        for question in part.get("questions", []):
+            lines = [f"**Câu {question.get('numberId', '')}:** {(question.get('content') or '').strip()}"]
+            for option in question.get("options") or []:
+                label = (option.get("optionLabel") or "").strip()
+                content = (option.get("content") or "").strip()
+                lines.append(f"{label}. {content}" if label else content)
+            explain = (question.get("explainQuestion") or "").strip()
+            if explain:
+                lines.extend(["Lời giải", explain])
+            blocks.append("\n".join(lines))
+    markdown = "\n\n".join(blocks) + "\n"
+    
+    if image_url_mapping:
+        pattern, _ = compile_placeholder_pattern(image_url_mapping)
+        markdown = pattern.sub(lambda m: f"![]({image_url_mapping[m.group(0)]})", markdown)
+    return markdown
+
+
+def save_json_result(json_object: Any, output_path: str,
+                     replacement_mapping: Optional[Dict[str, str]] = None) -> None:
+    """
+    Lưu kết quả JSON vào file (ghi streaming từng đoạn, không dựng cả chuỗi JSON trong RAM).
     
     Args:
         json_object: Object JSON cần lưu
         output_path: Đường dẫn file output
+        replacement_mapping: placeholder -> giá trị (thẻ <img> Base64) được thay khi ghi,
+                             nên cấu trúc JSON không phải chứa bản sao của ảnh
     """
+    encoder = json.JSONEncoder(ensure_ascii=False, indent=4)
+    if replacement_mapping:
+        pattern, prefix = compile_placeholder_pattern(replacement_mapping)
+        # Placeholder không có ký tự cần escape -> thay thẳng trên đoạn JSON đã encode
+        escape = lambda m: encoder.encode(replacement_mapping[m.group(0)])[1:-1]
+    
     with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(json_object, f, ensure_ascii=False, indent=4)
+        for chunk in encoder.iterencode(json_object):
+            if replacement_mapping and prefix in chunk:
+                chunk = pattern.sub(escape, chunk)
+            f.write(chunk)
 
 
 
@@ -406,12 +577,16 @@ def process_json_data(json_object):
 
     print(f"Đã xử lý xong: {len(quiz_parts)} phần, tạo ra tổng cộng {len(all_processed_questions)} câu hỏi.")
     return all_processed_questions
-def process_markdown_with_vertex_ai(markdown_file_path: str) -> Tuple[str, Optional[str]]:
+def process_markdown_with_vertex_ai(markdown_file_path: str, on_chunk=None,
+                                    fused: bool = False) -> Tuple[str, Optional[str]]:
     """
     Xử lý file Markdown, chuyển đổi hình ảnh sang Base64 và nhúng vào kết quả JSON.
     
     Args:
         markdown_file_path: Đường dẫn đến file Markdown
+        on_chunk: callback(chunk_text) nhận JSON thô theo từng đoạn token khi AI được gọi một lần
+        fused: file chưa mapping câu hỏi - lời giải: AI ghép lời giải khi dựng JSON, sau đó
+               file .md được ghi lại bằng nội dung đã mapping suy ra từ JSON (json_to_markdown)
         
     Returns:
         Tuple[str, Optional[str]]: (đường_dẫn_input, đường_dẫn_output_hoặc_None)
@@ -439,29 +614,29 @@ def process_markdown_with_vertex_ai(markdown_file_path: str) -> Tuple[str, Optio
         # 5. Xử lý ảnh và chuyển đổi sang Base64
         base64_replacement_mapping = process_images_to_base64(image_url_mapping)
         
-        # 6. Gọi AI model
-        response_text = call_vertex_ai_model(modified_markdown_content)
-        
-        # 7. Parse JSON response
-        json_object = json.loads(response_text)
+        # 6-7. Gọi AI model (song song theo phần với đề dài) và parse JSON response
+        json_object = convert_markdown_to_json(modified_markdown_content, markdown_file_path, on_chunk, fused)
+        if fused:
+            with open(markdown_file_path, 'w', encoding='utf-8') as file:
+                file.write(json_to_markdown(json_object, image_url_mapping))
+            print(f"Đã ghi lại file Markdown đã mapping từ JSON: {os.path.basename(markdown_file_path)}")
         
-        # 8. Khôi phục ảnh Base64 vào JSON
+        # 8. Ảnh Base64 được nhúng khi ghi file (streaming), cấu trúc JSON chỉ giữ placeholder
         print("AI đã xử lý xong. Đang nhúng ảnh Base64 vào cấu trúc JSON...")
-        image_replacement_json_object = deep_replace_placeholders(json_object, base64_replacement_mapping)
         # 9. Xử lý json về định dạng đúng
-        save_json_result(image_replacement_json_object, "a.md")
-        final_json_object = process_json_data(image_replacement_json_object)
+        save_json_result(json_object, "a.md", base64_replacement_mapping)
+        final_json_object = process_json_data(json_object)
         
         #  10. Giai câu hỏi bằng ai 
         # final_json_object= giai_cau_hoi_bang_ai(final_json_object) 
         #  11. Lưu kết quả
-        save_json_result(final_json_object, output_json_path)
+        save_json_result(final_json_object, output_json_path, base64_replacement_mapping)
         print(f"✔️ Kết quả đã được lưu thành công tại '{output_json_path}'.\n")
        
         return (markdown_file_path, output_json_path)
         
     except json.JSONDecodeError as e:
-        print(f"Lỗi: JSON không hợp lệ. Lỗi: {e}\nNội dung từ AI:\n{response_text}\n")
+        print(f"Lỗi: JSON không hợp lệ. Lỗi: {e}\n")
         return (markdown_file_path, None)
     except Exception as e:
         print(f"Đã xảy ra lỗi không xác định khi xử lý file '{markdown_file_path}': {e}\n")
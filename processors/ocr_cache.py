@@ -0,0 +1,349 @@
+"""
+OCR Cache - Cache kết quả OCR trên đĩa theo nội dung ảnh (SQLite + blob files)
+
+Khóa cache = sha256(ảnh) + engine + model + generation config + prompt/options,
+nên chạy lại cùng một thư mục đề thi sẽ không gửi lại ảnh lên Vertex AI/Mathpix.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+
+from config.app_config import app_config
+
+
+def digest_bytes(data):
+    """Trả về sha256 hex của dữ liệu bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_file(file_path, chunk_size=1024 * 1024):
+    """Trả về sha256 hex của file (đọc theo từng chunk)"""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_cacheable(value):
+    """
+    Kết quả OCR có được cache không: bỏ None, chuỗi rỗng và response lỗi của API
+    (Mathpix trả HTTP 200 kèm {"error": ...}, hoặc không có "text")
+    """
+    if value is None:
+        return False
+    if isinstance(value, str):
+        return bool(value.strip())
+    if isinstance(value, dict):
+        return "error" not in value and bool(value.get("text"))
+    return True
+
+
+class OCRCache:
+    """Cache kết quả OCR với LRU eviction theo dung lượng/tuổi và single-flight"""
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, max_age_seconds=30 * 86400,
+                 enabled=True, inflight_timeout=600, poll_interval=0.5):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.db_path = os.path.join(cache_dir, "index.sqlite3")
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.enabled = enabled
+        self.inflight_timeout = inflight_timeout
+        self.poll_interval = poll_interval
+
+        # Single-flight trong cùng process (giữa các thread)
+        self._lock = threading.Lock()
+        self._local_flights = {}
+        self._ready = False
+        self._token = uuid.uuid4().hex[:8]
+
+    # ------------------------------------------------------------------
+    # Khóa cache
+    # ------------------------------------------------------------------
+    @staticmethod
+    def build_key(image_digest, engine, model_name=None, generation_config=None, prompt=None,
+                  upload_profile=None):
+        """
+        Tạo khóa cache từ các thành phần ảnh hưởng tới kết quả OCR
+        Args:
+            image_digest: sha256 của bytes ảnh
+            engine: tên engine ("vertex_ai" hoặc "mathpix")
+            model_name: tên model (nếu có)
+            generation_config: dict generation config (nếu có)
+            prompt: prompt text hoặc dict options của Mathpix
+            upload_profile: cấu hình tối ưu payload upload (nếu có)
+        Returns:
+            str khóa sha256
+        """
+        payload = {
+            "image": image_digest,
+            "engine": engine,
+            "model": model_name,
+            "config": generation_config,
+            "prompt": prompt,
+        }
+        if upload_profile is not None:
+            payload["upload"] = upload_profile
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def _owner(self):
+        # Gắn pid để process con (fork) không dùng chung owner với process cha
+        return f"{os.getpid()}-{self._token}"
+
+    # ------------------------------------------------------------------
+    # SQLite index
+    # ------------------------------------------------------------------
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(self.blob_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        if not self._ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries(last_access)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS inflight ("
+                "key TEXT PRIMARY KEY, owner TEXT NOT NULL, started REAL NOT NULL)"
+            )
+            self._ready = True
+        return conn
+
+    def _blob_path(self, key):
+        return os.path.join(self.blob_dir, key[:2], f"{key}.json")
+
+    def _remove_entry(self, conn, key):
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        try:
+            os.remove(self._blob_path(key))
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------------
+    # Đọc / ghi
+    # ------------------------------------------------------------------
+    def get(self, key):
+        """Lấy kết quả đã cache hoặc None nếu không có / đã hết hạn"""
+        if not self.enabled:
+            return None
+
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT created FROM entries WHERE key = ?", (key,)).fetchone()
+                if not row:
+                    return None
+
+                now = time.time()
+                if self.max_age_seconds and row[0] < now - self.max_age_seconds:
+                    self._remove_entry(conn, key)
+                    return None
+
+                try:
+                    with open(self._blob_path(key), "r", encoding="utf-8") as f:
+                        value = json.load(f)
+                except (OSError, ValueError):
+                    # Blob bị mất/hỏng -> xóa entry
+                    self._remove_entry(conn, key)
+                    return None
+
+                if not is_cacheable(value):
+                    # Kết quả lỗi được ghi từ phiên bản cũ -> bỏ, gọi lại API
+                    self._remove_entry(conn, key)
+                    return None
+
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                return value
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"⚠️ Lỗi đọc OCR cache: {e}")
+            return None
+
+    def put(self, key, value):
+        """Lưu kết quả (JSON-serializable) vào cache; kết quả lỗi/rỗng không được lưu (is_cacheable)"""
+        if not self.enabled or not is_cacheable(value):
+            return
+
+        try:
+            conn = self._connect()
+            try:
+                blob_path = self._blob_path(key)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+                # Ghi atomic: file tạm -> os.replace
+                tmp_path = f"{blob_path}.{self._owner}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(value, f, ensure_ascii=False)
+                os.replace(tmp_path, blob_path)
+
+                now = time.time()
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, size, created, last_access) VALUES (?, ?, ?, ?)",
+                    (key, os.path.getsize(blob_path), now, now)
+                )
+                self._evict(conn)
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+            print(f"⚠️ Lỗi ghi OCR cache: {e}")
+
+    def _evict(self, conn):
+        """Xóa entry hết hạn, sau đó xóa theo LRU cho tới khi dưới giới hạn dung lượng"""
+        if self.max_age_seconds:
+            cutoff = time.time() - self.max_age_seconds
+            expired = conn.execute("SELECT key FROM entries WHERE created < ?", (cutoff,)).fetchall()
+            for (key,) in expired:
+                self._remove_entry(conn, key)
+
+        if not self.max_bytes:
+            return
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._remove_entry(conn, key)
+            total -= size
+
+    def clear(self):
+        """Xóa toàn bộ cache"""
+        conn = self._connect()
+        try:
+            for (key,) in conn.execute("SELECT key FROM entries").fetchall():
+                self._remove_entry(conn, key)
+            conn.execute("DELETE FROM inflight")
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Single-flight
+    # ------------------------------------------------------------------
+    def _try_claim(self, key):
+        """Giành quyền gọi API cho key (giữa các process). True nếu giành được"""
+        conn = self._connect()
+        try:
+            now = time.time()
+            # Chiếm lại nếu process trước treo/chết quá inflight_timeout
+            conn.execute(
+                "DELETE FROM inflight WHERE key = ? AND started < ?",
+                (key, now - self.inflight_timeout)
+            )
+            try:
+                conn.execute(
+                    "INSERT INTO inflight (key, owner, started) VALUES (?, ?, ?)",
+                    (key, self._owner, now)
+                )
+                return True
+            except sqlite3.IntegrityError:
+                return False
+        finally:
+            conn.close()
+
+    def _release(self, key):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM inflight WHERE key = ? AND owner = ?", (key, self._owner))
+        finally:
+            conn.close()
+
+    def _is_inflight(self, key):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM inflight WHERE key = ?", (key,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def get_or_compute(self, key, compute):
+        """
+        Trả về kết quả cache, nếu chưa có thì gọi compute() đúng một lần cho mỗi key
+        (các thread/process khác cùng key sẽ chờ và dùng chung kết quả)
+        Args:
+            key: khóa cache (từ build_key)
+            compute: hàm không tham số, trả về kết quả hoặc None nếu lỗi
+                     (kết quả không qua is_cacheable thì được trả về nhưng không cache)
+        Returns:
+            tuple (value, from_cache)
+        """
+        if not self.enabled:
+            return compute(), False
+
+        cached = self.get(key)
+        if cached is not None:
+            return cached, True
+
+        # Single-flight giữa các thread trong process
+        with self._lock:
+            event = self._local_flights.get(key)
+            is_leader = event is None
+            if is_leader:
+                event = threading.Event()
+                self._local_flights[key] = event
+
+        if not is_leader:
+            event.wait()
+            cached = self.get(key)
+            if cached is not None:
+                return cached, True
+            return compute(), False
+
+        try:
+            return self._compute_cross_process(key, compute)
+        finally:
+            with self._lock:
+                self._local_flights.pop(key, None)
+            event.set()
+
+    def _compute_cross_process(self, key, compute):
+        """Single-flight giữa các process thông qua bảng inflight trong SQLite"""
+        try:
+            while not self._try_claim(key):
+                # Process khác đang gọi API cho cùng ảnh -> chờ kết quả
+                time.sleep(self.poll_interval)
+                cached = self.get(key)
+                if cached is not None:
+                    return cached, True
+                if not self._is_inflight(key):
+                    # Leader lỗi/không cache được -> thử giành quyền lần nữa
+                    continue
+        except sqlite3.Error as e:
+            print(f"⚠️ Lỗi single-flight OCR cache: {e}")
+            return compute(), False
+
+        try:
+            # Có thể process khác vừa ghi xong trước khi ta giành được quyền
+            cached = self.get(key)
+            if cached is not None:
+                return cached, True
+
+            value = compute()
+            self.put(key, value)
+            return value, False
+        finally:
+            try:
+                self._release(key)
+            except sqlite3.Error:
+                pass
+
+
+# Tạo instance global để sử dụng trong toàn bộ ứng dụng
+ocr_cache = OCRCache(
+    cache_dir=app_config.ocr_cache_folder,
+    max_bytes=int(app_config.ocr_cache_max_mb * 1024 * 1024),
+    max_age_seconds=app_config.ocr_cache_max_age_days * 86400,
+    enabled=app_config.ocr_cache_enabled
+)
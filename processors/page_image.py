@@ -0,0 +1,158 @@
+"""
+Page Image - Ảnh trang trong bộ nhớ (bytes đã encode + mime type)
+
+Rasterizer tạo PageImage và chuyển thẳng cho Vertex AI/Mathpix, không ghi file tạm.
+Khi cần gửi sang worker process, PageImage được đặt vào multiprocessing.shared_memory
+(chỉ ghi ra đĩa khi ảnh vượt ngưỡng spill).
+"""
+import os
+import tempfile
+from multiprocessing import shared_memory
+
+from processors.image_processor import guess_image_mime_type
+
+_MIME_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+
+class PageImage:
+    """Một trang/ảnh đã encode nằm trong bộ nhớ"""
+
+    def __init__(self, data, mime_type, name, page_idx=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.name = name
+        self.page_idx = page_idx
+
+    def __repr__(self):
+        return f"PageImage({self.name!r}, {self.mime_type}, {len(self.data)} bytes)"
+
+    @property
+    def extension(self):
+        return _MIME_EXTENSIONS.get(self.mime_type, ".png")
+
+    @classmethod
+    def from_file(cls, image_path, page_idx=None):
+        """Đọc ảnh từ file"""
+        with open(image_path, "rb") as f:
+            data = f.read()
+        return cls(data, guess_image_mime_type(image_path), os.path.basename(image_path), page_idx)
+
+    @classmethod
+    def from_pil(cls, image, name, page_idx=None, fmt="JPEG", quality=90):
+        """Encode PIL image một lần (JPEG mặc định, không optimize=True như PNG trước đây)"""
+        import io
+
+        buffer = io.BytesIO()
+        if fmt.upper() == "JPEG":
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(buffer, "JPEG", quality=quality)
+            mime_type = "image/jpeg"
+        else:
+            image.save(buffer, fmt.upper())
+            mime_type = f"image/{fmt.lower()}"
+        return cls(buffer.getvalue(), mime_type, name, page_idx)
+
+    def to_handle(self, spill_threshold=None, spill_dir=None):
+        """
+        Tạo handle picklable để chuyển ảnh sang process khác
+        Args:
+            spill_threshold: số bytes tối đa đặt trong shared memory; lớn hơn thì ghi ra đĩa
+            spill_dir: thư mục chứa file spill (mặc định thư mục tạm hệ thống)
+        Returns:
+            PageHandle (process gửi phải gọi release() sau khi worker xử lý xong)
+        """
+        if spill_threshold is not None and len(self.data) > spill_threshold:
+            fd, path = tempfile.mkstemp(prefix="qprocess_page_", suffix=self.extension, dir=spill_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.data)
+            return PageHandle("file", path, len(self.data), self.mime_type, self.name, self.page_idx)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(self.data)))
+        shm.buf[:len(self.data)] = self.data
+        handle = PageHandle("shm", shm.name, len(self.data), self.mime_type, self.name, self.page_idx)
+        handle._shm = shm
+        return handle
+
+
+class PageHandle:
+    """Tham chiếu picklable tới PageImage nằm trong shared memory hoặc file spill"""
+
+    def __init__(self, kind, location, size, mime_type, name, page_idx=None):
+        self.kind = kind
+        self.location = location
+        self.size = size
+        self.mime_type = mime_type
+        self.name = name
+        self.page_idx = page_idx
+        self._shm = None  # Chỉ process tạo handle giữ segment để release
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shm"] = None
+        return state
+
+    def __repr__(self):
+        return f"PageHandle({self.kind}, {self.name!r}, {self.size} bytes)"
+
+    def load(self):
+        """Đọc PageImage từ shared memory / file spill (dùng trong worker)"""
+        if self.kind == "file":
+            with open(self.location, "rb") as f:
+                data = f.read()
+            return PageImage(data, self.mime_type, self.name, self.page_idx)
+
+        # Worker dùng chung resource_tracker với process cha (fork/spawn/forkserver):
+        # chỉ close, không unregister - process tạo handle sẽ unlink trong release()
+        shm = shared_memory.SharedMemory(name=self.location)
+        try:
+            data = bytes(shm.buf[:self.size])
+        finally:
+            shm.close()
+        return PageImage(data, self.mime_type, self.name, self.page_idx)
+
+    def release(self):
+        """Giải phóng shared memory / xóa file spill (gọi ở process tạo handle)"""
+        if self.kind == "file":
+            try:
+                os.remove(self.location)
+            except OSError:
+                pass
+            return
+
+        shm = self._shm
+        self._shm = None
+        if shm is None:
+            return
+        try:
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def load_page(source):
+    """
+    Chuẩn hóa đầu vào OCR thành PageImage
+    Args:
+        source: đường dẫn ảnh, PageImage hoặc PageHandle
+    Returns:
+        PageImage
+    """
+    if isinstance(source, PageImage):
+        return source
+    if isinstance(source, PageHandle):
+        return source.load()
+    return PageImage.from_file(source)
+
+
+def page_name(source):
+    """Tên hiển thị của ảnh/trang (dùng cho log)"""
+    if isinstance(source, (PageImage, PageHandle)):
+        return source.name
+    return os.path.basename(source)
@@ -0,0 +1,134 @@
+"""
+Page Scheduler - Gom trang của nhiều tài liệu vào một hàng đợi chung
+
+Thay vì mỗi PDF tạo/huỷ một ProcessPoolExecutor riêng (PDF ngắn để worker rảnh),
+tất cả trang của tất cả tài liệu được đưa vào một pool với mức song song cố định,
+kết quả được gom lại theo từng tài liệu đúng thứ tự trang.
+Trang dạng PageImage được chuyển sang worker qua shared memory (không ghi file tạm).
+"""
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from processors.page_image import PageImage, page_name
+
+
+class PageScheduler:
+    """Scheduler trang dùng chung một pool worker cho toàn bộ batch"""
+
+    def __init__(self, page_worker, max_workers=None, initializer=None, max_pending=None,
+                 spill_threshold=None, initargs=()):
+        """
+        Args:
+            page_worker: hàm picklable (image_path | PageHandle, index) -> (index, result_text, image_path, success, error_msg)
+            max_workers: số worker cố định (mặc định = số CPU)
+            initializer: initializer cho mỗi worker process
+            max_pending: số trang tối đa đã submit nhưng chưa xong; submit_page() sẽ chờ
+                         khi vượt ngưỡng (backpressure cho rasterizer). None = không giới hạn
+            spill_threshold: số bytes tối đa của một trang đặt trong shared memory; lớn hơn thì ghi ra đĩa
+            initargs: tham số cho initializer
+        """
+        self.page_worker = page_worker
+        self.max_workers = max_workers or mp.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pending = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.spill_threshold = spill_threshold
+
+        self._executor = None
+        self._futures = {}
+        self._documents = {}
+        self._next_index = 0
+
+    def __enter__(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer,
+                                             initargs=self.initargs)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def add_document(self, doc_key, page_count):
+        """Đăng ký tài liệu với số trang biết trước (trang sẽ submit dần qua submit_page)"""
+        self._documents[doc_key] = page_count
+
+    def submit_page(self, doc_key, page_idx, image):
+        """
+        Đưa một trang vào hàng đợi chung ngay khi có ảnh (chờ nếu vượt max_pending)
+        Args:
+            doc_key: khóa tài liệu đã đăng ký bằng add_document
+            page_idx: chỉ số trang (từ 0)
+            image: đường dẫn ảnh trang hoặc PageImage (chuyển qua shared memory)
+        """
+        if self._pending is not None:
+            self._pending.acquire()
+
+        handle = None
+        payload = image
+        if isinstance(image, PageImage):
+            handle = payload = image.to_handle(spill_threshold=self.spill_threshold)
+
+        job_index = self._next_index
+        self._next_index += 1
+        try:
+            future = self._executor.submit(self.page_worker, payload, job_index)
+        except Exception:
+            if handle is not None:
+                handle.release()
+            if self._pending is not None:
+                self._pending.release()
+            raise
+
+        def on_done(_):
+            # Worker đã đọc xong -> giải phóng shared memory / file spill
+            if handle is not None:
+                handle.release()
+            if self._pending is not None:
+                self._pending.release()
+
+        future.add_done_callback(on_done)
+        self._futures[future] = (doc_key, page_idx, image if isinstance(image, str) else page_name(image))
+
+    def submit_document(self, doc_key, page_paths):
+        """
+        Đưa tất cả trang của một tài liệu vào hàng đợi chung (không chờ tài liệu trước)
+        Args:
+            doc_key: khóa định danh tài liệu
+            page_paths: list đường dẫn ảnh các trang theo thứ tự
+        """
+        self.add_document(doc_key, len(page_paths))
+        for page_idx, image_path in enumerate(page_paths):
+            self.submit_page(doc_key, page_idx, image_path)
+
+    def collect(self, on_page_done=None):
+        """
+        Chờ tất cả trang hoàn thành và gom kết quả theo tài liệu
+        Args:
+            on_page_done: callback(doc_key, page_idx, success) sau mỗi trang (tùy chọn)
+        Returns:
+            dict doc_key -> list tuple (page_idx, result_text, image_path, success, error_msg) theo thứ tự trang
+        """
+        results = {doc_key: [None] * count for doc_key, count in self._documents.items()}
+
+        for future in as_completed(self._futures):
+            doc_key, page_idx, image_path = self._futures[future]
+            try:
+                _, result_text, _, success, error_msg = future.result()
+            except Exception as e:
+                result_text, success, error_msg = None, False, f"Lỗi future: {str(e)}"
+
+            results[doc_key][page_idx] = (page_idx, result_text, image_path, success, error_msg)
+            if on_page_done:
+                on_page_done(doc_key, page_idx, success)
+
+        # Trang không được submit (renderer lỗi giữa chừng) -> đánh dấu lỗi
+        for doc_key, pages in results.items():
+            for page_idx, page in enumerate(pages):
+                if page is None:
+                    pages[page_idx] = (page_idx, None, None, False, "Trang không được render")
+
+        self._futures = {}
+        self._documents = {}
+        return results
@@ -0,0 +1,207 @@
+"""
+Payload Optimizer - Giảm kích thước ảnh trước khi upload lên Vertex AI/Mathpix
+
+Ảnh đã nằm trong ngân sách được upload nguyên bản (không encode lại lossy).
+Ảnh vượt ngân sách: chọn định dạng (JPEG/WebP) và quality để nằm trong ngân sách bytes/pixel:
+- Giới hạn cạnh dài / tổng số pixel (JPEG dùng draft mode của PIL để decode nhanh ở độ phân giải thấp)
+- Tùy chọn chuyển grayscale (đủ cho OCR đề thi đen trắng)
+- Binary search quality cho tới khi dưới ngân sách bytes
+"""
+import io
+import math
+
+from PIL import Image, features
+
+from config.app_config import app_config
+from processors.page_image import PageImage
+
+_FORMAT_MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+class PayloadOptimizer:
+    """Encode ảnh upload theo ngân sách bytes/pixel"""
+
+    def __init__(self, enabled=True, max_bytes=1024 * 1024, max_dimension=2048, max_pixels=None,
+                 fmt="jpeg", grayscale=False, min_quality=40, max_quality=90):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.max_dimension = max_dimension
+        self.max_pixels = max_pixels
+        self.grayscale = grayscale
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+
+        fmt = (fmt or "jpeg").lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt == "webp" and not features.check("webp"):
+            print("⚠️ Pillow không hỗ trợ WebP, dùng JPEG cho payload upload")
+            fmt = "jpeg"
+        self.fmt = fmt if fmt in _FORMAT_MIME_TYPES else "jpeg"
+
+    @property
+    def profile(self):
+        """Cấu hình encode (đưa vào khóa OCR cache), None nếu tắt"""
+        if not self.enabled:
+            return None
+        return {
+            "format": self.fmt,
+            "max_bytes": self.max_bytes,
+            "max_dimension": self.max_dimension,
+            "max_pixels": self.max_pixels,
+            "grayscale": self.grayscale,
+            "quality": [self.min_quality, self.max_quality],
+        }
+
+    # ------------------------------------------------------------------
+    # Kích thước đích
+    # ------------------------------------------------------------------
+    def _target_scale(self, size):
+        """Tỉ lệ thu nhỏ (<= 1) để thỏa giới hạn cạnh dài và tổng pixel"""
+        w, h = size
+        scale = 1.0
+        if self.max_dimension and max(w, h) > self.max_dimension:
+            scale = min(scale, self.max_dimension / max(w, h))
+        if self.max_pixels and w * h > self.max_pixels:
+            scale = min(scale, math.sqrt(self.max_pixels / (w * h)))
+        return scale
+
+    def _fits(self, page, size):
+        """Ảnh đã nằm trong ngân sách (bytes + kích thước) -> upload nguyên bản, kể cả PNG"""
+        return ((not self.max_bytes or len(page.data) <= self.max_bytes)
+                and self._target_scale(size) >= 1.0
+                and not self.grayscale)
+
+    # ------------------------------------------------------------------
+    # Encode
+    # ------------------------------------------------------------------
+    def _encode(self, image, quality):
+        buffer = io.BytesIO()
+        if self.fmt == "webp":
+            image.save(buffer, "WEBP", quality=quality, method=4)
+        else:
+            image.save(buffer, "JPEG", quality=quality, optimize=False)
+        return buffer.getvalue()
+
+    def _encode_to_budget(self, image):
+        """Binary search quality lớn nhất có kích thước <= max_bytes"""
+        low, high = self.min_quality, self.max_quality
+        best = None
+        data = self._encode(image, high)
+        if not self.max_bytes or len(data) <= self.max_bytes:
+            return data
+
+        while low <= high:
+            quality = (low + high) // 2
+            data = self._encode(image, quality)
+            if len(data) <= self.max_bytes:
+                best = data
+                low = quality + 1
+            else:
+                high = quality - 1
+        return best
+
+    def optimize(self, page):
+        """
+        Encode lại ảnh upload để nằm trong ngân sách
+        Args:
+            page: PageImage gốc
+        Returns:
+            tuple (PageImage upload, scale) - scale = kích thước mới / kích thước gốc
+            (dùng để quy đổi tọa độ line_data của Mathpix về ảnh gốc)
+        """
+        if not self.enabled:
+            return page, 1.0
+
+        try:
+            image = Image.open(io.BytesIO(page.data))
+            original_size = image.size
+            if self._fits(page, original_size):
+                return page, 1.0
+
+            mode = "L" if self.grayscale else "RGB"
+            scale = self._target_scale(original_size)
+            target_size = (max(1, int(original_size[0] * scale)), max(1, int(original_size[1] * scale)))
+
+            # JPEG: decode thẳng ở độ phân giải gần target (DCT scaling), nhanh hơn decode full rồi resize
+            if image.format == "JPEG" and scale < 1.0:
+                image.draft(mode, target_size)
+
+            if image.mode not in ("RGB", "L"):
+                if image.mode in ("RGBA", "LA", "P"):
+                    # Nền trong suốt -> trắng (tránh nền đen khi bỏ alpha)
+                    rgba = image.convert("RGBA")
+                    background = Image.new("RGB", rgba.size, (255, 255, 255))
+                    background.paste(rgba, mask=rgba.split()[-1])
+                    image = background
+                else:
+                    image = image.convert("RGB")
+            if image.mode != mode:
+                image = image.convert(mode)
+            if image.size != target_size and scale < 1.0:
+                image = image.resize(target_size, Image.LANCZOS)
+
+            data = self._encode_to_budget(image)
+            # Vẫn vượt ngân sách ở quality thấp nhất -> thu nhỏ thêm
+            attempts = 0
+            while data is None and attempts < 3:
+                attempts += 1
+                image = image.resize((max(1, int(image.size[0] * 0.75)), max(1, int(image.size[1] * 0.75))),
+                                     Image.LANCZOS)
+                data = self._encode_to_budget(image)
+            if data is None:
+                data = self._encode(image, self.min_quality)
+
+            # Không lợi gì -> giữ ảnh gốc
+            if len(data) >= len(page.data) and self._target_scale(original_size) >= 1.0 and not self.grayscale:
+                return page, 1.0
+
+            final_scale = image.size[0] / original_size[0]
+            base_name = page.name.rsplit(".", 1)[0]
+            extension = ".webp" if self.fmt == "webp" else ".jpg"
+            optimized = PageImage(data, _FORMAT_MIME_TYPES[self.fmt], base_name + extension, page.page_idx)
+            return optimized, final_scale
+
+        except Exception as e:
+            print(f"⚠️ Không tối ưu được payload {page.name}: {str(e)}")
+            return page, 1.0
+
+
+def rescale_line_data(result, scale):
+    """
+    Quy đổi tọa độ line_data (cnt) của Mathpix từ ảnh upload đã thu nhỏ về ảnh gốc
+    Args:
+        result: dict kết quả Mathpix (được sửa tại chỗ)
+        scale: tỉ lệ ảnh upload / ảnh gốc
+    Returns:
+        result
+    """
+    if not result or not scale or scale == 1.0:
+        return result
+
+    factor = 1.0 / scale
+    for line in result.get("line_data") or []:
+        cnt = line.get("cnt")
+        if cnt:
+            line["cnt"] = [[p[0] * factor, p[1] * factor] for p in cnt
+                           if isinstance(p, (list, tuple)) and len(p) == 2]
+    for key in ("image_width", "image_height"):
+        if isinstance(result.get(key), (int, float)):
+            result[key] = int(round(result[key] * factor))
+    return result
+
+
+# Tạo instance global để sử dụng trong toàn bộ ứng dụng
+payload_optimizer = PayloadOptimizer(
+    enabled=app_config.upload_optimize_enabled,
+    max_bytes=int(app_config.upload_max_kb * 1024),
+    max_dimension=app_config.upload_max_dimension,
+    max_pixels=app_config.upload_max_pixels,
+    fmt=app_config.upload_format,
+    grayscale=app_config.upload_grayscale,
+    min_quality=app_config.upload_min_quality,
+    max_quality=app_config.upload_max_quality
+)
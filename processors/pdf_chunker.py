@@ -0,0 +1,72 @@
+"""
+PDF Chunker - Chia PDF lớn thành các cụm N trang để xử lý song song trên Mathpix
+
+Mathpix xử lý một PDF tuần tự phía server, nên PDF 100 trang chậm (hoặc timeout) dù
+client rảnh. Chia thành nhiều job nhỏ thì thời gian chờ tỉ lệ với kích thước cụm,
+không phải kích thước tài liệu.
+- Có pypdf: tách cụm trang ngay tại local (chỉ upload phần cần thiết)
+- Không có pypdf: upload cả file kèm option page_ranges của Mathpix
+"""
+import io
+
+try:
+    from pypdf import PdfReader, PdfWriter
+    PDF_SPLIT_SUPPORT = True
+except ImportError:
+    PDF_SPLIT_SUPPORT = False
+
+from processors.pdf_rasterizer import PDF_SUPPORT, get_pdf_page_count
+
+
+def count_pdf_pages(pdf_path):
+    """Số trang PDF (pypdf hoặc pdfinfo), None nếu không xác định được"""
+    try:
+        if PDF_SPLIT_SUPPORT:
+            return len(PdfReader(pdf_path).pages)
+        if PDF_SUPPORT:
+            return get_pdf_page_count(pdf_path)
+    except Exception as e:
+        print(f"⚠️ Không đọc được số trang PDF: {str(e)}")
+    return None
+
+
+def plan_page_chunks(page_count, chunk_pages):
+    """
+    Chia [1, page_count] thành các khoảng liên tiếp tối đa chunk_pages trang
+    Returns:
+        list tuple (first_page, last_page), đánh số từ 1
+    """
+    if not page_count or not chunk_pages or chunk_pages <= 0:
+        return [(1, page_count)] if page_count else []
+    return [(first, min(first + chunk_pages - 1, page_count))
+            for first in range(1, page_count + 1, chunk_pages)]
+
+
+def split_pdf_bytes(pdf_path, first_page, last_page, reader=None):
+    """
+    Tách các trang [first_page, last_page] thành một PDF mới trong RAM (cần pypdf)
+    Args:
+        reader: PdfReader dùng lại giữa các cụm (tránh parse file nhiều lần)
+    Returns:
+        bytes của PDF con
+    """
+    reader = reader or PdfReader(pdf_path)
+    writer = PdfWriter()
+    for page_idx in range(first_page - 1, last_page):
+        writer.add_page(reader.pages[page_idx])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def split_pdf_chunks(pdf_path, chunks):
+    """
+    Tách tất cả các cụm trang trong một lần đọc file (PdfReader không thread-safe,
+    nên không dùng chung một reader giữa các thread)
+    Args:
+        chunks: list tuple (first_page, last_page) từ plan_page_chunks
+    Returns:
+        list bytes PDF con theo thứ tự chunks
+    """
+    reader = PdfReader(pdf_path)
+    return [split_pdf_bytes(pdf_path, first, last, reader) for first, last in chunks]
@@ -0,0 +1,149 @@
+"""
+PDF Rasterizer - Render PDF thành ảnh theo từng cụm trang (streaming)
+
+Lấy số trang trước bằng pdfinfo, sau đó render từng khoảng trang nhỏ trong thread nền
+và đẩy từng trang ra qua một buffer có giới hạn. Bộ nhớ đỉnh là O(window) thay vì
+O(số trang) và trang đầu tiên được gửi OCR ngay khi render xong.
+
+pdftocairo xuất ppm (raw, không phải decode JPEG), mỗi trang chỉ encode JPEG một lần
+trong RAM thành PageImage và chuyển thẳng cho OCR, không ghi file tạm.
+"""
+import os
+import queue
+import threading
+import multiprocessing as mp
+
+try:
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    PDF_SUPPORT = True
+except ImportError:
+    PDF_SUPPORT = False
+
+from processors.page_image import PageImage
+
+
+def get_pdf_page_count(pdf_path):
+    """Lấy số trang PDF bằng pdfinfo (không render)"""
+    info = pdfinfo_from_path(pdf_path)
+    return int(info["Pages"])
+
+
+def render_pdf_page(pdf_path, page_no, size=None, dpi=200):
+    """
+    Render một trang PDF
+    Args:
+        page_no: số trang, bắt đầu từ 1
+        size: (width, height) pixel cần render (vd. hệ tọa độ line_data của Mathpix), None = theo dpi
+    Returns:
+        PIL.Image
+    """
+    size = tuple(int(round(v)) for v in size) if size else None
+    return convert_from_path(pdf_path, dpi=dpi, first_page=page_no, last_page=page_no, size=size)[0]
+
+
+class _RenderError:
+    """Lỗi render được chuyển từ thread nền sang generator"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def iter_pdf_pages(pdf_path, dpi=200, window=4, buffer_size=8, fmt="jpeg", page_count=None):
+    """
+    Render PDF theo từng cụm `window` trang, yield từng trang ngay khi có
+    Args:
+        pdf_path: đường dẫn file PDF
+        dpi: độ phân giải
+        window: số trang render mỗi lần gọi pdftocairo
+        buffer_size: số trang tối đa đã render nhưng chưa được xử lý (backpressure)
+        fmt: định dạng ảnh trung gian của pdftocairo
+        page_count: số trang (nếu đã biết)
+    Yields:
+        tuple (page_idx, PIL.Image) theo thứ tự trang, page_idx bắt đầu từ 0
+    """
+    if page_count is None:
+        page_count = get_pdf_page_count(pdf_path)
+
+    buffer = queue.Queue(maxsize=max(1, buffer_size))
+    stop = threading.Event()
+
+    def render():
+        try:
+            for first in range(1, page_count + 1, window):
+                if stop.is_set():
+                    return
+                last = min(first + window - 1, page_count)
+                images = convert_from_path(
+                    pdf_path,
+                    dpi=dpi,
+                    fmt=fmt,
+                    first_page=first,
+                    last_page=last,
+                    thread_count=min(window, mp.cpu_count()),
+                    use_pdftocairo=True  # Faster rendering
+                )
+                for offset, image in enumerate(images):
+                    # put() block khi buffer đầy -> renderer chờ OCR tiêu thụ
+                    while not stop.is_set():
+                        try:
+                            buffer.put((first - 1 + offset, image), timeout=0.5)
+                            break
+                        except queue.Full:
+                            continue
+                del images
+        except Exception as e:
+            buffer.put(_RenderError(e))
+        finally:
+            buffer.put(_DONE)
+
+    worker = threading.Thread(target=render, name="pdf-rasterizer", daemon=True)
+    worker.start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _RenderError):
+                raise item.error
+            yield item
+    finally:
+        # Consumer dừng sớm -> báo renderer dừng và giải phóng buffer
+        stop.set()
+        while worker.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def iter_pdf_page_images(pdf_path, dpi=200, window=4, buffer_size=8, page_count=None, quality=90):
+    """
+    Như iter_pdf_pages nhưng mỗi trang được encode JPEG một lần trong RAM
+    Yields:
+        tuple (page_idx, PageImage)
+    """
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    for page_idx, image in iter_pdf_pages(pdf_path, dpi=dpi, window=window, buffer_size=buffer_size,
+                                          fmt="ppm", page_count=page_count):
+        page = PageImage.from_pil(image, f"{base_name}_page_{page_idx + 1:03d}.jpg",
+                                  page_idx=page_idx, quality=quality)
+        image.close()
+        yield page_idx, page
+
+
+def iter_pdf_page_files(pdf_path, output_dir, dpi=200, window=4, buffer_size=8, page_count=None, quality=90):
+    """
+    Như iter_pdf_page_images nhưng lưu từng trang thành file ảnh trong output_dir
+    Yields:
+        tuple (page_idx, image_path)
+    """
+    for page_idx, page in iter_pdf_page_images(pdf_path, dpi=dpi, window=window, buffer_size=buffer_size,
+                                               page_count=page_count, quality=quality):
+        image_path = os.path.join(output_dir, f"page_{page_idx + 1:03d}{page.extension}")
+        with open(image_path, "wb") as f:
+            f.write(page.data)
+        yield page_idx, image_path
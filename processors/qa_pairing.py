@@ -0,0 +1,172 @@
+"""
+QA Pairing - Mapping câu hỏi - lời giải theo bảng ghép số dòng
+
+Thay vì để model viết lại toàn bộ tài liệu (token output ≈ token input), nội dung được đánh
+số từng dòng ở local, model chỉ trả về bảng ghép (phần / câu hỏi -> khoảng dòng lời giải)
+vài trăm token, rồi tài liệu "**Câu N:** ... Lời giải ..." được ghép lại từ nguyên văn nguồn.
+"""
+import re
+import json
+
+# Nhãn ở đầu tiêu đề phần / câu hỏi trong nguồn (kèm markdown đậm/nghiêng, dấu câu sau số)
+_SECTION_LABEL = re.compile(
+    r"^[ \t>#*_]*(PHẦN|Phần|PART|Part)\s+([IVXLC]+|\d+)[ \t]*[.:)]?[ \t*_]*[.:]?[ \t]*"
+)
+_QUESTION_LABEL = re.compile(r"^[ \t>#*_]*(Câu|CÂU|Question)\s+(\d+)[ \t]*[.:)]?[ \t*_]*[.:]?[ \t]*")
+# Dòng "Lời giải" có sẵn ở đầu khoảng lời giải (nhãn được ghép lại một lần)
+_SOLUTION_LABEL = re.compile(
+    r"^[ \t>#*_]*(?:Lời giải|LỜI GIẢI|Hướng dẫn giải|HƯỚNG DẪN GIẢI)(?: chi tiết| CHI TIẾT)?[ \t*_:.]*(?:\n|$)"
+)
+
+
+class PairingError(ValueError):
+    """Bảng ghép model trả về không hợp lệ"""
+
+
+def split_blocks(content):
+    """
+    Đánh số các dòng không rỗng của nội dung
+    Returns:
+        tuple (lines, blocks, numbered_content):
+            lines: các dòng gốc
+            blocks: blocks[k - 1] = chỉ số trong lines của dòng số k
+            numbered_content: nội dung gửi model, mỗi dòng dạng "[k] nội dung"
+    """
+    lines = content.split("\n")
+    blocks = [i for i, line in enumerate(lines) if line.strip()]
+    numbered_content = "\n".join(f"[{k}] {lines[i]}" for k, i in enumerate(blocks, 1))
+    return lines, blocks, numbered_content
+
+
+def _check_range(start, end, block_count):
+    if not isinstance(start, int) or not isinstance(end, int) or not 1 <= start <= end <= block_count:
+        raise PairingError(f"khoảng dòng không hợp lệ: [{start}, {end}] (có {block_count} dòng)")
+    return start, end
+
+
+def parse_pairing(response_text, lines, blocks, answer_line=None):
+    """
+    Đọc và kiểm tra bảng ghép JSON model trả về (QA_PAIRING_SCHEMA)
+    - Các khoảng dòng không được chồng nhau, phần / câu hỏi theo đúng thứ tự tài liệu
+    - Mọi dòng không rỗng trước phần lời giải cuối đề phải thuộc một khoảng (trừ dòng nhãn
+      "Lời giải"); các dòng trước mục đầu tiên được giữ nguyên làm phần mở đầu
+    Args:
+        lines, blocks: từ split_blocks
+        answer_line: chỉ số dòng bắt đầu phần lời giải tách riêng cuối đề (dòng từ đó trở đi
+                     được phép bỏ: tiêu đề "Đáp án", bảng đáp án đã ghép...)
+    Returns:
+        list dict {kind, number, start, end, solutions: [(start, end), ...]};
+        kind "text" = phần mở đầu giữ nguyên văn
+    Raises:
+        PairingError: JSON lỗi, khoảng dòng sai / chồng nhau / sai thứ tự, bỏ sót nội dung
+                      hoặc không có câu hỏi nào
+    """
+    block_count = len(blocks)
+    try:
+        items = json.loads(response_text)["items"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise PairingError(f"không đọc được bảng ghép: {e}")
+
+    owner = [None] * (block_count + 1)  # dòng số k -> khoảng đã chứa nó
+
+    def claim(start, end, label):
+        for k in range(start, end + 1):
+            if owner[k] is not None:
+                raise PairingError(f"dòng {k} thuộc cả {owner[k]} và {label}")
+            owner[k] = label
+
+    pairing = []
+    previous_end = 0
+    for item in items:
+        kind = item.get("kind")
+        if kind not in ("section", "question"):
+            raise PairingError(f"kind không hợp lệ: {kind!r}")
+        start, end = _check_range(item.get("start"), item.get("end"), block_count)
+        if start <= previous_end:
+            raise PairingError(f"mục [{start}, {end}] sai thứ tự (mục trước kết thúc ở dòng {previous_end})")
+        previous_end = end
+        label = f"{kind} [{start}, {end}]"
+        claim(start, end, label)
+        solutions = []
+        for solution in (item.get("solutions") or []) if kind == "question" else []:
+            if not isinstance(solution, (list, tuple)) or len(solution) != 2:
+                raise PairingError(f"khoảng lời giải không hợp lệ: {solution!r}")
+            solutions.append(_check_range(solution[0], solution[1], block_count))
+        pairing.append({"kind": kind, "number": str(item.get("number") or "").strip(),
+                        "start": start, "end": end, "solutions": solutions, "label": label})
+
+    for item in pairing:
+        for start, end in item["solutions"]:
+            claim(start, end, f"lời giải của {item['label']}")
+
+    if not any(item["kind"] == "question" for item in pairing):
+        raise PairingError("bảng ghép không có câu hỏi nào")
+
+    # Phần mở đầu (tiêu đề đề thi...) trước mục đầu tiên: giữ nguyên văn
+    first_start = pairing[0]["start"]
+    if first_start > 1:
+        if any(owner[k] is not None for k in range(1, first_start)):
+            raise PairingError(f"lời giải nằm trước mục đầu tiên (dòng {first_start})")
+        pairing.insert(0, {"kind": "text", "number": "", "start": 1, "end": first_start - 1,
+                           "solutions": [], "label": "mở đầu"})
+        for k in range(1, first_start):
+            owner[k] = "mở đầu"
+
+    missing = [k for k in range(1, block_count + 1)
+               if owner[k] is None
+               and (answer_line is None or blocks[k - 1] < answer_line)
+               and not _SOLUTION_LABEL.match(lines[blocks[k - 1]])]
+    if missing:
+        shown = ", ".join(map(str, missing[:10])) + ("..." if len(missing) > 10 else "")
+        raise PairingError(f"{len(missing)} dòng nội dung không thuộc khoảng nào: {shown}")
+    return pairing
+
+
+def _span(lines, blocks, start, end):
+    """Nguyên văn từ dòng số start tới end (gồm cả dòng trống ở giữa)"""
+    return "\n".join(lines[blocks[start - 1]:blocks[end - 1] + 1])
+
+
+def _relabel(text, pattern, vi_label, en_label, number=None):
+    """Thay nhãn đầu đoạn (Câu 3. / **Phần II**) bằng nhãn chuẩn "**Câu 3:**" """
+    match = pattern.match(text)
+    if match:
+        label = en_label if match.group(1).lower() == en_label.lower() else vi_label
+        number = number or match.group(2)
+        text = text[match.end():]
+    else:
+        label = vi_label
+    return f"**{label} {number}:** {text}" if number else text
+
+
+def assemble_mapped_document(lines, blocks, pairing):
+    """
+    Ghép tài liệu đã mapping từ nguyên văn nguồn theo bảng ghép
+    - Phần: "**Phần X:** ...", câu hỏi: "**Câu N:** ..." (tiếng Anh: Part / Question)
+    - Lời giải các khoảng dòng được nối dưới dòng "Lời giải", bỏ nhãn "Lời giải" / "Câu N." lặp lại ở đầu
+    - Chỉ các dòng parse_pairing cho phép bỏ (nhãn "Lời giải", phần lời giải cuối đề như tiêu đề
+      "Đáp án", bảng đáp án đã ghép...) không xuất hiện trong kết quả
+    Returns:
+        str nội dung đã mapping
+    """
+    parts = []
+    for item in pairing:
+        text = _span(lines, blocks, item["start"], item["end"]).strip()
+        if item["kind"] == "text":
+            parts.append(text)
+            continue
+        if item["kind"] == "section":
+            parts.append(_relabel(text, _SECTION_LABEL, "Phần", "Part"))
+            continue
+
+        piece = _relabel(text, _QUESTION_LABEL, "Câu", "Question", item["number"])
+        solutions = []
+        for start, end in item["solutions"]:
+            solution = _span(lines, blocks, start, end).strip()
+            solution = _QUESTION_LABEL.sub("", _SOLUTION_LABEL.sub("", solution, count=1), count=1)
+            solutions.append(solution)
+        solutions = [solution for solution in solutions if solution.strip()]
+        if solutions:
+            piece += "\nLời giải\n" + "\n".join(solutions)
+        parts.append(piece)
+    return "\n\n".join(parts)
@@ -1,19 +1,36 @@
 import os
 import sys
 from datetime import datetime
-from config.vertex_ai_config import VertexAIConfig
-from vertexai.generative_models import GenerativeModel, GenerationConfig
+from concurrent.futures import ThreadPoolExecutor
+from config.app_config import app_config
+from config.vertex_ai_config import vertex_ai_config
+from config.rate_limiter import vertex_limiter, estimate_tokens, call_with_retry
+from config.response_schema import QA_PAIRING_SCHEMA
+from vertexai.generative_models import GenerationConfig
+from processors.exam_chunker import plan_mapping_chunks, find_answer_section
+from processors.qa_pairing import split_blocks, parse_pairing, assemble_mapped_document, PairingError
+from processors.stream_output import StreamSink, stream_path, generate_streaming
 
 # Import prompts từ data/prompt
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data', 'prompt'))
-from data.prompt.prompts import QUESTION_ANSWER_MAPPING
+from data.prompt.prompts import QUESTION_ANSWER_MAPPING, QUESTION_ANSWER_PAIRING
+
+# Bảng ghép chỉ gồm số dòng: vài trăm tới vài nghìn token output
+PAIRING_GENERATION_CONFIG = GenerationConfig(
+    temperature=0.1,
+    top_p=0.8,
+    top_k=20,
+    max_output_tokens=8192,
+    response_mime_type="application/json",
+    response_schema=QA_PAIRING_SCHEMA
+)
 
 class QuestionAnswerMapper:
     """Class đơn giản để mapping câu hỏi với lời giải bằng AI"""
     
     def __init__(self):
-        """Khởi tạo mapper với Vertex AI"""
-        self.vertex_config = VertexAIConfig()
+        """Khởi tạo mapper với Vertex AI (dùng chung config/model đã cache trong process)"""
+        self.vertex_config = vertex_ai_config
         self.model = None
         self._initialize_model()
     
@@ -21,8 +38,7 @@ class QuestionAnswerMapper:
         """Khởi tạo Vertex AI model"""
         try:
             if self.vertex_config.is_configured():
-                self.vertex_config.initialize_vertex_ai()
-                self.model = GenerativeModel(
+                self.model = self.vertex_config.get_model(
                     model_name="gemini-2.5-flash",
                     generation_config=GenerationConfig(
                         temperature=0.1,
@@ -31,17 +47,81 @@ class QuestionAnswerMapper:
                         max_output_tokens=30000
                     )
                 )
-                print("✅ Vertex AI model đã được khởi tạo cho Question-Answer Mapper")
+                if self.model:
+                    print("✅ Vertex AI model đã được khởi tạo cho Question-Answer Mapper")
             else:
                 print("❌ Vertex AI chưa được cấu hình đúng")
         except Exception as e:
             print(f"❌ Lỗi khởi tạo Vertex AI model: {e}")
     
-    def process_content(self, content):
+    def process_content(self, content, label=None, on_chunk=None):
+        """
+        Gửi nội dung cho AI để mapping câu hỏi với lời giải (theo MAPPER_MODE)
+        Args:
+            content: Nội dung file .md
+            label: tên tài liệu (đặt tên file stream)
+            on_chunk: callback streaming, xem process_content_rewrite
+        Returns:
+            str: Kết quả đã mapping hoặc None nếu lỗi
+        """
+        if app_config.mapper_mode == "offsets":
+            mapped = self.process_content_offsets(content)
+            if mapped is not None:
+                return mapped
+            print("↩️ Chuyển sang mapping viết lại toàn văn")
+        return self.process_content_rewrite(content, label, on_chunk)
+    
+    def process_content_offsets(self, content):
+        """
+        Mapping bằng bảng ghép: AI chỉ trả về số dòng của phần / câu hỏi / lời giải,
+        tài liệu được ghép lại ở local từ nguyên văn nguồn
+        Args:
+            content: Nội dung file .md
+        Returns:
+            str: Kết quả đã mapping hoặc None nếu lỗi / bảng ghép không hợp lệ
+        """
+        if not self.model:
+            print("❌ Model chưa được khởi tạo")
+            return None
+        
+        lines, blocks, numbered_content = split_blocks(content)
+        if not blocks:
+            return None
+        
+        try:
+            model = self.vertex_config.get_model(
+                model_name="gemini-2.5-flash",
+                generation_config=PAIRING_GENERATION_CONFIG
+            )
+            prompt = QUESTION_ANSWER_PAIRING.format(numbered_content=numbered_content)
+            
+            print(f"🤖 Đang gửi {len(blocks):,} dòng cho AI (bảng ghép)...")
+            response = call_with_retry(lambda: model.generate_content(prompt), vertex_limiter,
+                                       tokens=estimate_tokens(prompt), label="qa-pairing")
+            
+            answer_start = find_answer_section(content)
+            answer_line = None if answer_start is None else content.count("\n", 0, answer_start)
+            pairing = parse_pairing(response.text, lines, blocks, answer_line)
+            questions = sum(1 for item in pairing if item["kind"] == "question")
+            print(f"✅ AI đã trả về bảng ghép {questions} câu hỏi")
+            return assemble_mapped_document(lines, blocks, pairing)
+        
+        except PairingError as e:
+            print(f"❌ Bảng ghép không hợp lệ: {e}")
+            return None
+        except Exception as e:
+            print(f"❌ Lỗi khi gửi cho AI: {e}")
+            return None
+    
+    def process_content_rewrite(self, content, label=None, on_chunk=None):
         """
-        Gửi nội dung cho AI để mapping câu hỏi với lời giải
+        Mapping bằng cách để AI viết lại toàn bộ tài liệu
+        Đề dài được chia đoạn tại ranh giới câu hỏi (kèm lời giải tương ứng), mapping song song
+        rồi ghép lại theo thứ tự
         Args:
             content: Nội dung file .md
+            label: tên tài liệu (đặt tên file stream)
+            on_chunk: callback(chunk_text) nhận kết quả theo từng đoạn token (chỉ khi không chia đoạn)
         Returns:
             str: Kết quả đã mapping hoặc None nếu lỗi
         """
@@ -49,17 +129,46 @@ class QuestionAnswerMapper:
             print("❌ Model chưa được khởi tạo")
             return None
         
+        chunks = plan_mapping_chunks(content, app_config.mapper_chunk_tokens)
+        if len(chunks) == 1:
+            sink = None
+            if on_chunk or app_config.generation_streaming:
+                sink = StreamSink(stream_path(label or "mapping", "mapped.md"), on_chunk)
+            return self._map_chunk(content, sink)
+        
+        print(f"✂️ Chia nội dung thành {len(chunks)} đoạn theo câu hỏi, mapping song song...")
+        workers = max(1, min(app_config.mapper_max_workers, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qa-mapper") as executor:
+            results = list(executor.map(self._map_chunk, chunks))
+        
+        if any(result is None for result in results):
+            failed = sum(1 for result in results if result is None)
+            print(f"❌ {failed}/{len(chunks)} đoạn mapping thất bại")
+            return None
+        
+        return "\n\n".join(result.strip() for result in results)
+    
+    def _map_chunk(self, content, sink=None):
+        """Mapping một đoạn nội dung bằng một request AI (sink: StreamSink nhận kết quả theo đoạn token)"""
         try:
             # Sử dụng prompt từ file data/prompt/prompts.py
             prompt = QUESTION_ANSWER_MAPPING.format(content=content)
             
             # Gửi cho AI
             print(f"🤖 Đang gửi {len(content):,} ký tự cho AI...")
-            response = self.model.generate_content(prompt)
+            def generate():
+                if sink is not None:
+                    text, _ = generate_streaming(self.model, prompt, sink)
+                    return text
+                response = self.model.generate_content(prompt)
+                return response.text if response else None
+            
+            text = call_with_retry(generate, vertex_limiter, tokens=estimate_tokens(prompt),
+                                   label="qa-mapper")
             
-            if response and response.text:
+            if text:
                 print("✅ AI đã trả về kết quả")
-                return response.text
+                return text
             else:
                 print("❌ AI không trả về kết quả")
                 return None
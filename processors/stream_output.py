@@ -0,0 +1,105 @@
+"""
+Stream Output - Nhận kết quả Vertex AI theo từng đoạn token (generate_content stream=True)
+
+- Mỗi đoạn được ghi ngay xuống file <STREAM_OUTPUT_DIR>/<tên>.<stage>.part (tail được khi đang chạy),
+  xong thì đổi tên bỏ đuôi .part; lỗi giữa chừng thì giữ lại file .part
+- Callback on_chunk nhận từng đoạn text khi vừa tới; khi request được thử lại, callback nhận
+  None (bỏ các đoạn đã nhận của lần thử trước) rồi nhận lại từ đầu
+"""
+import os
+import re
+import time
+
+from config.app_config import app_config
+
+
+def stream_path(name, stage):
+    """Đường dẫn file stream của một tài liệu / bước xử lý, vd. data/output/stream/de1.ocr.md"""
+    base_name = os.path.splitext(os.path.basename(name or "output"))[0]
+    safe_name = re.sub(r"[^\w.-]+", "_", base_name) or "output"
+    return os.path.join(app_config.stream_output_folder, f"{safe_name}.{stage}")
+
+
+class StreamSink:
+    """Ghi các đoạn text đang stream ra file / callback; dùng lại được qua các lần thử lại"""
+
+    def __init__(self, path=None, on_chunk=None):
+        """
+        Args:
+            path: file output cuối (đang stream ghi vào path + ".part"), None = không ghi file
+            on_chunk: callback(chunk_text) cho mỗi đoạn; callback(None) khi lần thử trước bị hủy
+        """
+        self.path = path
+        self.on_chunk = on_chunk
+        self.text = ""
+        self._delivered = False
+        self._file = None
+
+    def begin(self):
+        """Bắt đầu một lần thử: ghi lại file từ đầu, báo callback bỏ dữ liệu của lần thử trước"""
+        if self._delivered and self.on_chunk:
+            self.on_chunk(None)
+        self._delivered = False
+        self.text = ""
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path + ".part", "w", encoding="utf-8")
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self.text += chunk
+        if self._file:
+            self._file.write(chunk)
+            self._file.flush()
+        if self.on_chunk:
+            self.on_chunk(chunk)
+            self._delivered = True
+
+    def close(self, success=True):
+        """
+        Kết thúc lần thử: đổi file .part thành file output nếu thành công
+        Returns:
+            toàn bộ text đã nhận
+        """
+        if self._file:
+            self._file.close()
+            self._file = None
+            if success:
+                os.replace(self.path + ".part", self.path)
+        return self.text
+
+
+def generate_streaming(model, contents, sink, **kwargs):
+    """
+    Gọi model.generate_content(stream=True), chuyển từng đoạn vào sink
+    (gọi lại với cùng sink khi retry: sink ghi lại từ đầu)
+    Args:
+        model: GenerativeModel
+        contents: prompt / danh sách Part
+        sink: StreamSink
+        **kwargs: tham số khác cho generate_content (generation_config...)
+    Returns:
+        tuple (text, usage_metadata của đoạn cuối hoặc None)
+    """
+    started = time.perf_counter()
+    usage = None
+    sink.begin()
+    try:
+        for response in model.generate_content(contents, stream=True, **kwargs):
+            try:
+                chunk = response.text
+            except ValueError:
+                # Đoạn không có text (chỉ finish_reason / usage)
+                chunk = ""
+            if chunk and not sink.text:
+                print(f"⚡ Nhận đoạn đầu tiên sau {time.perf_counter() - started:.2f}s")
+            sink.write(chunk)
+            usage = getattr(response, "usage_metadata", None) or usage
+    except Exception:
+        sink.close(success=False)
+        raise
+    return sink.close(success=True), usage
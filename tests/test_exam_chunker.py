@@ -0,0 +1,75 @@
+from processors.exam_chunker import find_answer_section, plan_mapping_chunks
+
+
+def _question(number, part):
+    return f"**Câu {number}:** Nội dung câu {number} phần {part} " + "x" * 200 + "\n"
+
+
+def _solution(number, part):
+    return f"**Câu {number}:** Giải câu {number} phần {part}\n"
+
+
+def _exam_with_repeated_headings(numbers_by_part):
+    questions = "".join(
+        f"**PHẦN {part}**\n" + "".join(_question(n, part) for n in numbers)
+        for part, numbers in numbers_by_part
+    )
+    answers = "".join(
+        f"**PHẦN {part}**\n" + "".join(_solution(n, part) for n in numbers)
+        for part, numbers in numbers_by_part
+    )
+    return questions, "HƯỚNG DẪN GIẢI CHI TIẾT\n" + answers
+
+
+def _chunk_of(chunks, text):
+    return next(i for i, chunk in enumerate(chunks) if text in chunk)
+
+
+def test_answer_block_with_repeated_part_headings_is_detected():
+    questions, answers = _exam_with_repeated_headings([("I", [1, 2, 3]), ("II", [1, 2])])
+    content = questions + answers
+    assert find_answer_section(content) == len(questions)
+
+
+def test_answer_block_routes_by_part_and_number():
+    questions, answers = _exam_with_repeated_headings([("I", [1, 2, 3]), ("II", [1, 2])])
+    chunks = plan_mapping_chunks(questions + answers, max_tokens=80)
+    assert len(chunks) > 1
+    for part, number in [("I", 1), ("I", 2), ("I", 3), ("II", 1), ("II", 2)]:
+        assert (_chunk_of(chunks, f"Nội dung câu {number} phần {part} ")
+                == _chunk_of(chunks, f"Giải câu {number} phần {part}\n"))
+    # Tiêu đề phần của khối lời giải không lọt vào lời giải
+    assert all(chunk.count("PHẦN II") <= 1 for chunk in chunks)
+    assert all("HƯỚNG DẪN GIẢI" not in chunk for chunk in chunks)
+
+
+def test_answer_block_with_continuous_numbering_across_parts():
+    questions, answers = _exam_with_repeated_headings([("I", [1, 2, 3]), ("II", [4, 5])])
+    content = questions + answers
+    assert find_answer_section(content) == len(questions)
+    chunks = plan_mapping_chunks(content, max_tokens=80)
+    assert len(chunks) > 1
+    assert _chunk_of(chunks, "Nội dung câu 4 phần II") == _chunk_of(chunks, "Giải câu 4 phần II")
+
+
+def test_answer_block_without_part_headings_restarts_numbering():
+    content = "".join(_question(n, "I") for n in (1, 2, 3)) + "ĐÁP ÁN\n"
+    content += "".join(_solution(n, "I") for n in (1, 2, 3))
+    assert find_answer_section(content) == content.index("ĐÁP ÁN")
+    chunks = plan_mapping_chunks(content, max_tokens=80)
+    assert len(chunks) > 1
+    assert _chunk_of(chunks, "Nội dung câu 2 phần I") == _chunk_of(chunks, "Giải câu 2 phần I")
+
+
+def test_inline_solution_before_next_part_is_not_an_answer_block():
+    content = (
+        "**PHẦN I**\n" + _question(1, "I") + "Lời giải\nGiải câu 1\n" + _question(2, "I")
+        + "Lời giải\nGiải câu 2\n**PHẦN II**\n" + _question(1, "II") + "Lời giải\nGiải câu 1\n"
+    )
+    assert find_answer_section(content) is None
+
+
+def test_inline_solutions_keep_content_order():
+    content = "".join(_question(n, "I") + f"Lời giải\nGiải câu {n}\n" for n in (1, 2, 3, 4))
+    assert find_answer_section(content) is None
+    assert "".join(plan_mapping_chunks(content, max_tokens=80)) == content
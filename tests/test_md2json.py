@@ -0,0 +1,51 @@
+import json
+
+from processors import md2json
+
+
+def _exam_with_repeated_headings():
+    questions = (
+        "**PHẦN I**\n" + "".join(f"**Câu {n}:** Câu hỏi {n}\nA. 1\nB. 2\n" for n in (1, 2, 3))
+        + "**PHẦN II**\n" + "".join(f"**Câu {n}:** Câu hỏi {n}\n" for n in (1, 2))
+    )
+    answers = (
+        "HƯỚNG DẪN GIẢI CHI TIẾT\n"
+        "**PHẦN I**\n" + "".join(f"**Câu {n}:** Giải {n}\n" for n in (1, 2, 3))
+        + "**PHẦN II**\n" + "".join(f"**Câu {n}:** Giải {n}\n" for n in (1, 2))
+    )
+    return questions + answers
+
+
+def test_answer_block_with_repeated_part_headings_uses_single_call(monkeypatch):
+    calls = []
+
+    def fake_call(content, stream_name=None, on_chunk=None, fused=False):
+        calls.append(content)
+        return json.dumps({"quizParts": [{"sectionIndex": 0, "questions": []}]})
+
+    monkeypatch.setattr(md2json, "call_vertex_ai_model", fake_call)
+    monkeypatch.setattr(md2json.app_config, "md2json_section_parallel", True)
+    monkeypatch.setattr(md2json.app_config, "md2json_max_chunk_chars", 0)
+
+    content = _exam_with_repeated_headings()
+    result = md2json.convert_markdown_to_json(content)
+
+    assert calls == [content]
+    assert len(result["quizParts"]) == 1
+
+
+def test_exam_without_answer_block_is_split_by_part(monkeypatch):
+    calls = []
+
+    def fake_call(content, stream_name=None, on_chunk=None, fused=False):
+        calls.append(content)
+        return json.dumps({"quizParts": [{"sectionIndex": 0, "questions": []}]})
+
+    monkeypatch.setattr(md2json, "call_vertex_ai_model", fake_call)
+    monkeypatch.setattr(md2json.app_config, "md2json_section_parallel", True)
+    monkeypatch.setattr(md2json.app_config, "md2json_max_chunk_chars", 0)
+
+    content = _exam_with_repeated_headings().split("HƯỚNG DẪN GIẢI CHI TIẾT")[0]
+    md2json.convert_markdown_to_json(content)
+
+    assert len(calls) == 2
@@ -0,0 +1,41 @@
+from processors.ocr_cache import OCRCache, is_cacheable
+
+
+def _cache(tmp_path):
+    return OCRCache(cache_dir=str(tmp_path), enabled=True)
+
+
+def test_is_cacheable():
+    assert is_cacheable({"text": "$x$", "line_data": []})
+    assert is_cacheable("Câu 1: ...")
+    assert not is_cacheable(None)
+    assert not is_cacheable("  ")
+    assert not is_cacheable({"error": "Invalid image", "error_info": {"id": "image_decode_error"}})
+    assert not is_cacheable({"text": "partial", "error": "timeout"})
+    assert not is_cacheable({"line_data": []})
+
+
+def test_error_payload_is_not_cached(tmp_path):
+    cache = _cache(tmp_path)
+    key = cache.build_key("digest", engine="mathpix", prompt={"formats": ["mmd"]})
+
+    cache.put(key, {"error": "Invalid credentials"})
+    assert cache.get(key) is None
+
+    cache.put(key, {"text": "ok"})
+    assert cache.get(key) == {"text": "ok"}
+
+
+def test_get_or_compute_retries_after_error_payload(tmp_path):
+    cache = _cache(tmp_path)
+    key = cache.build_key("digest", engine="mathpix")
+    responses = iter([{"error": "Server busy"}, {"text": "Câu 1"}])
+
+    value, from_cache = cache.get_or_compute(key, lambda: next(responses))
+    assert value == {"error": "Server busy"} and not from_cache
+
+    value, from_cache = cache.get_or_compute(key, lambda: next(responses))
+    assert value == {"text": "Câu 1"} and not from_cache
+
+    value, from_cache = cache.get_or_compute(key, lambda: {"text": "không gọi"})
+    assert value == {"text": "Câu 1"} and from_cache